@@ -31,6 +31,14 @@ GLOBAL = {}
 SMTP = {}
 TEAMS = {}
 LANGUAGE = {}
+JOBS = {}
+SUPPRESS = {}
+CORRELATE = {}
+ROUTING = {}
+MAINTENANCE = {}
+TRACING = {}
+LATENCY = {}
+CAPTURE = {}
 
 
 # Create the empty list of plugins
@@ -55,3 +63,11 @@ SMTP = config['smtp']
 PLUGINS = config['plugins']
 TEAMS = config['teams']
 LANGUAGE = config['language']
+JOBS = config['jobs']
+SUPPRESS = config['suppress']
+CORRELATE = config['correlate']
+ROUTING = config['routing']
+MAINTENANCE = config['maintenance']
+TRACING = config['tracing']
+LATENCY = config['latency']
+CAPTURE = config['capture']
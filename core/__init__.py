@@ -7,14 +7,49 @@ azureauth
     Connects to Microsoft Identity Services API
     Authenticates the app/user, and gets a token
 
+capture
+    Saves a sample of webhooks, redacted, for load testing
+
+correlate
+    Merges related events from different plugins into incidents
+
 crypto
     Provides cryptographic functions
     Verifies and decrypts Resource Data sent from the Graph API
     Decrypts passwords in the secrets file
 
+decode
+    Decodes webhooks quickly, into the fields each plugin declares
+    Decodes very large webhooks incrementally
+
+diff
+    Compares two versions of a config, and describes the changes
+
+event
+    A common event record, which plugins parse their webhooks into
+
 hash
     Creates a HMAC hash, to verify the sender of the webhook
 
+jobs
+    Runs long-running jobs, one per device at a time
+    Keeps a job table on disk, so unfinished jobs resume after a restart
+
+latency
+    Measures delivery latency from the source, to Teams and SQL
+    Sends a daily percentile report
+
+maintenance
+    Maintenance windows, added when the bot reboots a device
+    Events for devices in a window are suppressed or downgraded
+
+matcher
+    Finds many patterns in text (or bytes) in a single pass
+
+metrics
+    Counters and latency histograms for each stage
+    Renders them for Prometheus, at /metrics
+
 nlp
     Natural Language Processor
     Process text input and figure out how to handle it
@@ -26,13 +61,34 @@ plugin
     A template class that plugins can inherit
     Includes some default methods that plugins may choose to use
 
+prefilter
+    Filters webhooks using their raw bytes, before they are decoded
+
+profiler
+    Samples the stacks of all threads, and memory, on demand
+
+routing
+    Compiles routing rules, that pick the chats (and email) for each event
+
+severity
+    Compiles priority rules from plugin config into fast lookup tables
+
 smtp
     Connects to an SMTP server and sends an email
 
 sql
     Creates and reads entries in/from an SQL database
 
+suppress
+    Suppresses duplicate and flapping events, across all plugins
+
 teamschat
     Connects to the Microsoft Graph API, and interacts with MS-Teams chats
 
+timestamp
+    Converts webhook timestamps into local times, with one time per event
+
+trace
+    Gives each webhook and chat message a trace ID, and times each stage
+
 """
@@ -0,0 +1,364 @@
+"""
+Captures a sample of inbound webhooks, so they can be replayed later
+
+Captured webhooks are used by tools/replay.py, to load test the service
+    with real traffic
+
+A share of authenticated webhooks (set by 'sample_rate') is captured
+    Sensitive fields (eg, passwords, signatures, and tokens) are redacted,
+    in both the headers and the body
+    Each plugin has its own gzip compressed files, as JSON lines
+    Files are rotated when they reach 'max_bytes', and only the newest
+    'keep' files are kept
+
+Webhooks are written by a background thread, so capturing doesn't slow
+    down the webhook; If the queue is full, webhooks are not captured
+
+Modules:
+    3rd Party: termcolor, threading, queue, random, time, os, gzip, json,
+        glob
+    Custom: config, core.decode, core.metrics
+
+Classes:
+
+    CaptureWriter
+        Writes captured webhooks to rotating files
+
+Functions
+
+    redact()
+        Redact sensitive fields in a webhook
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    writer : CaptureWriter
+        The shared capture writer
+
+Limitations:
+    Redacted webhooks can't be authenticated when they're replayed
+        (tools/replay.py skips authentication when it runs the app itself)
+    Redaction is by field name; Sensitive values in other fields are kept
+    Webhooks that aren't JSON are stored as text
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import termcolor
+import threading
+import queue
+import random
+import time
+import os
+import gzip
+import json
+import glob
+
+from config import CAPTURE
+from core import decode, metrics
+
+
+CAPTURED = metrics.counter(
+    'captured_total',
+    'Webhooks captured for replay, by plugin',
+    ('plugin',)
+)
+CAPTURE_DROPPED = metrics.counter(
+    'capture_dropped_total',
+    'Webhooks not captured, as the capture queue was full'
+)
+
+
+def redact(value, words):
+    '''
+    Redacts sensitive fields in a webhook
+    Any field with a name containing one of the words is replaced
+
+        Parameters:
+            value : any
+                The webhook (or part of it)
+            words : tuple
+                Lower case words that mark a field as sensitive
+
+        Raises:
+            None
+
+        Returns:
+            value : any
+                A copy, with sensitive fields replaced with 'REDACTED'
+    '''
+
+    if isinstance(value, dict):
+        return {
+            key: 'REDACTED' if any(word in key.lower() for word in words)
+            else redact(item, words)
+            for key, item in value.items()
+        }
+
+    if isinstance(value, list):
+        return [redact(item, words) for item in value]
+
+    return value
+
+
+class CaptureWriter():
+    """Writes captured webhooks to rotating files
+
+    Attributes
+    ----------
+    queue : queue.Queue
+        Webhooks waiting to be written
+    files : dict
+        The open file for each plugin, and the bytes written to it
+
+    Methods
+    -------
+    capture()
+        Queue a webhook to be captured (if it's sampled)
+    run()
+        Write queued webhooks, in the background
+    write()
+        Redact a webhook, and write it to its plugin's file
+    flush()
+        Flush all open files
+    rotate()
+        Start a new file for a plugin, and remove old files
+    start()
+        Start the background writer, if it isn't running
+    """
+
+    def __init__(self, settings=CAPTURE):
+        """Class constructor
+
+        Parameters
+        ----------
+        settings : dict
+            The 'capture' section of the global config
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=settings['queue'])
+        self.files = {}
+        self.thread = None
+        self.words = tuple(word.lower() for word in settings['redact'])
+
+    def capture(self, plugin, route, headers, body):
+        """Queue a webhook to be captured (if it's sampled)
+
+        Parameters
+        ----------
+        plugin : str
+            The plugin name
+        route : str
+            The route the webhook was sent to
+        headers : dict
+            The HTTP headers
+        body : bytes
+            The raw webhook
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        if not self.settings['enabled']:
+            return
+        if random.random() >= self.settings['sample_rate']:
+            return
+
+        self.start()
+        try:
+            self.queue.put_nowait(
+                (time.time(), plugin, route, dict(headers), body)
+            )
+        except queue.Full:
+            CAPTURE_DROPPED.inc()
+
+    def run(self):
+        """Write queued webhooks, in the background
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        Exception
+            If a webhook can't be written (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        while True:
+            item = self.queue.get()
+            try:
+                self.write(*item)
+
+                # Flush when there's a gap, so files can be read while
+                #   they're being written
+                if self.queue.empty():
+                    self.flush()
+
+            except Exception as err:
+                print(termcolor.colored(
+                    f"Could not capture a webhook: {err}",
+                    "red"
+                ))
+
+    def write(self, received, plugin, route, headers, body):
+        """Redact a webhook, and write it to its plugin's file
+
+        Parameters
+        ----------
+        received : float
+            When the webhook arrived (epoch seconds)
+        plugin : str
+            The plugin name
+        route : str
+            The route the webhook was sent to
+        headers : dict
+            The HTTP headers
+        body : bytes
+            The raw webhook
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        record = {
+            'time': received,
+            'plugin': plugin,
+            'route': route,
+            'headers': redact(headers, self.words),
+        }
+        try:
+            record['body'] = redact(decode.loads(body), self.words)
+        except ValueError:
+            record['text'] = body.decode('utf-8', errors='replace')
+
+        line = (json.dumps(record) + '\n').encode('utf-8')
+
+        with self.lock:
+            entry = self.files.get(plugin)
+            if entry is None or entry[1] >= self.settings['max_bytes']:
+                entry = self.rotate(plugin)
+
+            entry[0].write(line)
+            entry[1] += len(line)
+
+        CAPTURED.inc(plugin)
+
+    def flush(self):
+        """Flush all open files
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            for entry in self.files.values():
+                entry[0].flush()
+
+    def rotate(self, plugin):
+        """Start a new file for a plugin, and remove old files
+
+        Must be called with the lock held
+
+        Parameters
+        ----------
+        plugin : str
+            The plugin name
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        entry : list
+            The new file, and the bytes written to it
+        """
+
+        if plugin in self.files:
+            self.files[plugin][0].close()
+
+        # Milliseconds, so files rotated in the same second have new names
+        now = time.time()
+        os.makedirs(self.settings['folder'], exist_ok=True)
+        name = os.path.join(
+            self.settings['folder'],
+            f"{plugin}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}"
+            f"-{int(now * 1000) % 1000:03d}.jsonl.gz"
+        )
+        entry = self.files[plugin] = [gzip.open(name, 'ab'), 0]
+
+        # Remove the oldest files (names sort by time)
+        old = sorted(glob.glob(
+            os.path.join(self.settings['folder'], f"{plugin}-*.jsonl.gz")
+        ))
+        for filename in old[:-self.settings['keep']]:
+            os.remove(filename)
+
+        return entry
+
+    def start(self):
+        """Start the background writer, if it isn't running
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        if self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+
+# The shared capture writer
+writer = CaptureWriter()
@@ -0,0 +1,577 @@
+"""
+Correlates events from different plugins into incidents
+
+One outage often shows up in several plugins (eg, a Mist up/down, a Junos
+    syslog event, and a Log Insight alert for the same device)
+Events for the same device (or site) within the window are merged into
+    one incident, and one Teams message
+    The first event is sent as normal, and becomes the incident's message
+    Later events are added to that message, instead of being sent
+When an incident closes, one incident record is written to SQL
+
+Incidents are found with a dictionary lookup, so this doesn't slow down
+    as more incidents are tracked
+Open incidents are also kept in a heap, ordered by when they expire, so
+    expiry only looks at incidents that are due
+
+Modules:
+    3rd Party: termcolor, threading, time, heapq, itertools, dataclasses,
+        datetime, typing
+    Custom: config, core.suppress, core.sql, core.timestamp
+
+Classes:
+
+    Incident
+        A group of related events
+    Correlator
+        Matches events to incidents, and expires them
+
+Functions
+
+    host_name()
+        Get the name a device is matched on
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    engine : Correlator
+        The shared correlator, used by all plugins
+    MAX_RELATED : int
+        The most events listed in an incident's Teams message
+
+Limitations:
+    Incidents are kept in memory, so open incidents are lost on a restart
+    Events are matched on device names, so plugins need to use the same
+        names for a device (case and domain names don't matter, so
+        'sw01.example.com' matches 'SW01')
+    Incidents stay open while events keep arriving; 'max_age' limits this
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import termcolor
+import threading
+import time
+import heapq
+import itertools
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
+
+from config import CORRELATE
+from core import suppress, sql, timestamp
+
+
+# The most events listed in an incident's Teams message
+MAX_RELATED = 20
+
+
+def host_name(device):
+    '''
+    Gets the name a device is matched on
+    Log Insight sends full domain names, while Mist and Junos use the
+        short host name, so the domain is removed (IP addresses are kept)
+
+        Parameters:
+            device : str
+                The device name, as the plugin gave it
+
+        Raises:
+            None
+
+        Returns:
+            name : str
+                The lower case host name
+    '''
+
+    name = device.strip().lower()
+    if name.replace('.', '').isdigit():
+        return name
+
+    return name.split('.')[0]
+
+
+@dataclass(slots=True, eq=False)
+class Incident():
+    """A group of related events
+
+    Attributes
+    ----------
+    id : int
+        A number for the incident
+    keys : set
+        The devices (and sites) the incident is indexed by
+    devices : list
+        The devices in the incident, in the order they were seen
+    site : str
+        The site of the first event that had one
+    sources : list
+        The plugins that sent events, in the order they were seen
+    types : list
+        The event types, in the order they were seen
+    first : datetime
+        The time of the first event
+    last : datetime
+        The time of the latest event
+    opened : float
+        When the incident was opened (monotonic seconds)
+    expires : float
+        When the incident closes, unless more events arrive
+    count : int
+        The number of events in the incident
+    post : suppress.Post
+        The Teams message for the incident
+    """
+
+    id: int
+    keys: set
+    devices: list
+    site: str
+    sources: list
+    types: list
+    first: datetime
+    last: datetime
+    opened: float
+    expires: float
+    count: int = 1
+    post: Any = None
+
+    def sql_row(self):
+        """Get the incident's record, for SQL
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        row : dict
+            Column names and their raw values (for Sql.add_many())
+        """
+
+        return {
+            'device': ', '.join(self.devices),
+            'site': self.site,
+            'event': ', '.join(self.sources),
+            'description': ', '.join(self.types),
+            'logdate': self.first.date(),
+            'logtime': timestamp.clock(self.first),
+            'enddate': self.last.date(),
+            'endtime': timestamp.clock(self.last),
+            'events': self.count,
+            'message': self.post.message_id if self.post else '',
+        }
+
+
+class Correlator():
+    """Matches events to incidents, and expires them
+
+    Attributes
+    ----------
+    index : dict
+        Open incidents, keyed by device (and site)
+    expiry : list
+        A heap of open incidents, ordered by when they expire
+    stats : dict
+        Counts of incidents and correlated events
+
+    Methods
+    -------
+    keys()
+        Get the keys an event is matched on
+    check()
+        Match events to incidents
+    join()
+        Add an event to an incident, and keep the incident open
+    posted()
+        Record the Teams message that incidents were opened in
+    expire()
+        Remove incidents that have expired
+    write()
+        Write closed incidents to SQL
+    sweep()
+        Close expired incidents, in the background
+    start()
+        Start the background sweeper, if it isn't running
+    """
+
+    def __init__(self, settings=CORRELATE):
+        """Class constructor
+
+        Parameters
+        ----------
+        settings : dict
+            The 'correlate' section of the global config
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.index = {}
+        self.expiry = []
+        self.ids = itertools.count(1)
+        self.sweeper = None
+        self.stats = {'opened': 0, 'correlated': 0, 'closed': 0}
+
+        self.sources = set(settings['sources'])
+        self.ignore = {host_name(device) for device in settings['ignore']}
+
+    def keys(self, event):
+        """Get the keys an event is matched on
+
+        Some events list several devices (eg, Mist alarms)
+        Events without a device can be matched on their site
+
+        Parameters
+        ----------
+        event : core.event.Event
+            The event
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        keys : list
+            ('device', name) and ('site', name) tuples
+        """
+
+        if event.source not in self.sources:
+            return []
+
+        names = dict.fromkeys(
+            host_name(device) for device in event.device.split(',')
+        )
+        keys = [
+            ('device', name)
+            for name in names
+            if name and name not in self.ignore
+        ]
+
+        if not keys and event.site and self.settings['by_site']:
+            keys.append(('site', event.site.lower()))
+
+        return keys
+
+    def check(self, events):
+        """Match events to incidents
+
+        Events that join an incident with a Teams message have their own
+            message removed, and are added to the incident's message
+        Other events open a new incident, or are left alone
+
+        Parameters
+        ----------
+        events : list
+            core.event.Event objects
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        related : list
+            Events that were added to an existing incident's message
+        """
+
+        if not self.settings['enabled']:
+            return []
+
+        related = []
+        dirty = set()
+        window = self.settings['window']
+
+        with self.lock:
+            now = time.monotonic()
+            closed = self.expire(now)
+
+            for event in events:
+                keys = self.keys(event)
+                if not keys:
+                    continue
+
+                # Find an open incident for any of the event's keys
+                incident = None
+                for key in keys:
+                    incident = self.index.get(key)
+                    if incident is not None:
+                        break
+
+                if incident is None:
+                    incident = Incident(
+                        id=next(self.ids),
+                        keys=set(),
+                        devices=[],
+                        site=event.site,
+                        sources=[event.source],
+                        types=[event.type],
+                        first=event.when,
+                        last=event.when,
+                        opened=now,
+                        expires=now + window
+                    )
+                    heapq.heappush(
+                        self.expiry,
+                        (incident.expires, incident.id, incident)
+                    )
+                    self.stats['opened'] += 1
+                else:
+                    self.join(incident, event, now)
+
+                # Index the incident by all of the event's keys
+                for key in keys:
+                    if key not in incident.keys:
+                        incident.keys.add(key)
+                        self.index[key] = incident
+                        if key[0] == 'device':
+                            incident.devices.append(event.device)
+
+                # The first event is the incident's message
+                if incident.count == 1 or incident.post is None:
+                    continue
+
+                # List the first few events, then count the rest
+                if incident.count <= MAX_RELATED:
+                    line = f"{timestamp.clock(event.when)} {event.source}: \
+                        {event.device} {event.type} {event.description}"
+                    key = incident.count
+                else:
+                    line = f"...and {incident.count - MAX_RELATED} more"
+                    key = 'more'
+                suppress.add_line(incident.post, 'Related events', key, line)
+                event.message = ''
+                event.chat_id = incident.post.message_id
+                related.append(event)
+                dirty.add(incident.post)
+
+            self.stats['correlated'] += len(related)
+
+        self.write(closed)
+        for post in dirty:
+            suppress.edit(post, self.settings['update_interval'])
+
+        self.start()
+        return related
+
+    def join(self, incident, event, now):
+        """Add an event to an incident, and keep the incident open
+
+        Must be called with the lock held
+
+        Parameters
+        ----------
+        incident : Incident
+            The incident
+        event : core.event.Event
+            The event
+        now : float
+            The current time (monotonic seconds)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        incident.count += 1
+        incident.last = max(incident.last, event.when)
+        if not incident.site:
+            incident.site = event.site
+        if event.source not in incident.sources:
+            incident.sources.append(event.source)
+        if event.type not in incident.types:
+            incident.types.append(event.type)
+
+        # Incidents can't be extended past their maximum age
+        incident.expires = min(
+            now + self.settings['window'],
+            incident.opened + self.settings['max_age']
+        )
+
+    def posted(self, events, post):
+        """Record the Teams message that incidents were opened in
+
+        Parameters
+        ----------
+        events : list
+            The events that were in the message
+        post : suppress.Post
+            The Teams message
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        if not self.settings['enabled'] or not post.message_id:
+            return
+
+        with self.lock:
+            for event in events:
+                for key in self.keys(event):
+                    incident = self.index.get(key)
+                    if incident is not None:
+                        if incident.post is None:
+                            incident.post = post
+                        break
+
+    def expire(self, now):
+        """Remove incidents that have expired
+
+        The heap is ordered by expiry time, so only incidents that are due
+            are looked at
+        Incidents that were extended are pushed back with their new time
+        Must be called with the lock held
+
+        Parameters
+        ----------
+        now : float
+            The current time (monotonic seconds)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        closed : list
+            The incidents that were closed
+        """
+
+        closed = []
+        while self.expiry and self.expiry[0][0] <= now:
+            _, _, incident = heapq.heappop(self.expiry)
+
+            # Extended since it was pushed; Check again later
+            if incident.expires > now:
+                heapq.heappush(
+                    self.expiry,
+                    (incident.expires, incident.id, incident)
+                )
+                continue
+
+            for key in incident.keys:
+                if self.index.get(key) is incident:
+                    del self.index[key]
+            closed.append(incident)
+
+        self.stats['closed'] += len(closed)
+        return closed
+
+    def write(self, closed):
+        """Write closed incidents to SQL
+
+        Only incidents with at least 'min_events' events are written
+
+        Parameters
+        ----------
+        closed : list
+            The incidents that were closed
+
+        Raises
+        ------
+        Exception
+            If there's a problem writing to SQL (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        rows = [
+            incident.sql_row() for incident in closed
+            if incident.count >= self.settings['min_events']
+        ]
+        if not rows or not self.settings['table']:
+            return
+
+        try:
+            sql_conn = sql.Sql()
+            sql_conn.add_many(self.settings['table'], rows)
+        except Exception as err:
+            print(termcolor.colored(
+                f"Could not write incidents to SQL: {err}",
+                "red"
+            ))
+
+    def sweep(self):
+        """Close expired incidents
+
+        Runs in the background, so incidents close even when no events
+            are arriving
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        while True:
+            time.sleep(self.settings['sweep_interval'])
+            with self.lock:
+                closed = self.expire(time.monotonic())
+
+            self.write(closed)
+
+    def start(self):
+        """Start the background sweeper, if it isn't running
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        if self.sweeper is not None:
+            return
+
+        with self.lock:
+            if self.sweeper is None:
+                self.sweeper = threading.Thread(
+                    target=self.sweep,
+                    daemon=True
+                )
+                self.sweeper.start()
+
+
+# The shared correlator
+engine = Correlator()
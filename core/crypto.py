@@ -4,9 +4,9 @@ Provides cryptographic functions
     Decrypts passwords in the secrets file
 
 Modules:
-    3rd Party: Crypto, cryptography, base64, hmac, hashlib, json, pycryptodome
-        termcolor, yaml, os, re
-    Custom: config
+    3rd Party: Crypto, cryptography, base64, hmac, hashlib, pycryptodome
+        termcolor, yaml, os, re, functools
+    Custom: config, core.decode
 
 Classes:
 
@@ -20,6 +20,8 @@ Functions
         Validate the Graph API signature
     aes_decrypt()
         Decrypt the body of a Teams message (encryptes symmetrically with AES)
+    derive_key()
+        Derive (and cache) the key used to decrypt passwords
     pw_decrypt()
         Decrypt passwords from the secrets file
 
@@ -47,14 +49,15 @@ from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives import hashes
 import base64
 from base64 import b64decode, b64encode
+import functools
 import hmac
 import hashlib
-import json
 import termcolor
 import yaml
 import os
 import re
 from config import TEAMS, GLOBAL
+from core import decode
 
 
 # Decrypt the encrypted symmetric key
@@ -222,12 +225,44 @@ def aes_decrypt(decrypted_symmetric_key, data):
             b64decode(data)
         ),
         block_size=16
-    ).decode()
-    decrypted_payload = json.loads(decrypted_payload)
+    )
+    decrypted_payload = decode.loads(decrypted_payload)
 
     return decrypted_payload
 
 
+# Generate a key from the master password and a salt
+# PBKDF2 is deliberately slow, and many devices share a secrets entry,
+#   so keys are cached rather than derived for every device
+@functools.lru_cache(maxsize=64)
+def derive_key(master, salt):
+    '''
+    Derives a Fernet key from the master password and a salt
+
+        Parameters:
+            master : str
+                The master password
+            salt : str
+                The salt from the secrets file (base64 encoded)
+
+        Raises:
+            None
+
+        Returns:
+            key : bytes
+                The key, ready to use with Fernet
+    '''
+
+    # generate a key using PBKDF2HMAC
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=base64.urlsafe_b64decode(salt.encode()),
+        iterations=100000
+    )
+    return base64.urlsafe_b64encode(kdf.derive(master.encode()))
+
+
 # Retrieve a username/password for a device
 def pw_decrypt(dev_type, device):
     '''
@@ -292,17 +327,8 @@ def pw_decrypt(dev_type, device):
     # Get master PW from env variable
     master = os.getenv('chat_master_pw')
 
-    # generate a key using PBKDF2HMAC
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=base64.urlsafe_b64decode(salt.encode()),
-        iterations=100000
-    )
-    key = base64.urlsafe_b64encode(kdf.derive(master.encode()))
-
     # create a Fernet object using the key
-    fernet = Fernet(key)
+    fernet = Fernet(derive_key(master, salt))
 
     # decrypt the encrypted message using the same key
     try:
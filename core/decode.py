@@ -0,0 +1,515 @@
+"""
+Fast JSON decoding for webhooks, with optional payload schemas
+
+Plugins can declare a schema for their webhooks (the fields they use)
+    If msgspec is installed, webhooks are decoded straight into these
+    fields, and anything else in the webhook is skipped
+    If it's not, orjson (or the standard json module) decodes everything
+Decoded webhooks are always plain dictionaries and lists, so plugins
+    work the same way with any decoder
+
+Very large webhooks can be decoded incrementally
+    The items in a large list (eg, Mist events) are decoded one at a time,
+    as the plugin reads them, so filtered items are freed straight away
+    Items are slices of the raw body (it isn't copied), decoded into the
+    schema like the rest of the webhook
+    With msgspec and a schema, the list is split into raw items in the
+    same pass that decodes the other fields
+    Otherwise, items are found by counting brackets, which is slower
+
+Schema format (nested to match the webhook):
+    {'field': str}
+        A field, and its type (use typing.Any for mixed types)
+    {'field': {...}}
+        A nested object
+    {'field': [{...}]}
+        A list of objects
+    {'field': (int, str)}
+        A field that may be one of several types
+
+Modules:
+    3rd Party: json, re, typing, msgspec (optional), orjson (optional)
+    Custom: None
+
+Classes:
+
+    Decoder
+        Decodes webhooks for one plugin
+
+Functions
+
+    loads()
+        Decode JSON, with the fastest decoder available
+    build_type()
+        Convert a schema into a type msgspec can decode into
+    list_start()
+        Find where a list starts in a webhook, without decoding it
+    item_end()
+        Find where an item in a list ends, without decoding it
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    BACKEND : str
+        The decoder in use ('msgspec', 'orjson', or 'json')
+    STREAM_SIZE : int
+        Webhooks larger than this (bytes) are decoded incrementally
+
+Limitations:
+    Schemas are only enforced with msgspec
+        If a webhook doesn't match its schema, it's decoded without one
+    Incremental decoding only works on a list in a top-level field
+        Fields after the list are added once the list has been read
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import json
+import re
+from typing import TypedDict, Union
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if msgspec is not None:
+    BACKEND = 'msgspec'
+    _loads = msgspec.json.Decoder().decode
+elif orjson is not None:
+    BACKEND = 'orjson'
+    _loads = orjson.loads
+else:
+    BACKEND = 'json'
+    _loads = json.loads
+
+
+# Webhooks larger than this are decoded incrementally (1MB)
+STREAM_SIZE = 1024 * 1024
+
+# Tokens that matter when finding a list in a webhook
+#   Strings are matched whole, so brackets inside them are skipped
+TOKENS = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}:]')
+WHITESPACE = re.compile(rb'[ \t\n\r]*')
+
+# Everything up to (and including) the next bracket, skipping strings
+BRACKET = re.compile(
+    rb'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*[\[\]{}]'
+)
+
+# A string, number, or literal (true, false, null)
+SCALAR = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[^,\]\s]+')
+
+
+def loads(body):
+    '''
+    Decodes JSON, with the fastest decoder available
+
+        Parameters:
+            body : bytes or str
+                The JSON text
+
+        Raises:
+            ValueError
+                If the JSON is invalid
+
+        Returns:
+            value : any
+                The decoded JSON
+    '''
+
+    return _loads(body)
+
+
+def build_type(schema, name='Payload'):
+    '''
+    Converts a schema into a type that msgspec can decode into
+    Objects become TypedDicts, so fields not in the schema are skipped
+
+        Parameters:
+            schema : dict, list, tuple, or type
+                The schema (see the module docstring)
+            name : str
+                A name for the type
+
+        Raises:
+            None
+
+        Returns:
+            type : type
+                The type to decode into
+    '''
+
+    if isinstance(schema, dict):
+        fields = {
+            key: build_type(value, f"{name}_{index}")
+            for index, (key, value) in enumerate(schema.items())
+        }
+        return TypedDict(name, fields, total=False)
+
+    if isinstance(schema, list):
+        return list[build_type(schema[0], f"{name}_item")]
+
+    if isinstance(schema, tuple):
+        return Union[tuple(build_type(value, name) for value in schema)]
+
+    return schema
+
+
+def list_start(text, key):
+    '''
+    Finds where a list starts, in a top-level field of a JSON object
+    Only the text before the list is scanned
+
+        Parameters:
+            text : bytes
+                The JSON text
+            key : str
+                The field that holds the list
+
+        Raises:
+            None
+
+        Returns:
+            start : int
+                The position of the list's opening bracket, or None if
+                    the field isn't found, or doesn't hold a list
+    '''
+
+    target = json.dumps(key).encode('utf-8')
+    depth = 0
+    previous = None
+
+    for match in TOKENS.finditer(text):
+        token = match.group()
+
+        # The key, at the top level of the object
+        if token == b':' and depth == 1 and previous == target:
+            following = WHITESPACE.match(text, match.end()).end()
+            if text.startswith(b'[', following):
+                return following
+            return None
+
+        if token in (b'{', b'['):
+            depth += 1
+        elif token in (b'}', b']'):
+            depth -= 1
+
+        previous = token
+
+    return None
+
+
+def item_end(text, position):
+    '''
+    Finds where an item in a list ends, without decoding it
+    Only the brackets are counted, so this is much faster than decoding
+
+        Parameters:
+            text : bytes
+                The JSON text
+            position : int
+                Where the item starts
+
+        Raises:
+            ValueError
+                If the item doesn't end
+
+        Returns:
+            end : int
+                The position just after the item
+    '''
+
+    # Strings, numbers, and literals
+    if not text.startswith((b'{', b'['), position):
+        match = SCALAR.match(text, position)
+        if match is None:
+            raise ValueError(f"Invalid JSON at position {position}")
+        return match.end()
+
+    # Objects and lists end at the bracket that closes the first one
+    depth = 0
+    while True:
+        match = BRACKET.match(text, position)
+        if match is None:
+            raise ValueError(f"Unterminated JSON at position {position}")
+
+        position = match.end()
+        if text[position - 1] in b'[{':
+            depth += 1
+        else:
+            depth -= 1
+
+        if depth == 0:
+            return position
+
+
+class Decoder():
+    """Decodes webhooks for one plugin
+
+    Attributes
+    ----------
+    schema : dict
+        The payload schema (None to decode everything)
+    stream_key : str
+        A top-level field holding a list, which can be decoded
+            incrementally (None to always decode all at once)
+    typed : msgspec.json.Decoder
+        Decodes into the schema (None without msgspec or a schema)
+    typed_item : msgspec.json.Decoder
+        Decodes a stream_key item into the schema (None without msgspec,
+            or if the schema doesn't include the list)
+    typed_stream : msgspec.json.Decoder
+        Decodes into the schema, leaving the stream_key items as raw
+            slices of the body (None without msgspec or a schema)
+
+    Methods
+    -------
+    decode()
+        Decode a webhook
+    stream()
+        Decode a large webhook incrementally
+    decode_part()
+        Decode part of a webhook, into the schema if there is one
+    items()
+        Decode the items in a list, one at a time
+    raw_items()
+        Decode raw items, one at a time
+    """
+
+    def __init__(self, schema=None, stream_key=None):
+        """Class constructor; Builds the decoders
+
+        Parameters
+        ----------
+        schema : dict
+            Optional; The payload schema (see the module docstring)
+        stream_key : str
+            Optional; A top-level list that can be decoded incrementally
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.schema = schema
+        self.stream_key = stream_key
+        self.typed = None
+        self.typed_item = None
+        self.typed_stream = None
+
+        if msgspec is not None and schema is not None:
+            self.typed = msgspec.json.Decoder(build_type(schema))
+
+            item = schema.get(stream_key)
+            if isinstance(item, list):
+                self.typed_item = msgspec.json.Decoder(
+                    build_type(item[0], 'Item')
+                )
+
+            if stream_key:
+                self.typed_stream = msgspec.json.Decoder(build_type({
+                    **schema,
+                    stream_key: list[msgspec.Raw]
+                }))
+
+    def decode(self, body):
+        """Decode a webhook
+
+        Parameters
+        ----------
+        body : bytes
+            The raw request body
+
+        Raises
+        ------
+        ValueError
+            If the body isn't valid JSON
+            If the body doesn't match the schema (handled here)
+
+        Returns
+        -------
+        payload : dict
+            The decoded webhook
+            For large webhooks, the stream_key list is an iterator, which
+                can only be read once
+        """
+
+        if self.stream_key and len(body) > STREAM_SIZE:
+            payload = self.stream(body)
+            if payload is not None:
+                return payload
+
+        if self.typed is not None:
+            try:
+                return self.typed.decode(body)
+
+            # If the webhook doesn't match the schema, decode all of it
+            except ValueError:
+                pass
+
+        return _loads(body)
+
+    def stream(self, body):
+        """Decode a large webhook incrementally
+
+        The rest of the webhook is decoded straight away
+        Items in the stream_key list are decoded as they're read
+
+        Parameters
+        ----------
+        body : bytes
+            The raw request body (str is accepted, and encoded)
+
+        Raises
+        ------
+        ValueError
+            If the body isn't valid JSON
+
+        Returns
+        -------
+        payload : dict
+            The decoded webhook, or None if the list couldn't be found
+        """
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        # msgspec splits the list into raw slices of the body
+        #   If the webhook doesn't match the schema, decode() handles it
+        if self.typed_stream is not None:
+            try:
+                payload = self.typed_stream.decode(body)
+            except ValueError:
+                return None
+
+            if self.stream_key not in payload:
+                return None
+
+            payload[self.stream_key] = self.raw_items(
+                payload[self.stream_key]
+            )
+            return payload
+
+        start = list_start(body, self.stream_key)
+        if start is None:
+            return None
+
+        # Close off the object at the list, to decode everything before it
+        payload = self.decode_part(self.typed, body[:start] + b'[]}')
+        payload[self.stream_key] = self.items(body, start + 1, payload)
+        return payload
+
+    def decode_part(self, typed, text):
+        """Decode part of a webhook, into the schema if there is one
+
+        Parameters
+        ----------
+        typed : msgspec.json.Decoder
+            The schema decoder for this part (None to decode everything)
+        text : bytes or memoryview
+            The JSON text
+
+        Raises
+        ------
+        ValueError
+            If the JSON is invalid
+            If the JSON doesn't match the schema (handled here)
+
+        Returns
+        -------
+        value : any
+            The decoded JSON
+        """
+
+        if typed is not None:
+            try:
+                return typed.decode(text)
+
+            # If this part doesn't match the schema, decode all of it
+            except ValueError:
+                pass
+
+        if BACKEND == 'json':
+            text = bytes(text)
+        return _loads(text)
+
+    def items(self, text, position, payload):
+        """Decode the items in a list, one at a time
+
+        Each item is a view of the body, so the body isn't copied
+        When the list ends, the fields after it are added to the payload
+
+        Parameters
+        ----------
+        text : bytes
+            The JSON text
+        position : int
+            Where the first item starts
+        payload : dict
+            The decoded webhook
+
+        Raises
+        ------
+        ValueError
+            If the JSON is invalid
+
+        Yields
+        ------
+        item : any
+            The decoded item
+        """
+
+        view = memoryview(text)
+        while True:
+            position = WHITESPACE.match(text, position).end()
+            if text.startswith(b']', position):
+                break
+
+            end = item_end(text, position)
+            yield self.decode_part(self.typed_item, view[position:end])
+            position = WHITESPACE.match(text, end).end()
+            if text.startswith(b',', position):
+                position += 1
+
+        # The rest of the object, after the list
+        rest = WHITESPACE.match(text, position + 1).end()
+        if text.startswith(b',', rest):
+            payload.update(_loads(b'{' + text[rest + 1:]))
+
+    def raw_items(self, raws):
+        """Decode raw items, one at a time
+
+        Parameters
+        ----------
+        raws : list
+            msgspec.Raw items, which are slices of the body
+
+        Raises
+        ------
+        ValueError
+            If an item is invalid JSON
+
+        Yields
+        ------
+        item : any
+            The decoded item
+        """
+
+        for raw in raws:
+            yield self.decode_part(self.typed_item, raw)
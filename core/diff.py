@@ -0,0 +1,276 @@
+"""
+Compares two versions of a config (before and after a change)
+
+Configs are flattened into a dictionary of paths and values, so the
+    comparison is a single pass over each side (dictionary lookups,
+    rather than searching a list for every line)
+Changes are reported with the path to the value that changed,
+    eg, 'port_config > ge-0/0/1 > vlan_id'
+
+Used by plugins that receive 'before' and 'after' payloads
+    (eg, Mist audit events)
+
+Modules:
+    3rd Party: json, html
+    Custom: None
+
+Classes:
+
+    None
+
+Functions
+
+    flatten()
+        Flatten a config into paths and values
+    diff()
+        Compare two configs
+    render()
+        Turn a list of changes into HTML for a teams message
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    IDENTITY_KEYS : tuple
+        Fields used to match up items in a list of dictionaries
+    MAX_CHANGES : int
+        The default number of changes to render
+    MAX_VALUE : int
+        The default length values are truncated to when rendered
+    PRESENT : object
+        The value of set members and plain lines, which have no value
+
+Limitations:
+    Lists of plain values are compared as sets (order and duplicates are
+        ignored)
+    Lists of dictionaries without an identity field are compared by position
+    Text that isn't JSON is compared line by line, split on ', '
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import json
+import html
+
+
+# Fields that identify an item in a list of dictionaries
+#   These are used in place of the list index, if every item has one
+IDENTITY_KEYS = ('id', 'name', 'mac')
+
+# Rendering limits, so large changes don't flood a chat
+MAX_CHANGES = 20
+MAX_VALUE = 80
+
+# Set members and plain lines are keyed by their text, and have no value
+PRESENT = object()
+
+
+def identity(items):
+    '''
+    Finds a field that uniquely identifies each item in a list
+
+        Parameters:
+            items : list
+                A list of dictionaries
+
+        Raises:
+            None
+
+        Returns:
+            key : str
+                The identity field, or None if there isn't one
+    '''
+
+    for key in IDENTITY_KEYS:
+        values = [
+            item.get(key) for item in items
+            if isinstance(item, dict)
+        ]
+        if (
+            len(values) == len(items) and
+            None not in values and
+            len(set(map(str, values))) == len(values)
+        ):
+            return key
+
+    return None
+
+
+def flatten(config):
+    '''
+    Flattens a config into a dictionary of paths and values
+    Each path is a tuple of keys, leading to a single value
+
+    Text is decoded as JSON if possible, otherwise it's split into lines
+
+        Parameters:
+            config : any
+                A config (dict, list, JSON text, or plain text)
+
+        Raises:
+            None
+
+        Returns:
+            flat : dict
+                Paths and their values
+    '''
+
+    if isinstance(config, (str, bytes)):
+        try:
+            config = json.loads(config)
+        except ValueError:
+            if isinstance(config, bytes):
+                config = config.decode('utf-8', errors='replace')
+            return {(line,): PRESENT for line in config.split(", ") if line}
+
+    flat = {}
+
+    # Walk the config with a stack, rather than recursion
+    #   Deeply nested configs can't hit the recursion limit
+    stack = [((), config)]
+    while stack:
+        path, value = stack.pop()
+
+        if isinstance(value, dict) and value:
+            for key, item in reversed(list(value.items())):
+                stack.append((path + (str(key),), item))
+
+        elif isinstance(value, list) and value:
+            # Dictionaries are matched by their identity field, or position
+            if isinstance(value[0], (dict, list)):
+                key = identity(value)
+                children = []
+                for index, item in enumerate(value):
+                    if key is None:
+                        label = f"[{index}]"
+                    else:
+                        label = f"[{key}={item[key]}]"
+                    children.append((path + (label,), item))
+                stack.extend(reversed(children))
+
+            # Plain values are compared as a set; The value is in the path
+            else:
+                for item in value:
+                    label = f"[{item!r}]"
+                    flat[path + (label,)] = PRESENT
+
+        else:
+            flat[path] = value
+
+    return flat
+
+
+def diff(before, after):
+    '''
+    Compares two configs
+    Each side is flattened once, and the paths compared with dictionary
+        lookups, so this takes linear time
+
+        Parameters:
+            before : any
+                The config before the change
+            after : any
+                The config after the change
+
+        Raises:
+            None
+
+        Returns:
+            changes : dict
+                'added', 'removed', and 'changed' lists
+                Each entry is a tuple of the path, old value, and new value
+    '''
+
+    old = flatten(before)
+    new = flatten(after)
+
+    changes = {'added': [], 'removed': [], 'changed': []}
+    for path, value in new.items():
+        if path not in old:
+            changes['added'].append((path, None, value))
+        elif old[path] != value:
+            changes['changed'].append((path, old[path], value))
+
+    for path, value in old.items():
+        if path not in new:
+            changes['removed'].append((path, value, None))
+
+    return changes
+
+
+def shorten(value, limit):
+    '''
+    Gets a value as escaped HTML, truncated to a maximum length
+
+        Parameters:
+            value : any
+                The value to show
+            limit : int
+                The maximum length
+
+        Raises:
+            None
+
+        Returns:
+            text : str
+                The value, ready to add to a message
+    '''
+
+    text = value if isinstance(value, str) else json.dumps(value, default=str)
+    if len(text) > limit:
+        text = text[:limit - 3] + '...'
+
+    return html.escape(text)
+
+
+def render(changes, max_changes=MAX_CHANGES, max_value=MAX_VALUE):
+    '''
+    Turns a list of changes into HTML for a teams message
+    Long lists and long values are truncated
+
+        Parameters:
+            changes : dict
+                The changes, from diff()
+            max_changes : int
+                The most changes to list; The rest are counted
+            max_value : int
+                The longest a value can be before it's truncated
+
+        Raises:
+            None
+
+        Returns:
+            message : str
+                The changes, as HTML
+    '''
+
+    lines = []
+    for kind, sign in (('changed', '~'), ('added', '+'), ('removed', '-')):
+        for path, old, new in changes[kind]:
+            if len(lines) == max_changes:
+                break
+
+            # Set members and plain lines have no value; The path says it all
+            where = shorten(' > '.join(path), max_value)
+            value = new if kind == 'added' else old
+            if kind == 'changed':
+                old = shorten(old, max_value)
+                new = shorten(new, max_value)
+                lines.append(f"{sign} {where}: {old} => {new}")
+            elif value is PRESENT:
+                lines.append(f"{sign} {where}")
+            else:
+                lines.append(f"{sign} {where}: {shorten(value, max_value)}")
+
+    total = sum(len(entries) for entries in changes.values())
+    if not total:
+        return 'No config changes found'
+
+    if total > len(lines):
+        lines.append(f"...and {total - len(lines)} more changes")
+
+    return '<br>'.join(lines)
@@ -0,0 +1,219 @@
+"""
+A common event record, shared by all plugins
+
+Each plugin parses its webhooks into Event objects
+The shared stages (Teams messages, SQL logging, batching) then work with
+    these directly, rather than each plugin building its own dictionaries
+    and quoting values for SQL
+
+Events use slots, so they're smaller and quicker to create than
+    dictionaries
+The raw webhook is kept by reference, not copied
+
+Modules:
+    3rd Party: dataclasses, datetime, socket, struct
+    Custom: core.timestamp
+
+Classes:
+
+    Event
+        A single event from a plugin
+
+Functions
+
+    ip_integer()
+        Convert an IPv4 address to an integer
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    DEFAULT_COLUMNS : tuple
+        The SQL columns most plugin tables use
+
+Limitations:
+    SQL rows only contain the columns the plugin asks for
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import socket
+import struct
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any
+
+from core import timestamp
+
+
+# The SQL columns most plugin tables use
+DEFAULT_COLUMNS = (
+    'device',
+    'event',
+    'description',
+    'logdate',
+    'logtime',
+    'source',
+    'message',
+)
+
+
+def ip_integer(ip):
+    '''
+    Converts an IPv4 address to an integer, for SQL
+    If there are several addresses (eg, from a proxy), the first is used
+
+        Parameters:
+            ip : str
+                The IP address
+
+        Raises:
+            OSError
+                If the address isn't valid (handled here)
+
+        Returns:
+            integer : int
+                The address as an integer (0 if it isn't valid)
+    '''
+
+    try:
+        packed = socket.inet_aton(ip.split(",")[0].strip())
+    except (OSError, AttributeError):
+        return 0
+
+    return struct.unpack("!L", packed)[0]
+
+
+@dataclass(slots=True)
+class Event():
+    """A single event from a plugin
+
+    Attributes
+    ----------
+    source : str
+        The plugin that received the event (eg, 'mist')
+    kind : str
+        The kind of event, within the plugin (eg, 'alarm')
+    type : str
+        The event type or name (eg, 'AP_RESTARTED')
+    device : str
+        The device the event is about
+    site : str
+        The site the device is in
+    level : int
+        The priority (1 is the highest, 4 is ignored)
+    description : str
+        A description of the event
+    when : datetime
+        The time of the event (from the webhook, or when it arrived)
+    received : datetime
+        When the webhook arrived
+    delivered : datetime
+        When the event was sent to Teams (None until it has been)
+    committed : datetime
+        When the event was written to SQL (None until it has been)
+    src_ip : str
+        The IP address that sent the webhook
+    message : str
+        The Teams message (empty if nothing should be sent)
+    chat_id : str
+        The ID of the Teams message, once it has been sent
+    raw : any
+        The webhook the event came from (a reference, not a copy)
+    details : dict
+        Anything else the plugin needs (eg, for messages)
+        Also used for plugin specific SQL columns
+
+    Methods
+    -------
+    column()
+        Get the value for an SQL column
+    sql_row()
+        Get the values for several SQL columns
+    """
+
+    source: str
+    kind: str = ''
+    type: str = ''
+    device: str = ''
+    site: str = ''
+    level: int = 1
+    description: str = ''
+    when: datetime = field(default_factory=timestamp.now)
+    received: datetime = field(default_factory=timestamp.now)
+    delivered: Any = None
+    committed: Any = None
+    src_ip: str = ''
+    message: str = ''
+    chat_id: str = ''
+    raw: Any = field(default=None, repr=False)
+    details: dict = field(default_factory=dict)
+
+    def column(self, name):
+        """Get the value for an SQL column
+
+        Values in 'details' take priority, so plugins can fill in their
+            own columns, or change a standard one
+
+        Parameters
+        ----------
+        name : str
+            The column name
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        value : any
+            The raw value (not quoted)
+        """
+
+        if name in self.details:
+            return self.details[name]
+
+        match name:
+            case 'device':
+                return self.device
+            case 'site':
+                return self.site
+            case 'event' | 'type':
+                return self.type
+            case 'description':
+                return self.description
+            case 'logdate':
+                return self.when.date()
+            case 'logtime':
+                return timestamp.clock(self.when)
+            case 'source':
+                # The SQL 'source' column is the sender's IP address
+                return ip_integer(self.src_ip)
+            case 'message':
+                return self.chat_id
+            case _:
+                return ''
+
+    def sql_row(self, columns=DEFAULT_COLUMNS):
+        """Get the values for several SQL columns
+
+        Parameters
+        ----------
+        columns : tuple
+            The column names
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        row : dict
+            Column names and their raw values (for Sql.add_many())
+        """
+
+        return {name: self.column(name) for name in columns}
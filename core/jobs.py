@@ -0,0 +1,1023 @@
+"""
+Runs long-running jobs (eg, collecting logs from a device)
+
+Jobs are queued, and run by a fixed number of worker threads
+Only one job can run against a device at a time; Others wait their turn
+The job table is saved to disk, including step checkpoints, so jobs
+    that were queued or running when the service stopped are resumed
+
+Modules:
+    3rd Party: termcolor, threading, queue, collections, json, os, re,
+        importlib, datetime, time, concurrent.futures
+    Custom: config, teamschat
+
+Classes:
+
+    Job
+        A single job, and its checkpoints
+    JobEngine
+        Queues jobs, runs them, and keeps the job table
+    StepGraph
+        Runs the steps of a job, with independent steps in parallel
+
+Functions
+
+    list_jobs()
+        Chat command to list jobs
+    cancel_job()
+        Chat command to cancel a job
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    engine : JobEngine
+        The shared job engine
+
+Limitations:
+    Job functions are stored by module and function name, so they can be
+        imported again after a restart
+    Job functions take the device and chat ID, and a 'job' keyword argument
+    Job arguments must be JSON serializable
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import termcolor
+import threading
+import queue
+import json
+import os
+import re
+import importlib
+import time
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from config import JOBS
+from core import teamschat
+
+
+class Job():
+    """A single job, and its checkpoints
+
+    Job functions use this to check if they have been cancelled,
+        and to record the steps they have completed
+
+    Attributes
+    ----------
+    record : dict
+        The job's entry in the job table
+    engine : JobEngine
+        The engine running this job
+
+    Methods
+    -------
+    cancelled()
+        Check if the job has been cancelled
+    completed()
+        Check if a step completed in an earlier run
+    data()
+        Get data saved with a step
+    checkpoint()
+        Record that a step has completed
+    """
+
+    def __init__(self, record, engine):
+        """Class constructor
+
+        Parameters
+        ----------
+        record : dict
+            The job's entry in the job table
+        engine : JobEngine
+            The engine running this job
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.record = record
+        self.engine = engine
+        self.cancel_event = threading.Event()
+
+    @property
+    def id(self):
+        return self.record['id']
+
+    @property
+    def device(self):
+        return self.record['device']
+
+    def cancelled(self):
+        """Check if the job has been cancelled
+
+        Job functions should check this between steps
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        cancelled : bool
+            True if the job should stop
+        """
+
+        return self.cancel_event.is_set()
+
+    def completed(self, step):
+        """Check if a step completed (possibly in an earlier run)
+
+        Parameters
+        ----------
+        step : str
+            The name of the step
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        completed : bool
+            True if the step has a checkpoint
+        """
+
+        return step in self.record['steps']
+
+    def data(self, step):
+        """Get the data saved with a step's checkpoint
+
+        Parameters
+        ----------
+        step : str
+            The name of the step
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        data : any
+            The saved data, or None
+        """
+
+        return self.record['steps'].get(step)
+
+    def checkpoint(self, step, data=True):
+        """Record that a step has completed
+
+        The job table is saved, so the step is skipped if the job is resumed
+
+        Parameters
+        ----------
+        step : str
+            The name of the step
+        data : any
+            Optional; JSON serializable data to keep with the checkpoint
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        # save() may be writing the record from another thread
+        with self.engine.lock:
+            self.record['steps'][step] = data
+            self.record['updated'] = str(datetime.now())
+
+        self.engine.save()
+
+
+class JobEngine():
+    """Queues jobs, runs them, and keeps the job table
+
+    A fixed pool of worker threads takes jobs from the ready queue
+    A job only enters the ready queue when no other job is running against
+        its device; Otherwise, it waits in that device's queue
+
+    Attributes
+    ----------
+    jobs : dict
+        All jobs in the job table, keyed by ID
+    ready : queue.Queue
+        Jobs that can run now
+    waiting : dict
+        Jobs waiting for their device to be free, keyed by device
+    busy : set
+        Devices with a job running or ready to run
+
+    Methods
+    -------
+    start()
+        Load the job table, resume unfinished jobs, and start the workers
+    submit()
+        Add a new job
+    cancel()
+        Cancel a job
+    position()
+        How many jobs are ahead of a job
+    summary()
+        A list of jobs, for display
+    save()
+        Write the job table to disk
+    """
+
+    def __init__(self):
+        """Class constructor
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.lock = threading.RLock()
+        self.jobs = {}
+        self.ready = queue.Queue()
+        self.waiting = {}
+        self.busy = set()
+        self.workers = []
+        self.next_id = 1
+
+    def start(self):
+        """Load the job table, resume unfinished jobs, and start the workers
+
+        Safe to call more than once
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        Exception
+            If the job table can't be read (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            if self.workers:
+                return
+
+            # Load the job table from the last run
+            records = []
+            try:
+                with open(JOBS['job_file']) as file:
+                    records = json.load(file)
+            except FileNotFoundError:
+                pass
+            except Exception as err:
+                print(termcolor.colored(
+                    f"Could not load the job table: {err}",
+                    "red"
+                ))
+
+            for record in records:
+                job = Job(record, self)
+                self.jobs[job.id] = job
+                self.next_id = max(self.next_id, job.id + 1)
+
+                # Anything queued or running when we stopped is resumed
+                if record['status'] in ('queued', 'running'):
+                    print(termcolor.colored(
+                        f"Resuming job {job.id}: {record['name']}",
+                        "yellow"
+                    ))
+                    record['status'] = 'queued'
+                    self.enqueue(job)
+
+            # Start the workers
+            for number in range(JOBS['workers']):
+                worker = threading.Thread(
+                    target=self.worker,
+                    name=f"job-worker-{number}",
+                    daemon=True
+                )
+                worker.start()
+                self.workers.append(worker)
+
+        self.save()
+
+    def submit(self, name, module, function, device, chat_id, **args):
+        """Add a new job
+
+        Parameters
+        ----------
+        name : str
+            A description of the job
+        module : str
+            The module containing the job function
+        function : str
+            The name of the job function
+        device : str
+            The device the job works on
+        chat_id : str
+            The chat to report to
+        args : dict
+            Extra arguments for the job function (JSON serializable)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        job : Job
+            The new job
+        """
+
+        self.start()
+
+        with self.lock:
+            record = {
+                'id': self.next_id,
+                'name': name,
+                'module': module,
+                'function': function,
+                'device': device,
+                'chat_id': chat_id,
+                'args': args,
+                'status': 'queued',
+                'steps': {},
+                'created': str(datetime.now()),
+                'updated': str(datetime.now()),
+            }
+            self.next_id += 1
+
+            job = Job(record, self)
+            self.jobs[job.id] = job
+            self.enqueue(job)
+
+        self.save()
+        return job
+
+    def enqueue(self, job):
+        """Make a job ready to run, or queue it behind its device
+
+        Parameters
+        ----------
+        job : Job
+            The job to queue
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        key = job.device.lower()
+        with self.lock:
+            if key in self.busy:
+                self.waiting.setdefault(key, deque()).append(job)
+            else:
+                self.busy.add(key)
+                self.ready.put(job)
+
+    def worker(self):
+        """A worker thread; Runs jobs from the ready queue
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        Exception
+            If a job fails unexpectedly (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        while True:
+            job = self.ready.get()
+
+            if job.record['status'] != 'cancelled':
+                self.run(job)
+
+            self.finish(job)
+
+    def run(self, job):
+        """Run a single job
+
+        Parameters
+        ----------
+        job : Job
+            The job to run
+
+        Raises
+        ------
+        Exception
+            If the job fails unexpectedly (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        record = job.record
+        with self.lock:
+            record['status'] = 'running'
+            record['started'] = str(datetime.now())
+        self.save()
+
+        print(termcolor.colored(
+            f"Starting job {job.id}: {record['name']}",
+            "green"
+        ))
+
+        try:
+            module = importlib.import_module(record['module'])
+            function = getattr(module, record['function'])
+            result = function(
+                record['device'],
+                record['chat_id'],
+                job=job,
+                **record['args']
+            )
+
+        except Exception as err:
+            print(termcolor.colored(
+                f"Job {job.id} failed: {repr(err)}",
+                "red"
+            ))
+            teamschat.send_chat(
+                f"Job {job.id} ({record['name']}) failed<br> \
+                    <span style=\"color:Red\">{repr(err)}</span>",
+                record['chat_id']
+            )
+            result = False
+
+        with self.lock:
+            if job.cancelled():
+                record['status'] = 'cancelled'
+            elif result:
+                record['status'] = 'done'
+            else:
+                record['status'] = 'failed'
+
+            record['finished'] = str(datetime.now())
+
+        print(termcolor.colored(
+            f"Job {job.id} finished: {record['status']}",
+            "green"
+        ))
+
+    def finish(self, job):
+        """Free the job's device, and start the next job waiting for it
+
+        Parameters
+        ----------
+        job : Job
+            The job that has finished
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        key = job.device.lower()
+        with self.lock:
+            waiting = self.waiting.get(key)
+            if waiting:
+                self.ready.put(waiting.popleft())
+                if not waiting:
+                    del self.waiting[key]
+            else:
+                self.busy.discard(key)
+
+        self.save()
+
+    def cancel(self, job_id):
+        """Cancel a job
+
+        Queued jobs are skipped when they reach the front of the queue
+        Running jobs are asked to stop at their next checkpoint
+
+        Parameters
+        ----------
+        job_id : int
+            The ID of the job to cancel
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        message : str
+            A description of what happened
+        """
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return f"I can't find job {job_id}"
+
+            status = job.record['status']
+            if status == 'queued':
+                job.record['status'] = 'cancelled'
+                job.cancel_event.set()
+                message = f"Job {job_id} has been cancelled"
+
+            elif status == 'running':
+                job.cancel_event.set()
+                message = f"Job {job_id} will stop after its current step"
+
+            else:
+                return f"Job {job_id} has already finished ({status})"
+
+        self.save()
+        return message
+
+    def position(self, job):
+        """How many jobs are ahead of a queued job
+
+        Parameters
+        ----------
+        job : Job
+            The job to check
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        position : int
+            The number of queued jobs submitted before this one
+        """
+
+        with self.lock:
+            return len([
+                other for other in self.jobs.values()
+                if other.record['status'] == 'queued' and other.id < job.id
+            ])
+
+    def summary(self):
+        """A list of jobs, for display
+
+        Lists unfinished jobs, and the most recently finished ones
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        lines : list
+            One HTML formatted line per job
+        """
+
+        colours = {
+            'queued': 'Yellow',
+            'running': 'Lime',
+            'done': 'White',
+            'failed': 'Red',
+            'cancelled': 'Orange',
+        }
+
+        lines = []
+        with self.lock:
+            for job in sorted(self.jobs.values(), key=lambda job: job.id):
+                record = job.record
+                steps = ', '.join(record['steps']) or 'none'
+                lines.append(
+                    f"<b>{job.id}</b>: {record['name']} - \
+                    <span style=\"color:{colours[record['status']]}\">\
+                    {record['status']}</span> (steps done: {steps})"
+                )
+
+        return lines[-JOBS['history']:]
+
+    def save(self):
+        """Write the job table to disk
+
+        Only the most recent finished jobs are kept
+        The file is replaced in one step, so a crash can't leave it half
+            written
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        Exception
+            If the file can't be written (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            active = [
+                job for job in self.jobs.values()
+                if job.record['status'] in ('queued', 'running')
+            ]
+            finished = [
+                job for job in self.jobs.values()
+                if job.record['status'] not in ('queued', 'running')
+            ]
+            finished.sort(key=lambda job: job.id)
+
+            # Forget old finished jobs
+            for job in finished[:-JOBS['history'] or None]:
+                del self.jobs[job.id]
+            finished = finished[-JOBS['history']:]
+
+            records = [
+                job.record for job in sorted(
+                    active + finished,
+                    key=lambda job: job.id
+                )
+            ]
+
+            try:
+                temp_file = JOBS['job_file'] + '.tmp'
+                with open(temp_file, 'w') as file:
+                    json.dump(records, file, indent=2)
+                os.replace(temp_file, JOBS['job_file'])
+
+            except Exception as err:
+                print(termcolor.colored(
+                    f"Could not save the job table: {err}",
+                    "red"
+                ))
+
+
+class StepGraph():
+    """A small graph of job steps, where independent steps run in parallel
+
+    Each step names the steps it runs after
+    A step starts as soon as everything it depends on has finished
+    If a step fails, the steps that depend on it are skipped
+    When run as part of a job, finished steps are checkpointed, and steps
+        completed in an earlier run are not run again
+
+    Attributes
+    ----------
+    job : Job
+        The job this graph is part of (may be None)
+    steps : dict
+        The steps, their dependencies, and their state
+
+    Methods
+    -------
+    add()
+        Add a step to the graph
+    run()
+        Run the steps, and wait for them to finish
+    report()
+        A wall-clock timing breakdown of the steps
+    """
+
+    def __init__(self, job=None):
+        """Class constructor
+
+        Parameters
+        ----------
+        job : Job
+            Optional; The job this graph is part of
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.job = job
+        self.steps = {}
+        self.start = None
+        self.end = None
+
+    def add(self, name, function, after=()):
+        """Add a step to the graph
+
+        Parameters
+        ----------
+        name : str
+            The name of the step (used for checkpoints)
+        function : function
+            Called with no arguments; Returns True if the step worked
+        after : list
+            The names of steps that must finish first
+
+        Raises
+        ------
+        ValueError
+            If a step this depends on has not been added yet
+
+        Returns
+        -------
+        None
+        """
+
+        for step in after:
+            if step not in self.steps:
+                raise ValueError(f"Unknown step '{step}'")
+
+        self.steps[name] = {
+            'function': function,
+            'after': list(after),
+            'state': 'pending',
+            'start': None,
+            'end': None,
+        }
+
+    def ready(self):
+        """Get the pending steps that can start now
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        ready : list
+            The names of the steps that can start
+        """
+
+        return [
+            name for name, step in self.steps.items()
+            if step['state'] == 'pending' and all(
+                self.steps[before]['state'] == 'done'
+                for before in step['after']
+            )
+        ]
+
+    def skip(self, failed, state='skipped'):
+        """Mark the steps that depend on a failed step
+
+        Parameters
+        ----------
+        failed : str
+            The name of the step that failed
+        state : str
+            The state to give the dependent steps
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        for name, step in self.steps.items():
+            if step['state'] == 'pending' and failed in step['after']:
+                step['state'] = state
+                self.skip(name, state)
+
+    def timed(self, name):
+        """Run a single step, and record when it started and ended
+
+        Parameters
+        ----------
+        name : str
+            The name of the step
+
+        Raises
+        ------
+        Exception
+            If the step fails unexpectedly (handled here)
+
+        Returns
+        -------
+        result : bool
+            True if the step worked
+        """
+
+        step = self.steps[name]
+        step['start'] = time.monotonic()
+        try:
+            result = bool(step['function']())
+        except Exception as err:
+            print(termcolor.colored(
+                f"Step '{name}' failed: {repr(err)}",
+                "red"
+            ))
+            result = False
+        step['end'] = time.monotonic()
+
+        return result
+
+    def run(self, workers=None):
+        """Run the steps, and wait for them to finish
+
+        New steps are not started once the job is cancelled
+            Steps already running are allowed to finish
+
+        Parameters
+        ----------
+        workers : int
+            Optional; The most steps to run at once
+            Defaults to the number of steps
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        success : bool
+            True if every step finished successfully
+        """
+
+        # Steps finished in an earlier run of the job don't run again
+        for name, step in self.steps.items():
+            if self.job is not None and self.job.completed(name):
+                step['state'] = 'done'
+                step['resumed'] = True
+
+        self.start = time.monotonic()
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers or len(self.steps) or 1) \
+                as pool:
+            while True:
+                if self.job is None or not self.job.cancelled():
+                    for name in self.ready():
+                        self.steps[name]['state'] = 'running'
+                        running[pool.submit(self.timed, name)] = name
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.result():
+                        self.steps[name]['state'] = 'done'
+                        if self.job is not None:
+                            self.job.checkpoint(name)
+                    else:
+                        self.steps[name]['state'] = 'failed'
+                        self.skip(name)
+
+        self.end = time.monotonic()
+
+        # Anything still pending was stopped by a cancel
+        for step in self.steps.values():
+            if step['state'] == 'pending':
+                step['state'] = 'cancelled'
+
+        return all(
+            step['state'] == 'done' for step in self.steps.values()
+        )
+
+    def report(self):
+        """A wall-clock timing breakdown of the steps
+
+        Shows when each step started (from the start of the graph),
+            how long it took, and the total time saved by running steps
+            in parallel
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        summary : str
+            An HTML formatted summary, one line per step
+        """
+
+        lines = []
+        busy = 0
+        for name, step in self.steps.items():
+            if step.get('resumed'):
+                lines.append(f"{name}: done in an earlier run")
+            elif step['start'] is None:
+                lines.append(f"{name}: {step['state']}")
+            else:
+                seconds = step['end'] - step['start']
+                busy += seconds
+                offset = step['start'] - self.start
+                status = '' if step['state'] == 'done' \
+                    else f" ({step['state']})"
+                lines.append(
+                    f"{name}: {seconds:.1f}s, started at +{offset:.1f}s"
+                    f"{status}"
+                )
+
+        if self.start is not None and self.end is not None:
+            lines.append(
+                f"Total: {self.end - self.start:.1f}s \
+                    ({busy:.1f}s of work)"
+            )
+
+        return '<br>'.join(lines)
+
+
+# The shared job engine
+engine = JobEngine()
+
+
+def list_jobs(chat_id, **kwargs):
+    '''
+    Chat command to list jobs
+
+        Parameters:
+            chat_id : str
+                The teams chat ID to respond to
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    engine.start()
+    lines = engine.summary()
+    if not lines:
+        teamschat.send_chat("There are no jobs right now", chat_id)
+        return
+
+    teamschat.send_chat("Here are the jobs:<br>" + "<br>".join(lines), chat_id)
+
+
+def cancel_job(chat_id, **kwargs):
+    '''
+    Chat command to cancel a job
+    The job number is taken from the message (eg, 'cancel job 4')
+
+        Parameters:
+            chat_id : str
+                The teams chat ID to respond to
+            kwargs : dict
+                Includes the original message
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    engine.start()
+    job_id = re.search(r'\b(\d+)\b', kwargs.get('message', ''))
+    if job_id is None:
+        teamschat.send_chat(
+            "Which job? Tell me the job number (eg, 'cancel job 4')",
+            chat_id
+        )
+        return
+
+    teamschat.send_chat(engine.cancel(int(job_id.group(1))), chat_id)
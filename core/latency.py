@@ -0,0 +1,403 @@
+"""
+Measures end-to-end delivery latency, from the source to Teams and SQL
+
+Each event carries four times
+    when - The time the event happened, from the webhook
+    received - When the webhook arrived
+    delivered - When the event was sent to Teams
+    committed - When the event was written to SQL
+The latency of each stage is measured from the source time, and recorded
+    in a histogram for each plugin (see core/metrics.py)
+
+A sample of each day's latencies is kept, for a daily percentile report
+    This is sent to Teams at the report time, and shows the share of
+    alerts that reached Teams within the SLO
+    Samples are kept with reservoir sampling, so memory is bounded however
+    many events arrive
+
+Modules:
+    3rd Party: termcolor, threading, random, math, datetime
+    Custom: config, core.metrics, core.teamschat, core.timestamp
+
+Classes:
+
+    LatencyTracker
+        Records event latencies, and reports percentiles
+
+Functions
+
+    percentile()
+        Get a percentile from sorted values
+    show_latency()
+        Chat command to show today's latency report
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    STAGES : tuple
+        The stages that latency is measured to
+    BUCKETS : tuple
+        The histogram buckets (seconds)
+    tracker : LatencyTracker
+        The shared tracker, used by all plugins
+
+Limitations:
+    Plugins without a source timestamp use the time the webhook arrived,
+        so their latency only covers this service
+    Latency depends on the source's clock; Negative values (a fast clock)
+        are counted as zero
+    Samples are kept in memory, so a restart starts a new day
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import termcolor
+import threading
+import random
+import math
+from datetime import datetime, timedelta
+
+from config import LATENCY, GRAPH
+from core import metrics, teamschat, timestamp
+
+
+# The stages that latency is measured to
+STAGES = ('ingest', 'teams', 'sql')
+
+# The histogram buckets (seconds); Sources can be minutes behind
+BUCKETS = (
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600,
+)
+
+# Latency from the source, for each plugin and stage
+DELIVERY_LATENCY = metrics.histogram(
+    'delivery_seconds',
+    'Time from the event at the source, to each stage',
+    ('plugin', 'stage'),
+    BUCKETS
+)
+
+
+class LatencyTracker():
+    """Records event latencies, and reports percentiles
+
+    Attributes
+    ----------
+    samples : dict
+        A sample of latencies, for each (plugin, stage)
+    seen : dict
+        The number of latencies recorded, for each (plugin, stage)
+    since : datetime
+        When the samples were started
+
+    Methods
+    -------
+    record()
+        Record the latencies of events
+    keep()
+        Add a latency to the day's sample
+    report()
+        Build the percentile report
+    reset()
+        Start a new day
+    schedule()
+        Schedule the next daily report
+    send_report()
+        Send the daily report to Teams, and start a new day
+    """
+
+    def __init__(self, settings=LATENCY):
+        """Class constructor
+
+        Parameters
+        ----------
+        settings : dict
+            The 'latency' section of the global config
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.timer = None
+        self.reset()
+
+    def record(self, events):
+        """Record the latencies of events
+
+        Each stage is only recorded once it has happened (eg, events that
+            weren't sent to Teams have no Teams latency)
+
+        Parameters
+        ----------
+        events : list
+            core.event.Event objects
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        if not self.settings['enabled']:
+            return
+
+        for event in events:
+            for stage, time in zip(
+                STAGES,
+                (event.received, event.delivered, event.committed)
+            ):
+                if time is None:
+                    continue
+
+                seconds = max((time - event.when).total_seconds(), 0)
+                DELIVERY_LATENCY.observe(seconds, event.source, stage)
+                self.keep((event.source, stage), seconds)
+
+    def keep(self, key, seconds):
+        """Add a latency to the day's sample
+
+        Once the sample is full, each new value replaces a random one
+            (reservoir sampling), so every value has the same chance of
+            being in the sample
+
+        Parameters
+        ----------
+        key : tuple
+            The plugin and stage
+        seconds : float
+            The latency
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            sample = self.samples.setdefault(key, [])
+            seen = self.seen.get(key, 0) + 1
+            self.seen[key] = seen
+
+            if len(sample) < self.settings['samples']:
+                sample.append(seconds)
+            else:
+                slot = random.randrange(seen)
+                if slot < len(sample):
+                    sample[slot] = seconds
+
+    def report(self):
+        """Build the percentile report
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        lines : list
+            A line for each plugin and stage
+        """
+
+        with self.lock:
+            samples = {key: sorted(values) for key, values in
+                       self.samples.items()}
+            seen = dict(self.seen)
+
+        slo = self.settings['slo_seconds']
+        lines = []
+        for (plugin, stage), values in sorted(
+            samples.items(),
+            key=lambda item: (item[0][0], STAGES.index(item[0][1]))
+        ):
+            if not values:
+                continue
+
+            stats = ', '.join(
+                f"p{number}: {percentile(values, number):.1f}s"
+                for number in self.settings['percentiles']
+            )
+            line = (
+                f"{plugin} to {stage}: {stats} "
+                f"({seen[(plugin, stage)]} events)"
+            )
+
+            # The SLO is for alerts reaching Teams
+            if stage == 'teams':
+                within = sum(1 for value in values if value <= slo)
+                line += f", {within / len(values):.1%} within {slo}s"
+
+            lines.append(line)
+
+        return lines
+
+    def reset(self):
+        """Start a new day
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            self.samples = {}
+            self.seen = {}
+            self.since = timestamp.now()
+
+    def schedule(self):
+        """Schedule the next daily report
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        ValueError
+            If the report time isn't valid (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        if not self.settings['enabled'] or not self.settings['report_time']:
+            return
+
+        try:
+            hour, minute = (
+                int(part) for part in
+                str(self.settings['report_time']).split(':')
+            )
+            now = datetime.now()
+            due = now.replace(hour=hour, minute=minute, second=0,
+                              microsecond=0)
+        except ValueError:
+            print(termcolor.colored(
+                f"Invalid latency report time: \
+                    {self.settings['report_time']}",
+                "red"
+            ))
+            return
+
+        if due <= now:
+            due += timedelta(days=1)
+
+        self.timer = threading.Timer(
+            (due - now).total_seconds(),
+            self.send_report
+        )
+        self.timer.daemon = True
+        self.timer.start()
+
+    def send_report(self):
+        """Send the daily report to Teams, and start a new day
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        lines = self.report()
+        since = self.since
+        self.reset()
+
+        if lines:
+            teamschat.send_chat(
+                f"<b>Delivery latency since \
+                    {since:%d/%m %H:%M}</b><br>" + "<br>".join(lines),
+                self.settings['chat_id'] or GRAPH['chat_id']
+            )
+
+        self.schedule()
+
+
+def percentile(values, number):
+    '''
+    Gets a percentile from sorted values (nearest rank)
+
+        Parameters:
+            values : list
+                The values, sorted
+            number : float
+                The percentile (eg, 99)
+
+        Raises:
+            None
+
+        Returns:
+            value : float
+                The value at that percentile
+    '''
+
+    rank = math.ceil(number / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+# The shared tracker
+tracker = LatencyTracker()
+tracker.schedule()
+
+
+def show_latency(chat_id, **kwargs):
+    '''
+    Chat command to show today's latency report
+
+        Parameters:
+            chat_id : str
+                The teams chat ID to respond to
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    lines = tracker.report()
+    if not lines:
+        teamschat.send_chat("There are no latencies yet today", chat_id)
+        return
+
+    teamschat.send_chat(
+        f"Delivery latency since {tracker.since:%d/%m %H:%M}:<br>" +
+        "<br>".join(lines),
+        chat_id
+    )
@@ -0,0 +1,609 @@
+"""
+Maintenance windows, so planned work doesn't flood the chat
+
+When the bot reboots a device, or restarts a process, Mist and Junos send
+    up/down events and alarms for that device
+A maintenance window is added automatically for these actions, and events
+    for the device during the window are suppressed or downgraded
+Windows can also be listed, added, and ended with chat commands
+
+Windows are kept in an interval index
+    Each device has a sorted list of (merged) windows, so checking an event
+    is a dictionary lookup, then a binary search
+The windows are saved to disk, so they survive a restart
+
+Modules:
+    3rd Party: termcolor, threading, json, os, re, time, bisect, datetime
+    Custom: config, core.teamschat, core.timestamp, core.correlate
+
+Classes:
+
+    WindowStore
+        Keeps maintenance windows, and checks events against them
+
+Functions
+
+    add_window()
+        Add a window for a device, starting now
+    parse_minutes()
+        Get a duration in minutes from text
+    list_windows()
+        Chat command to list maintenance windows
+    add_maintenance()
+        Chat command to add a maintenance window
+    end_maintenance()
+        Chat command to end maintenance windows
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    store : WindowStore
+        The shared window store
+
+Limitations:
+    Windows are matched on device names, the same way as correlation
+        (case and domain names don't matter, see core/correlate.py)
+    Events are checked using their own time, so a device with the wrong
+        clock may not match its window
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import termcolor
+import threading
+import json
+import os
+import re
+import time
+import bisect
+from datetime import datetime
+
+from config import MAINTENANCE
+from core import teamschat, timestamp
+from core.correlate import host_name
+
+
+class WindowStore():
+    """Keeps maintenance windows, and checks events against them
+
+    Attributes
+    ----------
+    windows : dict
+        Windows by ID; Each has a device, start, end, and reason
+    index : dict
+        For each device, sorted lists of merged window starts and ends
+    next_id : int
+        The ID for the next window
+
+    Methods
+    -------
+    load()
+        Load the windows from disk
+    save()
+        Write the windows to disk
+    rebuild()
+        Rebuild the interval index
+    add()
+        Add a window
+    end()
+        End windows early
+    active()
+        Check if a device is in a window
+    apply()
+        Suppress or downgrade events in a window
+    summary()
+        A list of windows, for display
+    """
+
+    def __init__(self):
+        """Class constructor
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.index = {}
+        self.next_id = 1
+
+    def load(self):
+        """Load the windows from disk
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        Exception
+            If the file can't be read (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        try:
+            with open(MAINTENANCE['window_file']) as file:
+                records = json.load(file)
+        except FileNotFoundError:
+            records = []
+        except Exception as err:
+            print(termcolor.colored(
+                f"Could not load maintenance windows: {err}",
+                "red"
+            ))
+            records = []
+
+        with self.lock:
+            for record in records:
+                self.windows[record['id']] = record
+                self.next_id = max(self.next_id, record['id'] + 1)
+
+        self.rebuild()
+
+    def save(self):
+        """Write the windows to disk
+
+        Windows that have ended are left out
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        Exception
+            If the file can't be written (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            now = time.time()
+            for number in [
+                number for number, window in self.windows.items()
+                if window['end'] <= now
+            ]:
+                del self.windows[number]
+
+            records = sorted(self.windows.values(), key=lambda w: w['id'])
+
+            try:
+                temp_file = MAINTENANCE['window_file'] + '.tmp'
+                with open(temp_file, 'w') as file:
+                    json.dump(records, file, indent=2)
+                os.replace(temp_file, MAINTENANCE['window_file'])
+
+            except Exception as err:
+                print(termcolor.colored(
+                    f"Could not save maintenance windows: {err}",
+                    "red"
+                ))
+
+    def rebuild(self):
+        """Rebuild the interval index
+
+        Overlapping windows for a device are merged, so each device has a
+            sorted list of separate intervals
+        The new index replaces the old one in a single step, so events can
+            be checked (without the lock) while it's being built
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        by_device = {}
+        with self.lock:
+            for window in self.windows.values():
+                by_device.setdefault(host_name(window['device']), []).append(
+                    (window['start'], window['end'])
+                )
+
+            index = {}
+            for device, intervals in by_device.items():
+                starts = []
+                ends = []
+                for start, end in sorted(intervals):
+                    if ends and start <= ends[-1]:
+                        ends[-1] = max(ends[-1], end)
+                    else:
+                        starts.append(start)
+                        ends.append(end)
+                index[device] = (starts, ends)
+
+            self.index = index
+
+    def add(self, device, start, end, reason, source='chat'):
+        """Add a window
+
+        Parameters
+        ----------
+        device : str
+            The device name
+        start : float
+            When the window starts (epoch seconds)
+        end : float
+            When the window ends (epoch seconds)
+        reason : str
+            Why the window was added
+        source : str
+            What added the window (eg, 'reboot', or 'chat')
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        window : dict
+            The new window
+        """
+
+        with self.lock:
+            window = {
+                'id': self.next_id,
+                'device': device,
+                'start': start,
+                'end': end,
+                'reason': reason,
+                'source': source,
+            }
+            self.windows[self.next_id] = window
+            self.next_id += 1
+
+        self.rebuild()
+        self.save()
+        return window
+
+    def end(self, number=None, device=None):
+        """End windows early
+
+        Parameters
+        ----------
+        number : int
+            Optional; The ID of a window to end
+        device : str
+            Optional; End all windows for this device
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        ended : list
+            The windows that were ended
+        """
+
+        with self.lock:
+            ended = [
+                window for window in self.windows.values()
+                if window['id'] == number or (
+                    device is not None and
+                    host_name(window['device']) == host_name(device)
+                )
+            ]
+            for window in ended:
+                del self.windows[window['id']]
+
+        if ended:
+            self.rebuild()
+            self.save()
+
+        return ended
+
+    def active(self, device, when):
+        """Check if a device is in a window
+
+        Parameters
+        ----------
+        device : str
+            The device name
+        when : float
+            The time to check (epoch seconds)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        active : bool
+            True if the device is in a window at this time
+        """
+
+        intervals = self.index.get(host_name(device))
+        if intervals is None:
+            return False
+
+        starts, ends = intervals
+        position = bisect.bisect_right(starts, when) - 1
+        return position >= 0 and when < ends[position]
+
+    def apply(self, events):
+        """Suppress or downgrade events in a window
+
+        With the 'suppress' action, events are dropped completely
+        With the 'downgrade' action, events are given the configured level,
+            and aren't sent to teams (they're still written to SQL)
+
+        Parameters
+        ----------
+        events : list
+            core.event.Event objects
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        events : list
+            The events that weren't suppressed
+        """
+
+        if not self.index:
+            return events
+
+        kept = []
+        for event in events:
+            if not event.device or not self.active(
+                event.device,
+                event.when.timestamp()
+            ):
+                kept.append(event)
+                continue
+
+            if MAINTENANCE['action'] == 'downgrade':
+                event.level = MAINTENANCE['level']
+                event.message = ''
+                kept.append(event)
+
+        return kept
+
+    def summary(self):
+        """A list of windows, for display
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        lines : list
+            A line for each window that hasn't ended
+        """
+
+        now = time.time()
+        with self.lock:
+            windows = sorted(
+                (w for w in self.windows.values() if w['end'] > now),
+                key=lambda w: w['start']
+            )
+
+        lines = []
+        for window in windows:
+            start = datetime.fromtimestamp(
+                window['start'],
+                timestamp.local_zone()
+            )
+            end = datetime.fromtimestamp(window['end'], timestamp.local_zone())
+            lines.append(
+                f"{window['id']}: {window['device']}, \
+                    {start:%d/%m %H:%M} to {end:%H:%M} ({window['reason']})"
+            )
+
+        return lines
+
+
+# The shared window store
+store = WindowStore()
+store.load()
+
+
+def add_window(device, minutes, reason, source, delay=0):
+    '''
+    Adds a maintenance window for a device, starting now (or after a delay)
+    Used by actions (eg, reboots) to cover the disruption they cause
+
+        Parameters:
+            device : str
+                The device name
+            minutes : int
+                How long the window lasts
+            reason : str
+                Why the window was added
+            source : str
+                What added the window (eg, 'reboot')
+            delay : float
+                Optional; Seconds from now until the window starts
+
+        Raises:
+            None
+
+        Returns:
+            window : dict
+                The new window
+    '''
+
+    start = time.time() + delay
+    return store.add(device, start, start + minutes * 60, reason, source)
+
+
+def parse_minutes(text):
+    '''
+    Gets a duration in minutes from text (eg, '2 hours')
+
+        Parameters:
+            text : str
+                The text, which may contain a duration
+
+        Raises:
+            None
+
+        Returns:
+            minutes : int
+                The duration in minutes, or None if there isn't one
+    '''
+
+    found = re.search(
+        r'(\d+)\s*(minute|min|hour|hr|day)',
+        text or '',
+        re.IGNORECASE
+    )
+    if found is None:
+        return None
+
+    value = int(found.group(1))
+    match found.group(2).lower():
+        case 'hour' | 'hr':
+            return value * 60
+        case 'day':
+            return value * 1440
+        case _:
+            return value
+
+
+def list_windows(chat_id, **kwargs):
+    '''
+    Chat command to list maintenance windows
+
+        Parameters:
+            chat_id : str
+                The teams chat ID to respond to
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    lines = store.summary()
+    if not lines:
+        teamschat.send_chat("There are no maintenance windows", chat_id)
+        return
+
+    teamschat.send_chat(
+        "Here are the maintenance windows:<br>" + "<br>".join(lines),
+        chat_id
+    )
+
+
+def add_maintenance(chat_id, **kwargs):
+    '''
+    Chat command to add a maintenance window
+    Takes devices and a duration from the message
+        (eg, 'add maintenance for switch1 for 2 hours')
+
+        Parameters:
+            chat_id : str
+                The teams chat ID to respond to
+            kwargs : dict
+                Includes the entities and the original message
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    devices = [
+        ent['ent'] for ent in kwargs.get('ents', [])
+        if ent['label'] == 'DEVICE'
+    ]
+    if not devices:
+        teamschat.send_chat(
+            "Which device? Tell me the device name \
+                (eg, 'add maintenance for switch1 for 2 hours')",
+            chat_id
+        )
+        return
+
+    minutes = parse_minutes(kwargs.get('message', ''))
+    if minutes is None:
+        minutes = MAINTENANCE['default_minutes']
+
+    for device in devices:
+        add_window(device, minutes, 'Added in chat', 'chat')
+
+    teamschat.send_chat(
+        f"Maintenance started for {', '.join(devices)}, \
+            for {minutes} minutes",
+        chat_id
+    )
+
+
+def end_maintenance(chat_id, **kwargs):
+    '''
+    Chat command to end maintenance windows
+    Takes a window number or devices from the message
+        (eg, 'end maintenance 4', or 'end maintenance for switch1')
+
+        Parameters:
+            chat_id : str
+                The teams chat ID to respond to
+            kwargs : dict
+                Includes the entities and the original message
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    ended = []
+    for ent in kwargs.get('ents', []):
+        if ent['label'] == 'DEVICE':
+            ended += store.end(device=ent['ent'])
+
+    number = re.search(r'\b(\d+)\b', kwargs.get('message', ''))
+    if not ended and number is not None:
+        ended = store.end(number=int(number.group(1)))
+
+    if not ended:
+        teamschat.send_chat(
+            "I couldn't find that maintenance window \
+                (eg, 'end maintenance 4', or 'end maintenance for switch1')",
+            chat_id
+        )
+        return
+
+    teamschat.send_chat(
+        f"Ended maintenance for \
+            {', '.join(window['device'] for window in ended)}",
+        chat_id
+    )
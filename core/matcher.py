@@ -0,0 +1,267 @@
+"""
+Multi-pattern substring matching (Aho-Corasick)
+
+Finds every pattern in a piece of text in a single pass
+    The time taken depends on the length of the text,
+    not on how many patterns there are
+Works with either strings or bytes (but not both in one matcher)
+
+Modules:
+    3rd Party: collections
+    Custom: None
+
+Classes:
+
+    Matcher
+        A compiled set of patterns
+
+Functions
+
+    None
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    None
+
+Limitations:
+    Patterns are matched exactly (case sensitive, no wildcards)
+    Empty patterns are ignored
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+from collections import deque
+
+
+class Matcher():
+    """A compiled set of patterns
+
+    Patterns are added with a value, which is returned when they match
+    The matcher is compiled on first use, or by calling compile()
+
+    Attributes
+    ----------
+    patterns : list
+        The patterns and their values, in the order they were added
+    goto : list
+        The transitions out of each state
+    fail : list
+        The state to fall back to when there is no transition
+    output : list
+        The pattern numbers that end at each state
+
+    Methods
+    -------
+    add()
+        Add a pattern
+    compile()
+        Build the automaton
+    finditer()
+        Find each match in some text
+    values()
+        Get the values of the patterns found in some text
+    search()
+        Check if any pattern is in some text
+    """
+
+    def __init__(self, patterns=None):
+        """Class constructor
+
+        Parameters
+        ----------
+        patterns : dict or list
+            Optional; Patterns to add
+            A dict maps patterns to values; A list uses the pattern as the
+                value
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.patterns = []
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        self.compiled = False
+
+        if isinstance(patterns, dict):
+            for pattern, value in patterns.items():
+                self.add(pattern, value)
+        elif patterns:
+            for pattern in patterns:
+                self.add(pattern)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def add(self, pattern, value=None):
+        """Add a pattern
+
+        Parameters
+        ----------
+        pattern : str or bytes
+            The text to look for
+        value : any
+            Optional; Returned when the pattern matches
+            Defaults to the pattern
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        if not pattern:
+            return
+
+        number = len(self.patterns)
+        self.patterns.append((pattern, pattern if value is None else value))
+
+        # Add the pattern to the trie
+        state = 0
+        for symbol in pattern:
+            if symbol not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][symbol] = len(self.goto) - 1
+            state = self.goto[state][symbol]
+
+        self.output[state].append(number)
+        self.compiled = False
+
+    def compile(self):
+        """Build the failure links
+
+        Breadth first, so each state's failure link is set before its
+            children need it
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        queue = deque()
+        for state in self.goto[0].values():
+            self.fail[state] = 0
+            queue.append(state)
+
+        while queue:
+            state = queue.popleft()
+            for symbol, child in self.goto[state].items():
+                queue.append(child)
+
+                # Follow failure links until a state can take this symbol
+                fallback = self.fail[state]
+                while fallback and symbol not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(symbol, 0)
+
+                # A state also matches everything its failure state matches
+                self.output[child] = \
+                    self.output[child] + self.output[self.fail[child]]
+
+        self.compiled = True
+
+    def finditer(self, text):
+        """Find each match in some text
+
+        Parameters
+        ----------
+        text : str or bytes
+            The text to search (the same type as the patterns)
+
+        Raises
+        ------
+        None
+
+        Yields
+        ------
+        match : tuple
+            The position the match ends at, and the pattern number
+        """
+
+        if not self.compiled:
+            self.compile()
+
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+
+        state = 0
+        for position, symbol in enumerate(text):
+            while state and symbol not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(symbol, 0)
+
+            for number in output[state]:
+                yield position, number
+
+    def values(self, text):
+        """Get the values of the patterns found in some text
+
+        Parameters
+        ----------
+        text : str or bytes
+            The text to search
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        values : list
+            The value of each pattern found, in the order the patterns
+                were added (each pattern is only listed once)
+        """
+
+        found = {number for _, number in self.finditer(text)}
+        return [self.patterns[number][1] for number in sorted(found)]
+
+    def search(self, text):
+        """Check if any pattern is in some text
+
+        Stops at the first match
+
+        Parameters
+        ----------
+        text : str or bytes
+            The text to search
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        value : any
+            The value of the first pattern found, or None
+        """
+
+        for _, number in self.finditer(text):
+            return self.patterns[number][1]
+
+        return None
@@ -0,0 +1,733 @@
+"""
+Counters and latency histograms, exposed for Prometheus at /metrics
+
+Each stage of the service (webhooks, Teams, SQL, NLP) records what it does
+    here, so it can be graphed and alerted on
+
+Recording is cheap, so it can be done on every webhook
+    Each thread has its own copy of each metric, so no locks are needed;
+    The copies are added together when the metrics are read
+    When a thread finishes, its copy is folded into a shared total, so
+    short-lived threads (eg, one per request) don't add up over time
+    Histogram buckets are fixed when the histogram is created, so
+    recording a value is a binary search and an increment
+Gauges (eg, queue depths) are read from callbacks when the metrics are
+    collected, so they cost nothing until then
+
+Modules:
+    3rd Party: threading, time, bisect, weakref, contextlib
+    Custom: None
+
+Classes:
+
+    Metric
+        The base class for metrics, which keeps per-thread values
+    Counter
+        A count that only goes up
+    Histogram
+        A distribution of values (eg, latencies) in fixed buckets
+    Gauge
+        A value that's read when the metrics are collected
+        (or a total that's counted elsewhere)
+
+Functions
+
+    counter()
+        Create (or get) a counter
+    histogram()
+        Create (or get) a histogram
+    gauge()
+        Create (or get) a gauge
+    render()
+        Get all metrics, in the Prometheus text format
+    escape()
+        Escape a label value
+    register()
+        Create a metric, or get it if it already exists
+    fold()
+        Add one set of values into another
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    LATENCY_BUCKETS : tuple
+        The default histogram buckets, in seconds
+    PREFIX : str
+        The prefix for all metric names
+
+Limitations:
+    Labels are passed by position, in the order they were declared
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import threading
+import time
+import bisect
+import weakref
+from contextlib import contextmanager
+
+
+# The default histogram buckets (seconds), from 1ms to 30s
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10, 30,
+)
+
+# The prefix for all metric names
+PREFIX = 'network_assistant_'
+
+# All metrics, by name
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class _Owner():
+    # Kept in a thread's local data, so its end can be detected
+    __slots__ = ('__weakref__',)
+
+
+class Metric():
+    """The base class for metrics, which keeps per-thread values
+
+    Attributes
+    ----------
+    name : str
+        The metric name (with the prefix)
+    help : str
+        A description of the metric
+    labels : tuple
+        The label names
+    shards : dict
+        The values from each running thread
+    retired : dict
+        The values from threads that have finished, added together
+
+    Methods
+    -------
+    shard()
+        Get this thread's values
+    retire()
+        Fold a finished thread's values into the shared total
+    merged()
+        Get the values from all threads, added together
+    label_text()
+        Format label values for the text format
+    header()
+        The HELP and TYPE lines for the metric
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        """Class constructor
+
+        Parameters
+        ----------
+        name : str
+            The metric name (without the prefix)
+        help : str
+            A description of the metric
+        labels : tuple
+            Optional; The label names
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self.shards = {}
+        self.retired = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def shard(self):
+        """Get this thread's values
+
+        The first time a thread records a value, it gets its own dictionary
+            (only this takes the lock)
+        When the thread finishes, its local data is freed, and the
+            dictionary is folded into the shared total
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        values : dict
+            This thread's values, keyed by label values
+        """
+
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+            owner = self.local.owner = _Owner()
+            with self.lock:
+                self.shards[id(owner)] = values
+            weakref.finalize(owner, self.retire, id(owner))
+            return values
+
+    def retire(self, key):
+        """Fold a finished thread's values into the shared total
+
+        Parameters
+        ----------
+        key : int
+            The thread's shard
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            values = self.shards.pop(key, None)
+            if values:
+                fold(self.retired, values)
+
+    def merged(self):
+        """Get the values from all threads, added together
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        values : dict
+            The values, keyed by label values
+        """
+
+        merged = {}
+        with self.lock:
+            fold(merged, self.retired)
+            shards = list(self.shards.values())
+
+        for shard in shards:
+            fold(merged, dict(shard))
+
+        return merged
+
+    def label_text(self, values, extra=''):
+        """Format label values for the text format
+
+        Parameters
+        ----------
+        values : tuple
+            The label values
+        extra : str
+            Optional; Another label (eg, a histogram bucket)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        text : str
+            The labels, in braces (or an empty string if there are none)
+        """
+
+        pairs = [
+            f'{name}="{escape(value)}"'
+            for name, value in zip(self.labels, values)
+        ]
+        if extra:
+            pairs.append(extra)
+
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def header(self):
+        """The HELP and TYPE lines for the metric
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        lines : list
+            The lines, in the text format
+        """
+
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class Counter(Metric):
+    """A count that only goes up
+
+    Methods
+    -------
+    inc()
+        Add to the count
+    lines()
+        Get the metric in the text format
+    """
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        """Add to the count
+
+        Parameters
+        ----------
+        labels : str
+            The label values, in the order they were declared
+        amount : int
+            Optional; How much to add
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        values = self.shard()
+        values[labels] = values.get(labels, 0) + amount
+
+    def lines(self):
+        """Get the metric in the text format
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        lines : list
+            The lines, in the text format
+        """
+
+        return self.header() + [
+            f"{self.name}{self.label_text(key)} {value}"
+            for key, value in sorted(self.merged().items())
+        ]
+
+
+class Histogram(Metric):
+    """A distribution of values (eg, latencies) in fixed buckets
+
+    Attributes
+    ----------
+    buckets : tuple
+        The upper bound of each bucket
+
+    Methods
+    -------
+    observe()
+        Record a value
+    time()
+        Time a block of code
+    lines()
+        Get the metric in the text format
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        """Class constructor
+
+        Parameters
+        ----------
+        name : str
+            The metric name (without the prefix)
+        help : str
+            A description of the metric
+        labels : tuple
+            Optional; The label names
+        buckets : tuple
+            Optional; The upper bound of each bucket
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        """Record a value
+
+        Parameters
+        ----------
+        value : float
+            The value (eg, seconds)
+        labels : str
+            The label values, in the order they were declared
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        values = self.shard()
+        counts = values.get(labels)
+        if counts is None:
+            # A count for each bucket, then +Inf, then the sum
+            counts = values[labels] = [0] * (len(self.buckets) + 2)
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Time a block of code
+
+        Parameters
+        ----------
+        labels : str
+            The label values, in the order they were declared
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def lines(self):
+        """Get the metric in the text format
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        lines : list
+            The lines, in the text format
+        """
+
+        lines = self.header()
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+
+        for key, counts in sorted(self.merged().items()):
+            # Buckets are cumulative in the text format
+            total = 0
+            for bound, count in zip(bounds, counts):
+                total += count
+                labels = self.label_text(key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {total}")
+
+            labels = self.label_text(key)
+            lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+            lines.append(f"{self.name}_count{labels} {total}")
+
+        return lines
+
+
+class Gauge(Metric):
+    """A value that's read when the metrics are collected
+
+    Attributes
+    ----------
+    function : callable
+        Returns the value, or a dictionary of label values and values
+
+    Methods
+    -------
+    lines()
+        Get the metric in the text format
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, function, labels=(), kind='gauge'):
+        """Class constructor
+
+        Parameters
+        ----------
+        name : str
+            The metric name (without the prefix)
+        help : str
+            A description of the metric
+        function : callable
+            Returns the value, or a dictionary of label values and values
+        labels : tuple
+            Optional; The label names
+        kind : str
+            Optional; 'counter' if the value is a total kept elsewhere
+                (eg, core.suppress stats)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        super().__init__(name, help, labels)
+        self.function = function
+        self.kind = kind
+
+    def lines(self):
+        """Get the metric in the text format
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        lines : list
+            The lines, in the text format
+        """
+
+        # A broken callback shouldn't stop the other metrics
+        try:
+            value = self.function()
+        except Exception:
+            return []
+
+        if not isinstance(value, dict):
+            value = {(): value}
+
+        lines = self.header()
+        for key, number in sorted(value.items()):
+            if not isinstance(key, tuple):
+                key = (key,)
+            lines.append(f"{self.name}{self.label_text(key)} {number}")
+
+        return lines
+
+
+def escape(value):
+    '''
+    Escapes a label value for the text format
+
+        Parameters:
+            value : any
+                The label value
+
+        Raises:
+            None
+
+        Returns:
+            text : str
+                The escaped value
+    '''
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def fold(total, values):
+    '''
+    Adds one set of metric values into another
+
+        Parameters:
+            total : dict
+                The values to add to (changed in place)
+            values : dict
+                The values to add, keyed by label values
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    for key, value in values.items():
+        # Histograms keep a list of bucket counts
+        if isinstance(value, list):
+            counts = total.setdefault(key, [0] * len(value))
+            for position, count in enumerate(value):
+                counts[position] += count
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+def register(cls, name, *args, **kwargs):
+    '''
+    Creates a metric, or gets it if it already exists
+    Modules can be imported more than once (eg, plugins), so creating a
+        metric with the same name returns the existing one
+
+        Parameters:
+            cls : type
+                The metric class
+            name : str
+                The metric name (without the prefix)
+            args, kwargs
+                Passed to the class
+
+        Raises:
+            None
+
+        Returns:
+            metric : Metric
+                The metric
+    '''
+
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = cls(name, *args, **kwargs)
+        return _registry[name]
+
+
+def counter(name, help, labels=()):
+    '''
+    Creates (or gets) a counter
+
+        Parameters:
+            name : str
+                The metric name (without the prefix)
+            help : str
+                A description of the metric
+            labels : tuple
+                Optional; The label names
+
+        Raises:
+            None
+
+        Returns:
+            counter : Counter
+                The counter
+    '''
+
+    return register(Counter, name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    '''
+    Creates (or gets) a histogram
+
+        Parameters:
+            name : str
+                The metric name (without the prefix)
+            help : str
+                A description of the metric
+            labels : tuple
+                Optional; The label names
+            buckets : tuple
+                Optional; The upper bound of each bucket
+
+        Raises:
+            None
+
+        Returns:
+            histogram : Histogram
+                The histogram
+    '''
+
+    return register(Histogram, name, help, labels, buckets)
+
+
+def gauge(name, help, function, labels=(), kind='gauge'):
+    '''
+    Creates (or gets) a gauge
+
+        Parameters:
+            name : str
+                The metric name (without the prefix)
+            help : str
+                A description of the metric
+            function : callable
+                Returns the value, or a dictionary of label values and values
+            labels : tuple
+                Optional; The label names
+            kind : str
+                Optional; 'counter' if the value is a total kept elsewhere
+
+        Raises:
+            None
+
+        Returns:
+            gauge : Gauge
+                The gauge
+    '''
+
+    return register(Gauge, name, help, function, labels, kind)
+
+
+def render():
+    '''
+    Gets all metrics, in the Prometheus text format
+
+        Parameters:
+            None
+
+        Raises:
+            None
+
+        Returns:
+            text : str
+                The metrics
+    '''
+
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda metric: metric.name)
+
+    lines = []
+    for metric in metrics:
+        lines += metric.lines()
+
+    return '\n'.join(lines) + '\n'
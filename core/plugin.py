@@ -24,10 +24,15 @@ Author:
 """
 
 import yaml
-import socket
-import struct
 import termcolor
-from core import sql, hash
+import threading
+from core import sql, hash, teamschat, decode, suppress, correlate
+from core import routing, smtp, maintenance, latency, timestamp
+from core import event as event_model
+
+
+# The most events listed in one grouped teams message
+MAX_GROUPED = 20
 
 
 class PluginTemplate():
@@ -39,6 +44,11 @@ class PluginTemplate():
         self.location = location
         self.phrase_list = False
         self.entities = False
+        self.table = ''
+        self.sql_columns = event_model.DEFAULT_COLUMNS
+        self.schema = None
+        self.stream_key = None
+        self.decoder = None
 
         # Read the YAML file
         with open(location) as config:
@@ -62,15 +72,46 @@ class PluginTemplate():
         except Exception as e:
             print(f"{e} not used in this plugin")
 
+        # Build anything that's derived from the config
+        self.compile_config()
+
+    # Build lookup tables (eg, priority rules) from the config
+    def compile_config(self):
+        """
+        Called when the config is loaded or refreshed
+        Plugins override this to precompute anything they need from
+            their config, so it isn't worked out for every event
+        """
+        pass
+
+    # Check the raw webhook body, before it's decoded
+    def prefilter(self, body):
+        """
+        Takes the raw request body (bytes)
+        Return True to drop the webhook without decoding it
+        Plugins override this to filter out noise cheaply
+        """
+        return False
+
+    # Decode the webhook body
+    def decode(self, body):
+        """
+        Takes the raw request body (bytes), and decodes the JSON
+        Plugins can set self.schema to decode only the fields they use,
+            and self.stream_key to decode a large list incrementally
+            (see core/decode.py)
+        """
+        if self.decoder is None:
+            self.decoder = decode.Decoder(self.schema, self.stream_key)
+
+        return self.decoder.decode(body)
+
     # Convert an IPv4 address to an integer
     def ip2integer(self, ip):
         """
         Convert an IP string to long integer
         """
-        ip = ip.split(",")[0]
-        # print(termcolor.colored(f"DEBUG: IP Address: {ip}", "red"))
-        packedIP = socket.inet_aton(ip)
-        return struct.unpack("!L", packedIP)[0]
+        return event_model.ip_integer(ip)
 
     # Refresh the plugin's config file
     def refresh(self):
@@ -91,6 +132,8 @@ class PluginTemplate():
                 print(err)
                 return False
 
+        self.compile_config()
+
     # Write to an SQL database
     def sql_write(self, database, fields):
         """
@@ -99,6 +142,142 @@ class PluginTemplate():
         sql_conn = sql.Sql()
         sql_conn.add(database, fields)
 
+    # Write several rows to an SQL database, in one transaction
+    def sql_write_many(self, database, rows):
+        """
+        Write a list of rows (raw values, not quoted) to the SQL server
+        Returns True if the rows were committed
+        """
+        sql_conn = sql.Sql()
+        return sql_conn.add_many(database, rows)
+
+    # Send a batch of events to teams, and write them to SQL
+    def log_events(self, events, title='events'):
+        """
+        Takes a list of events (core.event.Event)
+        Events for devices in a maintenance window are suppressed or
+            downgraded first (see core/maintenance.py)
+        Repeats of recent events are suppressed (see core/suppress.py)
+        Events related to an open incident are added to its message,
+            rather than sent separately (see core/correlate.py)
+        Routing rules pick the chats and email addresses for each event
+            (see core/routing.py)
+        Events with a message are sent to teams as one message
+        Every event is written to SQL (self.table) in one transaction,
+            using the columns in self.sql_columns
+        Delivery and commit times are recorded on each event, for
+            latency reporting (see core/latency.py)
+        """
+        # Devices in maintenance (eg, being rebooted by the bot)
+        events = maintenance.store.apply(events)
+
+        # Suppress duplicates and flapping events, across all plugins
+        #   Repeats are summarised in the first event's teams message
+        events, repeats = suppress.engine.check(events)
+
+        # Events for a device with an open incident join that incident
+        #   They're added to the incident's teams message, not sent again
+        correlate.engine.check(events)
+        if suppress.engine.settings['log_suppressed']:
+            events = events + repeats
+
+        # Pick the chats (and email addresses) for each event
+        #   Without routing rules, everything goes to the plugin's chat
+        chats = {}
+        email = {}
+        for event in events:
+            if not event.message:
+                continue
+            to_chats, to_email = routing.engine.route(
+                event,
+                self.config['config']['chat_id']
+            )
+            for chat in to_chats:
+                chats.setdefault(chat, []).append(event)
+            for address in to_email:
+                email.setdefault(address, []).append(event)
+
+        # Send one message to each chat
+        #   Events get the ID of the first message they were in
+        for chat, sent in chats.items():
+            grouped = self.group_messages(sent, title)
+            try:
+                chat_id = teamschat.send_chat(grouped, chat)['id']
+            except Exception as err:
+                print(termcolor.colored("Error with Teams chat ID", "red"))
+                print(termcolor.colored(err, "red"))
+                chat_id = ''
+
+            delivered = timestamp.now()
+            for event in sent:
+                if not event.chat_id:
+                    event.chat_id = chat_id
+                if chat_id and event.delivered is None:
+                    event.delivered = delivered
+
+            # Later repeats and related events are added to this message
+            post = suppress.Post(grouped, chat, chat_id)
+            suppress.engine.posted(sent, post)
+            correlate.engine.posted(sent, post)
+
+        # Email runs in the background, so it doesn't hold up the webhook
+        for address, sent in email.items():
+            threading.Thread(
+                target=self.send_email,
+                args=(address, self.group_messages(sent, title), title),
+                daemon=True
+            ).start()
+
+        # Write to SQL, if this plugin has a table
+        if self.table and events:
+            if self.sql_write_many(
+                database=self.table,
+                rows=[event.sql_row(self.sql_columns) for event in events]
+            ):
+                committed = timestamp.now()
+                for event in events:
+                    event.committed = committed
+
+        # End-to-end latency, from the source to Teams and SQL
+        latency.tracker.record(events)
+
+    # Group the messages from several events into one message
+    def group_messages(self, events, title='events'):
+        """
+        Takes a list of events with messages
+        Returns one message, listing up to MAX_GROUPED of them
+        """
+        messages = [event.message for event in events]
+        if len(messages) == 1:
+            return messages[0]
+
+        grouped = f"<b>{len(messages)} {title}</b><br><br>"
+        grouped += '<br><br>'.join(messages[:MAX_GROUPED])
+        if len(messages) > MAX_GROUPED:
+            grouped += f"<br><br>...and {len(messages) - MAX_GROUPED} \
+                more (see SQL)"
+
+        return grouped
+
+    # Email a message, for a routing rule
+    def send_email(self, address, message, title):
+        """
+        Takes an email address, an HTML message, and a title
+        Errors are printed, as there's nobody waiting for a response
+        """
+        try:
+            smtp.send_mail(
+                message,
+                receivers=[address],
+                subject=f"Network Assistant - {title}",
+                html=True
+            )
+        except Exception as err:
+            print(termcolor.colored(
+                f"Could not email {address}: {err}",
+                "red"
+            ))
+
     # Check webhook authentication
     def authenticate(self, request, plugin):
         # Check if there is an authentication header
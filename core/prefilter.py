@@ -0,0 +1,358 @@
+"""
+Filters unwanted webhooks using the raw request body
+
+Filters are compiled once, when the config is loaded
+The raw bytes of a webhook are checked before they are decoded
+    Each filter is a substring search over the bytes (at C speed), so
+    webhooks that match nothing are passed on without being parsed
+If a webhook has to be decoded to check its events, the payload is kept,
+    so the plugin doesn't decode it again (see decoded())
+
+Filter formats (a list in the plugin config):
+    - "some text"
+        Drops an event if the text is anywhere in the event
+    - text: "some text"
+      field: "field_name"
+        Drops an event if the text is in that field of the event
+The webhook is only dropped if every event in it matches a filter
+    Otherwise, the plugin drops the matching events with event_match()
+
+Modules:
+    3rd Party: json, threading
+    Custom: core.matcher, core.decode
+
+Classes:
+
+    PayloadFilter
+        A compiled list of filters, with hit counters
+
+Functions
+
+    None
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    None
+
+Limitations:
+    Matching is case sensitive
+    Field filters look at the top level of each event
+    Filters without a field are matched against each event as JSON, so
+        the plugin must decode whole events when there are any
+    Events are read from an 'events' list if there is one, otherwise the
+        whole webhook is treated as one event
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import json
+import threading
+
+from core.matcher import Matcher
+from core import decode
+
+
+class PayloadFilter():
+    """A compiled list of filters, with hit counters
+
+    Text may be escaped when it's encoded as JSON (eg, quotes, or non-ASCII
+        characters), so each filter is searched for in each form it could
+        take in the raw bytes
+
+    Attributes
+    ----------
+    filters : list
+        Each filter's text and field (None if it applies anywhere)
+    raw : dict
+        Each form a filter could take in the raw bytes, and the filters
+            it belongs to
+    fields : dict
+        A matcher for each field that has filters
+    anywhere : dict
+        Each form of the filters without a field, as text, and the filters
+            it belongs to (searched for in each decoded event)
+    hits : list
+        The number of times each filter has matched
+    local : threading.local
+        The payload check() decoded, for each thread
+
+    Methods
+    -------
+    check()
+        Check if a webhook should be dropped, before it's decoded
+    decoded()
+        Get the payload check() decoded, so it isn't decoded again
+    event_match()
+        Check if a decoded event should be dropped
+    stats()
+        Get the hit counters
+    """
+
+    def __init__(self, entries):
+        """Class constructor; Compiles the filters
+
+        Parameters
+        ----------
+        entries : list
+            The filters, from the plugin config (see the module docstring)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.filters = []
+        self.raw = {}
+        self.fields = {}
+        self.anywhere = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        for entry in entries or []:
+            if isinstance(entry, dict):
+                text = str(entry['text'])
+                field = entry.get('field')
+            else:
+                text = str(entry)
+                field = None
+
+            number = len(self.filters)
+            self.filters.append({'text': text, 'field': field})
+
+            for variant in self.encodings(text):
+                if variant:
+                    self.raw.setdefault(variant, set()).add(number)
+
+            if field is not None:
+                self.fields.setdefault(field, Matcher()).add(text, number)
+            else:
+                for variant in self.encodings(text):
+                    if variant:
+                        self.anywhere.setdefault(
+                            variant.decode('utf-8'),
+                            set()
+                        ).add(number)
+
+        self.hits = [0] * len(self.filters)
+
+    def encodings(self, text):
+        """The forms some text could take in a raw JSON body
+
+        Parameters
+        ----------
+        text : str
+            The filter text
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        variants : set
+            Each form, as bytes
+        """
+
+        escaped = json.dumps(text)[1:-1]
+        variants = {
+            text.encode('utf-8'),
+            escaped.encode('utf-8'),
+            json.dumps(text, ensure_ascii=False)[1:-1].encode('utf-8'),
+            escaped.replace('/', '\\/').encode('utf-8'),
+        }
+
+        return variants
+
+    def count(self, numbers):
+        """Add to the hit counters
+
+        Parameters
+        ----------
+        numbers : iterable
+            The filters that matched
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            for number in numbers:
+                self.hits[number] += 1
+
+    def check(self, body):
+        """Check if a webhook should be dropped, before it's decoded
+
+        Most webhooks match nothing, and only cost a search of the bytes
+        If a filter might match, the body is decoded to confirm that every
+            event in it matches
+        If it's decoded and not dropped, the payload is kept for decoded()
+        A webhook without an 'events' list is one event, so a filter
+            without a field drops it straight away
+
+        Parameters
+        ----------
+        body : bytes
+            The raw request body
+
+        Raises
+        ------
+        Exception
+            If the body can't be decoded (handled here)
+
+        Returns
+        -------
+        drop : bool
+            True if the webhook should be dropped
+        """
+
+        self.local.payload = None
+        if not self.filters:
+            return False
+
+        found = {
+            number
+            for variant, numbers in self.raw.items()
+            if variant in body
+            for number in numbers
+        }
+        if not found:
+            return False
+
+        # A single event with a filter that applies anywhere
+        anywhere = [
+            number for number in found
+            if self.filters[number]['field'] is None
+        ]
+        if anywhere and b'"events"' not in body:
+            self.count(anywhere)
+            return True
+
+        # Otherwise, decode the body to check each event
+        try:
+            payload = decode.loads(body)
+        except Exception:
+            return False
+
+        events = payload.get('events') if isinstance(payload, dict) else None
+        if not isinstance(events, list):
+            events = [payload]
+
+        matched = [self.event_match(event, count=False) for event in events]
+        if events and None not in matched:
+            self.count(set(matched))
+            return True
+
+        self.local.payload = (body, payload)
+        return False
+
+    def decoded(self, body):
+        """Get the payload check() decoded, so it isn't decoded again
+
+        The payload is only given once
+
+        Parameters
+        ----------
+        body : bytes
+            The raw request body
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        payload : dict
+            The decoded webhook, or None if check() didn't decode this body
+        """
+
+        kept = getattr(self.local, 'payload', None)
+        self.local.payload = None
+        if kept is None or kept[0] != body:
+            return None
+
+        return kept[1]
+
+    def event_match(self, event, count=True):
+        """Check if a decoded event should be dropped
+
+        Field filters are checked against their field
+        Filters without a field are checked against the whole event
+
+        Parameters
+        ----------
+        event : dict
+            A single event
+        count : bool
+            Add to the hit counter if the event matches
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        number : int
+            The number of the filter that matched, or None
+        """
+
+        if not isinstance(event, dict):
+            return None
+
+        for field, matcher in self.fields.items():
+            if field not in event:
+                continue
+
+            number = matcher.search(str(event[field]))
+            if number is not None:
+                if count:
+                    self.count([number])
+                return number
+
+        if self.anywhere:
+            text = json.dumps(event, ensure_ascii=False)
+            for variant, numbers in self.anywhere.items():
+                if variant in text:
+                    number = min(numbers)
+                    if count:
+                        self.count([number])
+                    return number
+
+        return None
+
+    def stats(self):
+        """Get the hit counters
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        stats : list
+            A dictionary for each filter, with its text, field, and hits
+        """
+
+        with self.lock:
+            return [
+                {**entry, 'hits': hits}
+                for entry, hits in zip(self.filters, self.hits)
+            ]
@@ -0,0 +1,341 @@
+"""
+Profiles the running service on demand, for a number of seconds
+
+Started from the /admin/profile endpoint (see web-service.py)
+    A background thread samples the stack of every thread, so busy
+    functions show up wherever they run (eg, in Flask request threads)
+    tracemalloc snapshots are taken at the start and end, to show where
+    memory was allocated during the run
+The report is saved to disk, and can be read from the same endpoint
+
+A stack sampler is used instead of cProfile, as cProfile only sees the
+    thread that started it, and slows down everything it profiles
+
+Modules:
+    3rd Party: termcolor, threading, time, os, sys, tracemalloc,
+        collections
+    Custom: config
+
+Classes:
+
+    Profiler
+        Runs one profile at a time, and keeps the last report
+
+Functions
+
+    None
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    profiler : Profiler
+        The shared profiler
+    TOP : int
+        The number of lines in each section of a report
+
+Limitations:
+    Sampling shows where time is spent, not exact call counts
+    Functions that finish between samples may not show up
+    tracemalloc slows down allocations while a profile is running
+    Idle threads (eg, waiting for a webhook) are sampled too
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import termcolor
+import threading
+import time
+import os
+import sys
+import tracemalloc
+from collections import Counter
+
+from config import TRACING
+
+
+# The number of lines in each section of a report
+TOP = 25
+
+
+class Profiler():
+    """Runs one profile at a time, and keeps the last report
+
+    Attributes
+    ----------
+    running : bool
+        True while a profile is running
+    report : str
+        The last report
+
+    Methods
+    -------
+    start()
+        Start a profile in the background
+    run()
+        Sample stacks and memory for a number of seconds
+    sample()
+        Take a sample of every thread's stack
+    build()
+        Build a report from the samples and snapshots
+    save()
+        Save a report to disk
+    """
+
+    def __init__(self):
+        """Class constructor
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.lock = threading.Lock()
+        self.running = False
+        self.report = ''
+
+    def start(self, seconds):
+        """Start a profile in the background
+
+        Parameters
+        ----------
+        seconds : float
+            How long to profile for (limited by 'max_profile_seconds')
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        started : bool
+            False if a profile is already running
+        """
+
+        seconds = min(seconds, TRACING['max_profile_seconds'])
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+
+        threading.Thread(
+            target=self.run,
+            args=(seconds,),
+            daemon=True
+        ).start()
+        return True
+
+    def run(self, seconds):
+        """Sample stacks and memory for a number of seconds
+
+        Parameters
+        ----------
+        seconds : float
+            How long to profile for
+
+        Raises
+        ------
+        Exception
+            If profiling fails (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        print(termcolor.colored(
+            f"Profiling for {seconds} seconds",
+            "cyan"
+        ))
+
+        # tracemalloc may already be running (eg, python -X tracemalloc)
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        own = Counter()
+        total = Counter()
+        samples = 0
+        start = time.monotonic()
+        deadline = start + seconds
+
+        try:
+            first = tracemalloc.take_snapshot()
+            while time.monotonic() < deadline:
+                samples += self.sample(own, total)
+                time.sleep(TRACING['profile_interval'])
+            last = tracemalloc.take_snapshot()
+
+            report = self.build(
+                own,
+                total,
+                samples,
+                time.monotonic() - start,
+                last.compare_to(first, 'lineno')
+            )
+            self.save(report)
+
+        except Exception as err:
+            print(termcolor.colored(f"Profiling failed: {err}", "red"))
+            report = None
+
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+
+            with self.lock:
+                self.running = False
+
+        if report is not None:
+            with self.lock:
+                self.report = report
+
+    def sample(self, own, total):
+        """Take a sample of every thread's stack
+
+        Parameters
+        ----------
+        own : collections.Counter
+            Samples where each function was running (the top of the stack)
+        total : collections.Counter
+            Samples where each function was anywhere in the stack
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        samples : int
+            The number of stacks sampled
+        """
+
+        me = threading.get_ident()
+        samples = 0
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+
+            samples += 1
+            code = frame.f_code
+            own[(code.co_filename, frame.f_lineno, code.co_name)] += 1
+
+            # Count each function once per stack (recursion)
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                seen.add((code.co_filename, code.co_name))
+                frame = frame.f_back
+            total.update(seen)
+
+        return samples
+
+    def build(self, own, total, samples, seconds, memory):
+        """Build a report from the samples and snapshots
+
+        Parameters
+        ----------
+        own : collections.Counter
+            Samples where each line was running
+        total : collections.Counter
+            Samples where each function was in the stack
+        samples : int
+            The number of stacks sampled
+        seconds : float
+            How long the profile ran for
+        memory : list
+            tracemalloc statistics (the difference between snapshots)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        report : str
+            The report, as text
+        """
+
+        lines = [
+            f"Profile: {samples} stack samples over {seconds:.1f} seconds",
+            f"Finished: {time.strftime('%Y-%m-%d %H:%M:%S')}",
+            '',
+            'Busiest lines (% of samples at the top of the stack)',
+        ]
+        for (filename, line, name), count in own.most_common(TOP):
+            lines.append(
+                f"  {count / max(samples, 1):6.1%}  {name} "
+                f"({filename}:{line})"
+            )
+
+        lines += ['', 'Busiest functions (% of samples in the stack)']
+        for (filename, name), count in total.most_common(TOP):
+            lines.append(
+                f"  {count / max(samples, 1):6.1%}  {name} ({filename})"
+            )
+
+        lines += ['', 'Memory allocated during the profile']
+        for stat in memory[:TOP]:
+            frame = stat.traceback[0]
+            lines.append(
+                f"  {stat.size_diff / 1024:+10.1f} KiB  "
+                f"{stat.count_diff:+7d} blocks  "
+                f"{frame.filename}:{frame.lineno}"
+            )
+
+        return '\n'.join(lines) + '\n'
+
+    def save(self, report):
+        """Save a report to disk
+
+        Parameters
+        ----------
+        report : str
+            The report
+
+        Raises
+        ------
+        Exception
+            If the file can't be written (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        try:
+            os.makedirs(TRACING['profile_dir'], exist_ok=True)
+            filename = os.path.join(
+                TRACING['profile_dir'],
+                f"profile-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+            )
+            with open(filename, 'w') as file:
+                file.write(report)
+
+            print(termcolor.colored(
+                f"Profile saved to {filename}",
+                "cyan"
+            ))
+
+        except Exception as err:
+            print(termcolor.colored(
+                f"Could not save the profile: {err}",
+                "red"
+            ))
+
+
+# The shared profiler
+profiler = Profiler()
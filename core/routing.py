@@ -0,0 +1,412 @@
+"""
+Routes events to Teams chats (and email), using rules in the global config
+
+Without routing, each plugin sends everything to the chat in its config
+Routing rules pick the destinations for each event, by plugin, site,
+    device, event type, and level
+
+Rules are compiled once, when the config is loaded
+    For each field, every value maps to a bitmask of the rules it matches
+    An event's rules are found by combining the masks for its fields, so
+    routing takes about the same time, however many rules there are
+
+Rule format (a list in the 'routing' section of config.yaml):
+    - name: core-switches
+      source: junos
+      site: HQ
+      device: 'hq-core*'
+      type: ['LACP*', 'SNMP_TRAP_LINK_*']
+      level: [1, 2]
+      chats:
+        - '19:xxxx@thread.v2'
+      email:
+        - 'noc@my-domain.com'
+      continue: False
+
+    Any field that is left out matches everything
+    Fields can be a single value or a list
+    Patterns ending in '*' are prefixes; Matching isn't case sensitive
+    The first matching rule is used, unless it has 'continue: True', in
+        which case later matching rules are used as well
+    If no rule matches, the plugin's own chat is used
+
+Modules:
+    3rd Party: termcolor, threading
+    Custom: config, core.teamschat
+
+Classes:
+
+    Field
+        The compiled patterns for one field
+    Router
+        A compiled set of routing rules
+
+Functions
+
+    show_routes()
+        Chat command to list the rules, and their hit counts
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    FIELDS : tuple
+        The event fields that rules can match on
+    engine : Router
+        The shared router, used by all plugins
+
+Limitations:
+    Rules are only compiled when the service starts
+    Devices are matched on the whole device field; Events listing several
+        devices (eg, Mist alarms) should be matched with a prefix or '*'
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import termcolor
+import threading
+
+from config import ROUTING
+from core import teamschat
+
+
+# The event fields that rules can match on
+FIELDS = ('source', 'site', 'device', 'type', 'level')
+
+
+class Field():
+    """The compiled patterns for one field
+
+    Attributes
+    ----------
+    any : int
+        The rules that don't check this field
+    exact : dict
+        Values, and the rules that match them exactly
+    prefixes : dict
+        Prefix patterns, grouped by length, and the rules they belong to
+    lengths : list
+        The prefix lengths
+
+    Methods
+    -------
+    add()
+        Add a rule's patterns
+    match()
+        Get the rules that match a value
+    """
+
+    def __init__(self):
+        """Class constructor
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.any = 0
+        self.exact = {}
+        self.prefixes = {}
+        self.lengths = []
+
+    def add(self, bit, patterns):
+        """Add a rule's patterns
+
+        Parameters
+        ----------
+        bit : int
+            The rule's bit
+        patterns : any
+            The patterns from the rule (None matches everything)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        if patterns is None:
+            self.any |= bit
+            return
+
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+
+        for pattern in patterns:
+            pattern = str(pattern).lower()
+
+            if pattern == '*':
+                self.any |= bit
+
+            elif pattern.endswith('*'):
+                prefix = pattern[:-1]
+                group = self.prefixes.setdefault(len(prefix), {})
+                group[prefix] = group.get(prefix, 0) | bit
+
+            else:
+                self.exact[pattern] = self.exact.get(pattern, 0) | bit
+
+        self.lengths = sorted(self.prefixes)
+
+    def match(self, value):
+        """Get the rules that match a value
+
+        Parameters
+        ----------
+        value : any
+            The event's value for this field
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        rules : int
+            A bitmask of the rules that match
+        """
+
+        value = str(value).lower()
+        rules = self.any | self.exact.get(value, 0)
+        for length in self.lengths:
+            rules |= self.prefixes[length].get(value[:length], 0)
+
+        return rules
+
+
+class Router():
+    """A compiled set of routing rules
+
+    Attributes
+    ----------
+    rules : list
+        The rules, in order
+    fields : dict
+        The compiled patterns for each field
+    hits : list
+        The number of events each rule has routed
+
+    Methods
+    -------
+    compile()
+        Compile a list of rules
+    match()
+        Get the rules that match an event
+    route()
+        Get the destinations for an event
+    summary()
+        A list of rules and their hit counts, for display
+    """
+
+    def __init__(self, rules=None):
+        """Class constructor; Compiles the rules
+
+        Parameters
+        ----------
+        rules : list
+            Optional; The rules (see the module docstring)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.lock = threading.Lock()
+        self.compile(rules or [])
+
+    def compile(self, rules):
+        """Compile a list of rules
+
+        Parameters
+        ----------
+        rules : list
+            The rules (see the module docstring)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        fields = {name: Field() for name in FIELDS}
+        compiled = []
+
+        for number, rule in enumerate(rules):
+            compiled.append({
+                'name': rule.get('name', f"rule {number + 1}"),
+                'chats': tuple(rule.get('chats') or ()),
+                'email': tuple(rule.get('email') or ()),
+                'continue': rule.get('continue', False),
+            })
+
+            # Rules without destinations never match
+            if not rule.get('chats') and not rule.get('email'):
+                print(termcolor.colored(
+                    f"Routing rule '{compiled[-1]['name']}' has no "
+                    "destinations, and will be ignored",
+                    "yellow"
+                ))
+                continue
+
+            bit = 1 << number
+            for name, field in fields.items():
+                field.add(bit, rule.get(name))
+
+        with self.lock:
+            self.rules = compiled
+            self.fields = fields
+            self.hits = [0] * len(compiled)
+
+    def match(self, event):
+        """Get the rules that match an event
+
+        Parameters
+        ----------
+        event : core.event.Event
+            The event
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        rules : int
+            A bitmask of the matching rules (bit 0 is the first rule)
+        """
+
+        rules = -1
+        for name, field in self.fields.items():
+            rules &= field.match(getattr(event, name))
+            if not rules:
+                break
+
+        return rules
+
+    def route(self, event, default):
+        """Get the destinations for an event
+
+        Parameters
+        ----------
+        event : core.event.Event
+            The event
+        default : str
+            The chat to use if no rules match (the plugin's chat)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        chats : list
+            The chats to send the event to
+        email : list
+            The addresses to email the event to
+        """
+
+        if not self.rules:
+            return [default], []
+
+        chats = []
+        email = []
+        rules = self.match(event)
+
+        # Use the lowest matching rule, then the next if it continues
+        while rules:
+            number = (rules & -rules).bit_length() - 1
+            rule = self.rules[number]
+            with self.lock:
+                self.hits[number] += 1
+
+            chats.extend(chat for chat in rule['chats'] if chat not in chats)
+            email.extend(addr for addr in rule['email'] if addr not in email)
+
+            if not rule['continue']:
+                break
+            rules &= rules - 1
+
+        if not chats and not email:
+            chats.append(default)
+
+        return chats, email
+
+    def summary(self):
+        """A list of rules and their hit counts, for display
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        lines : list
+            A line for each rule
+        """
+
+        with self.lock:
+            hits = list(self.hits)
+
+        return [
+            f"{rule['name']}: {count} events"
+            for rule, count in zip(self.rules, hits)
+        ]
+
+
+# The shared router
+engine = Router(ROUTING['rules'])
+
+
+def show_routes(chat_id, **kwargs):
+    '''
+    Chat command to list the routing rules, and their hit counts
+
+        Parameters:
+            chat_id : str
+                The teams chat ID to respond to
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    lines = engine.summary()
+    if not lines:
+        teamschat.send_chat(
+            "There are no routing rules; Each plugin uses its own chat",
+            chat_id
+        )
+        return
+
+    teamschat.send_chat(
+        "Here are the routing rules:<br>" + "<br>".join(lines),
+        chat_id
+    )
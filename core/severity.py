@@ -0,0 +1,194 @@
+"""
+Compiles priority rules from plugin config into fast lookup tables
+
+Plugins assign a priority (level) to each event, using rules in their
+    config file. These rules are compiled once, when the config is loaded
+Classifying an event then takes the same time, no matter how many
+    rules there are
+
+Rule formats (in a config section):
+    NAME: 2
+        An exact match on the event name
+    PREFIX*: 2
+        Matches any event name starting with PREFIX
+        The longest matching prefix wins
+    '*': 3
+        Matches any event name that no other rule matches
+    NAME:
+      keyword: 1
+      keyword: 2
+      default: 3
+        Sub-rules; If a keyword is in the event's text, use its level
+        If several keywords match, the last one listed wins
+        Keywords listed after 'default' are ignored
+        If no keywords match, the 'default' level is used
+
+Modules:
+    3rd Party: None
+    Custom: core.matcher
+
+Classes:
+
+    Classifier
+        A compiled set of priority rules
+
+Functions
+
+    None
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    None
+
+Limitations:
+    Matching is case sensitive
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+from core.matcher import Matcher
+
+
+class Classifier():
+    """A compiled set of priority rules
+
+    Attributes
+    ----------
+    default : int
+        The level for events that match no rule
+    exact : dict
+        Exact rules; Event names and their levels
+    prefixes : dict
+        Prefix rules, grouped by prefix length
+    lengths : list
+        The prefix lengths, longest first
+    subrules : dict
+        Event names and their keyword matchers and default levels
+
+    Methods
+    -------
+    classify()
+        Get the level for an event
+    """
+
+    def __init__(self, rules, default=1):
+        """Class constructor; Compiles the rules
+
+        Parameters
+        ----------
+        rules : dict
+            A section of plugin config (see the module docstring)
+        default : int
+            The level for events that match no rule
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.default = default
+        self.exact = {}
+        self.prefixes = {}
+        self.subrules = {}
+
+        for name, level in (rules or {}).items():
+            name = str(name)
+
+            # Sub-rules, matched against the event text
+            if isinstance(level, dict):
+                self.subrules[name] = self.compile_subrules(level)
+                continue
+
+            # A catch-all rule
+            if name == '*':
+                self.default = level
+
+            # A prefix rule
+            elif name.endswith('*'):
+                prefix = name[:-1]
+                self.prefixes.setdefault(len(prefix), {})[prefix] = level
+
+            # An exact rule
+            else:
+                self.exact[name] = level
+
+        self.lengths = sorted(self.prefixes, reverse=True)
+
+    def compile_subrules(self, keywords):
+        """Compile the sub-rules for one event name
+
+        Each keyword remembers its position, so the last one listed can
+            win when several match
+
+        Parameters
+        ----------
+        keywords : dict
+            Keywords and their levels, and optionally 'default'
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        subrule : tuple
+            The keyword matcher, and the default level (may be None)
+        """
+
+        matcher = Matcher()
+        for position, (keyword, level) in enumerate(keywords.items()):
+            if keyword == 'default':
+                break
+            matcher.add(str(keyword), (position, level))
+
+        return matcher, keywords.get('default')
+
+    def classify(self, name, text=''):
+        """Get the level for an event
+
+        Parameters
+        ----------
+        name : str
+            The event name (eg, the event type)
+        text : str
+            Optional; The event text, for sub-rules
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        level : int
+            The event level
+        """
+
+        if name is None:
+            return self.default
+
+        if name in self.exact:
+            return self.exact[name]
+
+        if name in self.subrules:
+            matcher, level = self.subrules[name]
+            found = matcher.values(text or '')
+            if found:
+                return max(found)[1]
+            return self.default if level is None else level
+
+        for length in self.lengths:
+            level = self.prefixes[length].get(name[:length])
+            if level is not None:
+                return level
+
+        return self.default
@@ -28,25 +28,28 @@ SERVER = SMTP['server']
 PORT = SMTP['port']
 
 
-def send_mail(message):
+def send_mail(message, receivers=None, subject=None, html=False):
     '''
     Takes a message as a string
     Sends the message to the smtp server, as defined in config.yaml
+    Optionally, sends to a different list of receivers (eg, for routing),
+        with a different subject, or as HTML
     '''
 
     to = ''
     sender = SMTP['sender']
-    receivers = SMTP['receivers']
+    if receivers is None:
+        receivers = SMTP['receivers']
     for receiver in receivers:
         if to != '':
             to += ", "
         to += receiver
 
     # Convert the given message to MIME format
-    msg = MIMEText(message)
+    msg = MIMEText(message, 'html' if html else 'plain')
 
     # Add email details
-    msg['Subject'] = 'Test mail - Network Assistant'
+    msg['Subject'] = subject or 'Test mail - Network Assistant'
     msg['From'] = SMTP['sender']
     msg['To'] = to
 
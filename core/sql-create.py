@@ -156,6 +156,22 @@ if __name__ == '__main__':
     # Create the table
     create_table('mist_events', fields, sql_connector)
 
+    # The incident table, for correlated events (see core/correlate.py)
+    incident_fields = {
+        'id': 'int IDENTITY(1,1) PRIMARY KEY not null',
+        'device': 'text null',
+        'site': 'text null',
+        'event': 'text not null',
+        'description': 'text null',
+        'logdate': 'date not null',
+        'logtime': 'time not null',
+        'enddate': 'date not null',
+        'endtime': 'time not null',
+        'events': 'int not null',
+        'message': 'text null'
+    }
+    create_table('incidents', incident_fields, sql_connector)
+
     # Cleanup
     close(sql_connector)
 
@@ -204,4 +220,26 @@ Chat message ID
     - Allow null: yes
 
 
+Incident Fields
+---------------
+
+The incident table has the same fields as above, with these differences:
+Device
+    - All devices in the incident, comma separated
+Event
+    - The plugins that sent events, comma separated
+Description
+    - The event types in the incident, comma separated
+LogDate / LogTime
+    - The time of the first event
+EndDate / EndTime
+    - The time of the last event
+    - Type: date / time
+    - Allow null: no
+Events
+    - The number of events in the incident
+    - Type: int
+    - Allow null: no
+Chat message ID
+    - The ID of the incident's teams message
 '''
@@ -2,7 +2,7 @@
 Creates and reads entries in an SQL database
 
 Modules:
-    3rd Party: pyodbc, termcolor
+    3rd Party: pyodbc, termcolor, time
     Internal: config, core
 
 Classes:
@@ -20,7 +20,8 @@ Exceptions:
 
 Misc Variables:
 
-    None
+    SQL_LATENCY : core.metrics.Histogram
+        Time taken to connect to the database, and to write rows
 
 Author:
     Luke Robertson - April 2023
@@ -28,8 +29,17 @@ Author:
 
 import pyodbc
 from config import GLOBAL, GRAPH
-from core import teamschat
+from core import teamschat, metrics, trace
 import termcolor
+import time
+
+
+# Time taken to connect to the database, and to write rows
+SQL_LATENCY = metrics.histogram(
+    'sql_seconds',
+    'Time spent connecting to SQL, and inserting rows',
+    ('stage',)
+)
 
 
 class Sql():
@@ -43,6 +53,8 @@ class Sql():
     -------
     add()
         Adds an entry to the database
+    add_many()
+        Adds several entries to the database, in one transaction
     read_last()
         Reads the last entry in a database
     read_since()
@@ -72,6 +84,7 @@ class Sql():
         self.db = GLOBAL['db_name']
 
     # Add an entry to the SQL server
+    @trace.traced('sql.add')
     def add(self, table, fields):
         """Add an entry to the database
 
@@ -128,6 +141,7 @@ class Sql():
             ))
 
         # Connect to db, run the SQL command, commit the transaction
+        start = time.perf_counter()
         try:
             with pyodbc.connect(
                     'Driver={SQL Server};'
@@ -136,6 +150,9 @@ class Sql():
                     'Trusted_Connection=yes;'
                     % (self.server, self.db)) as self.conn:
 
+                connected = time.perf_counter()
+                SQL_LATENCY.observe(connected - start, 'connect')
+
                 # The cursor is a pointer to an area in the database
                 self.cursor = self.conn.cursor()
 
@@ -172,6 +189,136 @@ class Sql():
 
                     return False
 
+                SQL_LATENCY.observe(time.perf_counter() - connected, 'insert')
+
+        # If the SQL server connection failed
+        except Exception as err:
+            print(termcolor.colored(
+                f"Error {err} connecting to the SQL database",
+                "red"
+            ))
+
+            teamschat.send_chat(
+                "Could not connect to the SQL server",
+                GRAPH['chat_id']
+            )
+
+            return False
+
+        # If all was good, return True
+        return True
+
+    # Add several entries to the SQL server, in one transaction
+    @trace.traced('sql.add_many')
+    def add_many(self, table, rows):
+        """Add several entries to the database, in one transaction
+
+        Rows are written with multi-row INSERT statements, with parameters
+            (so values don't need to be quoted or escaped)
+        SQL Server allows 2100 parameters and 1000 rows per statement, so
+            large batches are split into chunks
+
+        Parameters
+        ----------
+        table : str
+            The database table to write to
+        rows : list
+            A list of dictionaries, each with the same named fields
+            Values are raw (not quoted)
+
+        Raises
+        ------
+        Exception
+            If there were errors writing to the database
+
+        Returns
+        -------
+        True : boolean
+            If the write was successful
+        False : boolean
+            If the write failed
+        """
+
+        if not rows:
+            return True
+
+        # All rows share the columns of the first row
+        columns = list(rows[0])
+        placeholders = '(' + ', '.join('?' for _ in columns) + ')'
+        chunk_size = max(1, min(1000, 2000 // len(columns)))
+
+        # Build a statement and parameter list for each chunk
+        statements = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            sql_string = f'INSERT INTO {table} ('
+            sql_string += ', '.join(columns)
+            sql_string += ')'
+            sql_string += '\nVALUES '
+            sql_string += ', '.join(placeholders for _ in chunk) + ';'
+
+            params = [row[column] for row in chunk for column in columns]
+            statements.append((sql_string, params))
+
+        # Optionally, we can debug this to the terminal
+        if GLOBAL['flask_debug']:
+            print(termcolor.colored(
+                f"DEBUG (sql.py): {len(rows)} rows in \
+                    {len(statements)} statements: {statements[0][0]}",
+                "magenta"
+            ))
+
+        # Connect to db, run the SQL commands, commit the transaction
+        start = time.perf_counter()
+        try:
+            with pyodbc.connect(
+                    'Driver={SQL Server};'
+                    'Server=%s;'
+                    'Database=%s;'
+                    'Trusted_Connection=yes;'
+                    % (self.server, self.db)) as self.conn:
+
+                connected = time.perf_counter()
+                SQL_LATENCY.observe(connected - start, 'connect')
+
+                self.cursor = self.conn.cursor()
+
+                # Try to execute the SQL commands (add rows)
+                try:
+                    for sql_string, params in statements:
+                        self.cursor.execute(sql_string, params)
+                except Exception as err:
+                    print(termcolor.colored(
+                        f"SQL execution error: {err}",
+                        "red"
+                    ))
+
+                    teamschat.send_chat(
+                        "An error has occurred while writing to SQL",
+                        GRAPH['chat_id']
+                    )
+
+                    return False
+
+                # Commit the transaction
+                try:
+                    self.conn.commit()
+                except Exception as err:
+                    print(termcolor.colored(
+                        f"SQL commit error: {err}",
+                        "red"
+                    ))
+
+                    teamschat.send_chat(
+                        "An error has occurred while committing\
+                            the SQL transaction",
+                        GRAPH['chat_id']
+                    )
+
+                    return False
+
+                SQL_LATENCY.observe(time.perf_counter() - connected, 'insert')
+
         # If the SQL server connection failed
         except Exception as err:
             print(termcolor.colored(
@@ -0,0 +1,541 @@
+"""
+Suppresses duplicate and flapping events, across all plugins
+
+During a link flap, several plugins may report the same problem many
+    times (eg, LACP changes from the Junos agent, and up/downs from Mist)
+This stage sits between plugin parsing and the sinks (Teams and SQL)
+
+Each event is fingerprinted by its device, site, type, description, and
+    any key fields
+    Event types can be grouped, so related events from different plugins
+    share a fingerprint (eg, LACP changes and switch up/downs); Grouped
+    events leave out the description, as each plugin words it differently
+    Events without a device are never suppressed, as there's nothing to
+    tell them apart (eg, Mist audits, Cloudflare alerts)
+The first event with a fingerprint is sent as normal
+Repeats within the window are suppressed, and counted
+    The original Teams message is edited to show the count, and marked as
+    flapping if there are enough repeats in the window
+
+Modules:
+    3rd Party: termcolor, threading, time, collections, dataclasses,
+        typing
+    Custom: config, core.teamschat
+
+Classes:
+
+    Entry
+        The state of one fingerprint
+    Post
+        A Teams message that later events are summarised in
+    Suppressor
+        Checks events, and keeps the state table
+
+Functions
+
+    add_line()
+        Add a line to a summary in a Teams message
+    edit()
+        Edit a Teams message, to show its summaries
+    scheduled()
+        Run a scheduled edit
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    engine : Suppressor
+        The shared suppressor, used by all plugins
+    EDIT_LOCK : threading.Lock
+        Protects Teams messages while they're being edited
+
+Limitations:
+    State is kept in memory, so it starts empty when the service restarts
+    The state table is bounded; The least recently seen fingerprints are
+        dropped first
+    Edits are rate limited, so the count in Teams may lag by up to
+        'update_interval' seconds
+    Other stages (eg, core/correlate.py) add their own summaries to the
+        same messages, so edits from each don't overwrite each other
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import termcolor
+import threading
+import time
+from collections import deque, OrderedDict
+from dataclasses import dataclass, field
+from typing import Any
+
+from config import SUPPRESS
+from core import teamschat
+
+
+@dataclass(slots=True)
+class Entry():
+    """The state of one fingerprint
+
+    Attributes
+    ----------
+    key : tuple
+        The fingerprint
+    label : str
+        A description of the fingerprint, for messages
+    first : float
+        When the first event was seen (monotonic seconds)
+    last : float
+        When the latest event was seen (monotonic seconds)
+    times : collections.deque
+        When events were seen, within the window
+    repeats : int
+        The number of events suppressed
+    chat_id : str
+        The ID of the Teams message the first event was sent in
+    post : Post
+        The Teams message that repeats are summarised in
+    """
+
+    key: tuple
+    label: str
+    first: float
+    last: float
+    times: deque
+    repeats: int = 0
+    chat_id: str = ''
+    post: Any = None
+
+
+@dataclass(slots=True, eq=False)
+class Post():
+    """A Teams message that later events are summarised in
+
+    Attributes
+    ----------
+    content : str
+        The original message
+    chat : str
+        The chat the message was sent to
+    message_id : str
+        The ID of the message
+    sections : dict
+        Summaries added to the message, keyed by title
+        Each is a dictionary of lines, keyed by what they describe
+    last_edit : float
+        When the message was last edited (monotonic seconds)
+    timer : threading.Timer
+        A pending edit, if one has been scheduled
+
+    Methods
+    -------
+    render()
+        Build the message, with its summaries (call with EDIT_LOCK held)
+    """
+
+    content: str
+    chat: str
+    message_id: str
+    sections: dict = field(default_factory=dict)
+    last_edit: float = 0
+    timer: Any = None
+
+    def render(self):
+        """Build the message, with its summaries
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        message : str
+            The HTML message for Teams
+        """
+
+        message = self.content
+        for title, lines in self.sections.items():
+            message += f"<br><br><i>{title}</i><br>"
+            message += '<br>'.join(lines.values())
+
+        return message
+
+
+class Suppressor():
+    """Checks events, and keeps the state table
+
+    Attributes
+    ----------
+    entries : collections.OrderedDict
+        Entries, keyed by fingerprint, with the least recently seen first
+    groups : dict
+        Event types, and the group they belong to
+    stats : dict
+        Counts of events sent and suppressed
+
+    Methods
+    -------
+    fingerprint()
+        Get the fingerprint of an event
+    check()
+        Split events into new events, and repeats
+    posted()
+        Record the Teams message that new events were sent in
+    summarise()
+        Add a line to a Teams message, for a repeated event
+    """
+
+    def __init__(self, settings=SUPPRESS):
+        """Class constructor
+
+        Parameters
+        ----------
+        settings : dict
+            The 'suppress' section of the global config
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {'sent': 0, 'suppressed': 0, 'flapping': 0}
+
+        # Map each event type to its group, for quick lookups
+        self.groups = {}
+        for group, types in (settings.get('groups') or {}).items():
+            for event_type in types:
+                self.groups[event_type] = group
+
+    def fingerprint(self, event):
+        """Get the fingerprint of an event
+
+        Grouped event types share a fingerprint, whichever plugin sent them
+        Other types include the description, so different events of the
+            same type on a device aren't treated as repeats
+        Key fields come from the event's 'details', if they're there
+
+        Parameters
+        ----------
+        event : core.event.Event
+            The event
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        key : tuple
+            The fingerprint
+        None
+            If the event has no device (it isn't suppressed)
+        """
+
+        if not event.device:
+            return None
+
+        kind = self.groups.get(event.type)
+        description = ''
+        if kind is None:
+            kind = f"{event.source}:{event.type}"
+            description = event.description.lower()
+
+        return (
+            event.device.lower(),
+            kind,
+            event.site.lower(),
+            description,
+            *(event.details.get(name) for name in self.settings['keys'])
+        )
+
+    def expire(self, now):
+        """Remove entries that haven't been seen within the window
+
+        Entries are in the order they were last seen, so only expired
+            entries are looked at
+        Must be called with the lock held
+
+        Parameters
+        ----------
+        now : float
+            The current time (monotonic seconds)
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        window = self.settings['window']
+        while self.entries:
+            entry = next(iter(self.entries.values()))
+            if now - entry.last <= window:
+                break
+            self.entries.popitem(last=False)
+
+        # Keep the table bounded
+        while len(self.entries) > self.settings['max_entries']:
+            self.entries.popitem(last=False)
+
+    def check(self, events):
+        """Split events into new events, and repeats
+
+        Repeats have their message removed, and are given the ID of the
+            message the first event was sent in
+
+        Parameters
+        ----------
+        events : list
+            core.event.Event objects
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        new : list
+            Events to send as normal
+        repeats : list
+            Events that were suppressed
+        """
+
+        if not self.settings['enabled']:
+            return events, []
+
+        new = []
+        repeats = []
+        dirty = set()
+        window = self.settings['window']
+
+        with self.lock:
+            now = time.monotonic()
+            self.expire(now)
+
+            for event in events:
+                key = self.fingerprint(event)
+                if key is None:
+                    new.append(event)
+                    continue
+
+                entry = self.entries.get(key)
+
+                # The first event with this fingerprint
+                if entry is None:
+                    self.entries[key] = Entry(
+                        key=key,
+                        label=f"{event.device} {key[1].split(':')[-1]}",
+                        first=now,
+                        last=now,
+                        times=deque([now])
+                    )
+                    new.append(event)
+                    continue
+
+                # A repeat; Update the sliding window
+                self.entries.move_to_end(key)
+                entry.last = now
+                entry.repeats += 1
+                entry.times.append(now)
+                while now - entry.times[0] > window:
+                    entry.times.popleft()
+
+                if len(entry.times) == self.settings['flap_count']:
+                    self.stats['flapping'] += 1
+
+                event.message = ''
+                event.chat_id = entry.chat_id
+                repeats.append(event)
+                if entry.post is not None:
+                    self.summarise(entry)
+                    dirty.add(entry.post)
+
+            self.stats['sent'] += len(new)
+            self.stats['suppressed'] += len(repeats)
+
+        for post in dirty:
+            edit(post, self.settings['update_interval'])
+
+        return new, repeats
+
+    def posted(self, events, post):
+        """Record the Teams message that new events were sent in
+
+        Later repeats of these events are summarised in this message
+        If repeats arrived in the same batch, the message is edited now
+
+        Parameters
+        ----------
+        events : list
+            The events that were in the message
+        post : Post
+            The Teams message
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        if not self.settings['enabled'] or not post.message_id:
+            return
+
+        repeated = False
+        with self.lock:
+            for event in events:
+                key = self.fingerprint(event)
+                entry = None if key is None else self.entries.get(key)
+                if entry is None or entry.post is not None:
+                    continue
+                entry.chat_id = post.message_id
+                entry.post = post
+                if entry.repeats:
+                    self.summarise(entry)
+                    repeated = True
+
+        if repeated:
+            edit(post, self.settings['update_interval'])
+
+    def summarise(self, entry):
+        """Add a line to a Teams message, for a repeated event
+
+        Must be called with the lock held
+
+        Parameters
+        ----------
+        entry : Entry
+            The repeated event's entry
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        line = f"{entry.label}: repeated {entry.repeats} \
+            time{'s' if entry.repeats != 1 else ''}"
+        if len(entry.times) >= self.settings['flap_count']:
+            line += " <span style=\"color:Red\"><b>(flapping)</b></span>"
+
+        add_line(entry.post, 'Suppressed repeats', entry.key, line)
+
+
+def add_line(post, title, key, line):
+    '''
+    Adds a line to a summary in a Teams message, or replaces it
+    The message isn't edited until edit() is called
+
+        Parameters:
+            post : Post
+                The Teams message
+            title : str
+                The summary's title
+            key : any
+                What the line describes (a line with the same key is
+                    replaced)
+            line : str
+                The HTML line
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    with EDIT_LOCK:
+        post.sections.setdefault(title, {})[key] = line
+
+
+def edit(post, interval):
+    '''
+    Edits a Teams message, to show its summaries
+    Edits are rate limited; If it's too soon, an edit is scheduled for
+        later, so the latest summary is always shown
+
+        Parameters:
+            post : Post
+                The Teams message
+            interval : int
+                The minimum time (seconds) between edits
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    with EDIT_LOCK:
+        # An edit is already scheduled
+        if post.timer is not None:
+            return
+
+        wait = post.last_edit + interval - time.monotonic()
+        if wait > 0:
+            post.timer = threading.Timer(wait, scheduled, [post, interval])
+            post.timer.daemon = True
+            post.timer.start()
+            return
+
+        post.last_edit = time.monotonic()
+        message = post.render()
+
+    if not teamschat.update_chat(message, post.chat, post.message_id):
+        print(termcolor.colored(
+            "Could not update a Teams message with a summary",
+            "red"
+        ))
+
+
+def scheduled(post, interval):
+    '''
+    Runs a scheduled edit of a Teams message
+
+        Parameters:
+            post : Post
+                The Teams message
+            interval : int
+                The minimum time (seconds) between edits
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    with EDIT_LOCK:
+        post.timer = None
+
+    edit(post, interval)
+
+
+# Protects Teams messages while they're being edited
+EDIT_LOCK = threading.Lock()
+
+# The shared suppressor
+engine = Suppressor()
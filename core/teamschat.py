@@ -7,8 +7,8 @@ Graph API uses OAuth2 authentication, which is used in the azureauth module
 A valid bearer token is needed for API calls
 
 Modules:
-    3rd Party: Requests, json, datetime, termcolor, threading
-    Custom: config
+    3rd Party: Requests, json, time, datetime, termcolor, threading
+    Custom: config, core.metrics, core.trace
 
 Classes:
 
@@ -21,6 +21,8 @@ Functions
         Check there is a valid bearer token, and return it
     send_chat()
         Send a message to Teams
+    update_chat()
+        Update a message that was sent to Teams
     notification_refresh()
         Refresh resource subscriptions
 
@@ -30,7 +32,10 @@ Exceptions:
 
 Misc Variables:
 
-    None
+    GRAPH_LATENCY : core.metrics.Histogram
+        Time taken by Graph API calls
+    GRAPH_RESPONSES : core.metrics.Counter
+        Graph API responses, by status code ('error' if there wasn't one)
 
 Limitations:
     There is a limit to the API calls made to Graph before throttling occurs
@@ -44,12 +49,27 @@ Author:
 
 import requests
 from config import GRAPH, TEAMS
+from core import metrics, trace
 import json
+import time
 from datetime import datetime, timedelta
 import termcolor
 import threading
 
 
+# Graph API calls; How long they take, and the responses (eg, 429)
+GRAPH_LATENCY = metrics.histogram(
+    'graph_seconds',
+    'Time taken by Graph API calls',
+    ('call',)
+)
+GRAPH_RESPONSES = metrics.counter(
+    'graph_responses_total',
+    'Graph API responses, by status code',
+    ('call', 'status')
+)
+
+
 # Check teams token is available
 def check_token():
     '''
@@ -100,6 +120,7 @@ def check_token():
 
 
 # Send a messages to a teams chat
+@trace.traced('send_chat')
 def send_chat(message, chat_msg_id):
     '''
     takes a message, and sends it to a teams chat
@@ -141,11 +162,13 @@ def send_chat(message, chat_msg_id):
     }
 
     # API Call
+    start = time.perf_counter()
     try:
         response = requests.post(
             f"{endpoint}/{chat_msg_id}/messages", json=body, headers=headers
         )
     except Exception as err:
+        GRAPH_RESPONSES.inc('send', 'error')
         print(termcolor.colored(
             "Error connecting to the API to POST a message",
             "red"
@@ -156,11 +179,17 @@ def send_chat(message, chat_msg_id):
         ))
         return False
 
+    GRAPH_LATENCY.observe(time.perf_counter() - start, 'send')
+    GRAPH_RESPONSES.inc('send', str(response.status_code))
+
     # Check that we got a valid response
     match response.status_code:
         # HTTP 200 or 201 is a good response
         case 200 | 201:
             chat_id = json.loads(response.content)
+
+            # Keep the message ID with the trace, to find slow alerts later
+            trace.link(chat_id.get('id'))
             return chat_id
 
         # All other response codes are bad
@@ -172,6 +201,88 @@ def send_chat(message, chat_msg_id):
             return False
 
 
+# Update a message that has already been sent to a teams chat
+@trace.traced('update_chat')
+def update_chat(message, chat_msg_id, message_id):
+    '''
+    Replaces the content of a message that was previously sent
+    Only messages that this account sent can be updated
+
+        Parameters:
+            message : str
+                An HTML formatted string that replaces the message
+            chat_msg_id : str
+                The chat ID that the message is in
+            message_id : str
+                The ID of the message, as returned by send_chat()
+
+        Raises:
+            Exception
+                If there was an error connecting to the API
+
+        Returns:
+            True : Boolean
+                If the message was updated
+            False : Boolean
+                Returned if there was a problem
+    '''
+
+    # Make sure authentication is complete first
+    full_token = check_token()
+
+    # Setup standard REST details for the API call
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": full_token['access_token']
+    }
+    endpoint = GRAPH['base_url'] + 'chats'
+
+    body = {
+        "body": {
+            "contentType": "html",
+            "content": message
+        }
+    }
+
+    # API Call
+    start = time.perf_counter()
+    try:
+        response = requests.patch(
+            f"{endpoint}/{chat_msg_id}/messages/{message_id}",
+            json=body,
+            headers=headers
+        )
+    except Exception as err:
+        GRAPH_RESPONSES.inc('update', 'error')
+        print(termcolor.colored(
+            "Error connecting to the API to PATCH a message",
+            "red"
+        ))
+        print(termcolor.colored(
+            err,
+            "red"
+        ))
+        return False
+
+    GRAPH_LATENCY.observe(time.perf_counter() - start, 'update')
+    GRAPH_RESPONSES.inc('update', str(response.status_code))
+
+    # Check that we got a valid response
+    match response.status_code:
+        # HTTP 200 or 204 is a good response
+        case 200 | 204:
+            return True
+
+        # All other response codes are bad
+        case _:
+            print(termcolor.colored(
+                f"Received {response.status_code} code when updating a \
+                    teams message",
+                "red"
+            ))
+            return False
+
+
 # Refresh class based subscription
 def notification_refresh():
     '''
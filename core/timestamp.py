@@ -0,0 +1,295 @@
+"""
+Shared timestamp handling for plugins
+
+Webhooks carry timestamps in different formats (ISO-8601 text, epoch
+    seconds, or epoch milliseconds)
+This converts them into a datetime in the local timezone, so each event
+    has one authoritative time, used for both messages and SQL
+
+ISO-8601 and epoch timestamps are handled by the standard library
+    dateutil is only used (if it's installed) for anything else
+The local timezone is looked up once, and cached
+
+Modules:
+    3rd Party: datetime, functools, tzlocal (optional),
+        dateutil (optional)
+    Custom: None
+
+Classes:
+
+    None
+
+Functions
+
+    local_zone()
+        Get the local timezone
+    now()
+        Get the current time
+    parse()
+        Convert a timestamp into a local datetime
+    event_time()
+        Get the time of an event
+    clock()
+        Format a datetime as a simple time (HH:MM:SS)
+    log_fields()
+        Get the date and time fields for SQL
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    EPOCH_MS : int
+        Epoch values larger than this are in milliseconds
+    CACHE_SIZE : int
+        The number of timestamp strings to remember
+
+Limitations:
+    Timestamps without a timezone are assumed to be in local time
+    Epoch values are assumed to be in seconds, unless they're too large
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+from datetime import datetime, timezone
+from functools import lru_cache
+
+try:
+    from tzlocal import get_localzone
+except ImportError:
+    get_localzone = None
+
+try:
+    from dateutil.parser import parse as dateutil_parse
+except ImportError:
+    dateutil_parse = None
+
+
+# Epoch values larger than this are in milliseconds (this is in 5138 AD)
+EPOCH_MS = 10 ** 11
+
+# Many events in a batch share a timestamp, so parsed strings are cached
+CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=1)
+def local_zone():
+    '''
+    Gets the local timezone
+    This is looked up once, then cached
+
+        Parameters:
+            None
+
+        Raises:
+            Exception
+                If tzlocal can't find the timezone (handled here)
+
+        Returns:
+            zone : tzinfo
+                The local timezone
+    '''
+
+    if get_localzone is not None:
+        try:
+            return get_localzone()
+        except Exception:
+            pass
+
+    # Without tzlocal, use the current UTC offset
+    return datetime.now().astimezone().tzinfo
+
+
+def now():
+    '''
+    Gets the current time, in the local timezone
+
+        Parameters:
+            None
+
+        Raises:
+            None
+
+        Returns:
+            time : datetime
+                The current time
+    '''
+
+    return datetime.now(timezone.utc).astimezone(local_zone())
+
+
+def from_epoch(value):
+    '''
+    Converts an epoch timestamp (seconds or milliseconds) to a datetime
+
+        Parameters:
+            value : int or float
+                The epoch timestamp
+
+        Raises:
+            None
+
+        Returns:
+            time : datetime
+                The local time
+    '''
+
+    if value > EPOCH_MS:
+        value = value / 1000
+
+    return datetime.fromtimestamp(value, local_zone())
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def from_text(value):
+    '''
+    Converts a timestamp string to a datetime
+
+    Tries ISO-8601 first, then epoch, then dateutil (if installed)
+
+        Parameters:
+            value : str
+                The timestamp
+
+        Raises:
+            ValueError
+                If the timestamp can't be parsed (handled here)
+
+        Returns:
+            time : datetime
+                The local time, or None if the timestamp can't be parsed
+    '''
+
+    value = value.strip()
+
+    # The fast path; Most timestamps are ISO-8601
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        parsed = None
+
+    # Epoch timestamps, sent as text
+    if parsed is None:
+        try:
+            return from_epoch(float(value))
+        except (ValueError, OverflowError, OSError):
+            pass
+
+    # Anything else
+    if parsed is None and dateutil_parse is not None:
+        try:
+            parsed = dateutil_parse(value)
+        except (ValueError, OverflowError):
+            pass
+
+    if parsed is None:
+        return None
+
+    # Assume local time if there's no timezone
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=local_zone())
+
+    return parsed.astimezone(local_zone())
+
+
+def parse(value):
+    '''
+    Converts a timestamp into a datetime in the local timezone
+
+        Parameters:
+            value : str, int, float, or datetime
+                The timestamp (ISO-8601, epoch seconds, or epoch ms)
+
+        Raises:
+            Exception
+                If the timestamp is invalid (handled here)
+
+        Returns:
+            time : datetime
+                The local time, or None if the timestamp can't be parsed
+    '''
+
+    if value is None or isinstance(value, bool):
+        return None
+
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=local_zone())
+        return value.astimezone(local_zone())
+
+    if isinstance(value, (int, float)):
+        try:
+            return from_epoch(value)
+        except (ValueError, OverflowError, OSError):
+            return None
+
+    if isinstance(value, str) and value:
+        return from_text(value)
+
+    return None
+
+
+def event_time(value=None):
+    '''
+    Gets the time of an event
+    This is the time in the event if there is one, or the current time
+
+    Call this once per event, and use the result for messages and SQL,
+        so they all agree
+
+        Parameters:
+            value : any
+                Optional; The timestamp from the event
+
+        Raises:
+            None
+
+        Returns:
+            time : datetime
+                The local time of the event
+    '''
+
+    return parse(value) or now()
+
+
+def clock(time):
+    '''
+    Formats a datetime as a simple time (HH:MM:SS)
+
+        Parameters:
+            time : datetime
+                The time to format
+
+        Raises:
+            None
+
+        Returns:
+            clock : str
+                The formatted time
+    '''
+
+    return time.strftime("%H:%M:%S")
+
+
+def log_fields(time):
+    '''
+    Gets the date and time fields for SQL (logdate and logtime)
+
+        Parameters:
+            time : datetime
+                The event time
+
+        Raises:
+            None
+
+        Returns:
+            date : datetime.date
+                The date
+            clock : str
+                The time (HH:MM:SS)
+    '''
+
+    return time.date(), clock(time)
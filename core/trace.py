@@ -0,0 +1,435 @@
+"""
+Traces webhooks and chat messages through each stage of the service
+
+Each webhook (and chat message) gets a trace ID
+    The time taken by each stage (eg, authenticate, handle_event, send_chat,
+    and SQL) is recorded as a span
+    Teams messages sent while handling the request are recorded with the
+    trace, so a late alert can be traced back to the slow stage
+
+Spans are only recorded when there's a trace, so code outside a request
+    (eg, background jobs) isn't slowed down
+Recent traces are kept in memory; Traces that sent a Teams message, or
+    were slow, are also written to the log file
+
+Modules:
+    3rd Party: termcolor, threading, time, os, json, contextvars,
+        collections, contextlib, dataclasses, functools
+    Custom: config
+
+Classes:
+
+    Trace
+        The spans and Teams messages of one request
+    TraceLog
+        Keeps recent traces, and writes them to disk
+
+Functions
+
+    request()
+        Trace a request (context manager)
+    span()
+        Time a stage of the current request (context manager)
+    traced()
+        Decorator to time a function as a span
+    link()
+        Record a Teams message ID with the current trace
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    log : TraceLog
+        The shared trace log
+
+Limitations:
+    Traces follow the thread that handles the request; Work passed to
+        another thread (eg, email) isn't included
+    Looking up a trace by message ID reads the log file, if the trace is
+        no longer in memory
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import termcolor
+import threading
+import time
+import os
+import json
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import wraps
+
+from config import TRACING
+
+
+# The trace for the request this thread is handling
+_current = contextvars.ContextVar('trace', default=None)
+
+
+@dataclass(slots=True)
+class Trace():
+    """The spans and Teams messages of one request
+
+    Attributes
+    ----------
+    id : str
+        The trace ID
+    kind : str
+        The type of request (eg, 'webhook' or 'chat')
+    name : str
+        What handled the request (eg, the plugin name)
+    started : float
+        When the request arrived (epoch seconds)
+    start : float
+        When the request arrived (performance counter)
+    spans : list
+        (name, start, duration) for each stage, in milliseconds
+    messages : list
+        The IDs of Teams messages sent while handling the request
+    duration : float
+        The time taken by the whole request (milliseconds)
+
+    Methods
+    -------
+    record()
+        Get the trace as a dictionary, for JSON
+    """
+
+    id: str
+    kind: str
+    name: str
+    started: float
+    start: float
+    spans: list = field(default_factory=list)
+    messages: list = field(default_factory=list)
+    duration: float = 0
+
+    def record(self):
+        """Get the trace as a dictionary, for JSON
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        record : dict
+            The trace
+        """
+
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'name': self.name,
+            'started': time.strftime(
+                '%Y-%m-%d %H:%M:%S',
+                time.localtime(self.started)
+            ),
+            'duration': self.duration,
+            'messages': self.messages,
+            'spans': [
+                {'name': name, 'start': start, 'duration': duration}
+                for name, start, duration in self.spans
+            ],
+        }
+
+
+class TraceLog():
+    """Keeps recent traces, and writes them to disk
+
+    Attributes
+    ----------
+    recent : collections.deque
+        Recent traces, newest last
+
+    Methods
+    -------
+    finish()
+        Keep a finished trace, and write it if needed
+    write()
+        Append a trace to the log file
+    find()
+        Find traces by trace ID or Teams message ID
+    """
+
+    def __init__(self):
+        """Class constructor
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=TRACING['keep'])
+
+    def finish(self, trace):
+        """Keep a finished trace, and write it if needed
+
+        Parameters
+        ----------
+        trace : Trace
+            The trace
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.recent.append(trace)
+        slow = trace.duration >= TRACING['slow_seconds'] * 1000
+
+        if slow:
+            spans = ', '.join(
+                f"{name} {duration:.0f}ms"
+                for name, _, duration in trace.spans
+            )
+            print(termcolor.colored(
+                f"Slow {trace.kind} ({trace.name}, trace {trace.id}): "
+                f"{trace.duration:.0f}ms; {spans}",
+                "yellow"
+            ))
+
+        if TRACING['log_all'] or trace.messages or slow:
+            self.write(trace)
+
+    def write(self, trace):
+        """Append a trace to the log file
+
+        Parameters
+        ----------
+        trace : Trace
+            The trace
+
+        Raises
+        ------
+        Exception
+            If the file can't be written (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        if not TRACING['log_file']:
+            return
+
+        line = json.dumps(trace.record()) + '\n'
+        try:
+            with self.lock:
+                with open(TRACING['log_file'], 'a') as file:
+                    file.write(line)
+
+        except Exception as err:
+            print(termcolor.colored(
+                f"Could not write to the trace log: {err}",
+                "red"
+            ))
+
+    def find(self, trace_id=None, message_id=None, limit=20):
+        """Find traces by trace ID or Teams message ID
+
+        Recent traces are checked first, then the log file
+        With no IDs, the most recent traces are returned
+
+        Parameters
+        ----------
+        trace_id : str
+            Optional; The trace ID
+        message_id : str
+            Optional; The ID of a Teams message the trace sent
+        limit : int
+            Optional; The most traces to return
+
+        Raises
+        ------
+        Exception
+            If the log file can't be read (handled here)
+
+        Returns
+        -------
+        traces : list
+            Matching traces, as dictionaries (newest first)
+        """
+
+        def matches(record):
+            return (
+                (trace_id is None or record['id'] == trace_id) and
+                (message_id is None or message_id in record['messages'])
+            )
+
+        records = [trace.record() for trace in reversed(list(self.recent))]
+        found = [record for record in records if matches(record)][:limit]
+
+        if found or (trace_id is None and message_id is None):
+            return found
+
+        if not TRACING['log_file'] or not os.path.exists(
+            TRACING['log_file']
+        ):
+            return found
+
+        try:
+            with self.lock:
+                with open(TRACING['log_file']) as file:
+                    for line in file:
+                        record = json.loads(line)
+                        if matches(record):
+                            found.insert(0, record)
+        except Exception as err:
+            print(termcolor.colored(
+                f"Could not read the trace log: {err}",
+                "red"
+            ))
+
+        return found[:limit]
+
+
+# The shared trace log
+log = TraceLog()
+
+
+@contextmanager
+def request(kind, name=''):
+    '''
+    Traces a request (context manager)
+    Spans recorded in this thread, until the block ends, are added to it
+
+        Parameters:
+            kind : str
+                The type of request (eg, 'webhook' or 'chat')
+            name : str
+                Optional; What handled the request (eg, the plugin name)
+
+        Raises:
+            None
+
+        Returns:
+            trace : Trace
+                The new trace (None if tracing is disabled)
+    '''
+
+    if not TRACING['enabled']:
+        yield None
+        return
+
+    trace = Trace(
+        id=os.urandom(8).hex(),
+        kind=kind,
+        name=name,
+        started=time.time(),
+        start=time.perf_counter()
+    )
+    token = _current.set(trace)
+
+    try:
+        yield trace
+
+    finally:
+        trace.duration = round((time.perf_counter() - trace.start) * 1000, 2)
+        _current.reset(token)
+        log.finish(trace)
+
+
+@contextmanager
+def span(name):
+    '''
+    Times a stage of the current request (context manager)
+    Does nothing if there's no trace
+
+        Parameters:
+            name : str
+                The name of the stage (eg, 'send_chat')
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+
+    finally:
+        trace.spans.append((
+            name,
+            round((start - trace.start) * 1000, 2),
+            round((time.perf_counter() - start) * 1000, 2),
+        ))
+
+
+def traced(name):
+    '''
+    Decorator to time a function as a span of the current request
+
+        Parameters:
+            name : str
+                The name of the stage (eg, 'sql.add')
+
+        Raises:
+            None
+
+        Returns:
+            decorator : function
+                Wraps the function
+    '''
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def link(message_id):
+    '''
+    Records a Teams message ID with the current trace
+
+        Parameters:
+            message_id : str
+                The ID of the message that was sent
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    trace = _current.get()
+    if trace is not None and message_id:
+        trace.messages.append(message_id)
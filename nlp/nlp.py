@@ -7,7 +7,7 @@ Uses rule-based matching to execute an applicable action
 
 Modules:
     3rd Party: spacy, datetime, termcolor, yaml, importlib
-    Custom: config, teamschat, parse_chats
+    Custom: config, teamschat, metrics, parse_chats
 
 Classes:
 
@@ -31,6 +31,9 @@ Misc Variables:
     known_phrases : list
         A list of dictionaries
         Contains 'global' phrases and the functions to call
+        Includes the job commands from core.jobs
+    NLP_LATENCY : core.metrics.Histogram
+        Time taken to match a phrase, and to find its entities
 
 Limitations/Requirements:
     Requires the spaCy medium english model to be downloaded/installed
@@ -48,10 +51,18 @@ import importlib
 
 from config import LANGUAGE
 from config import plugin_list
-from core import teamschat
+from core import teamschat, metrics
 import nlp.personality as personality
 
 
+# Time taken to match a phrase, and to find its entities
+NLP_LATENCY = metrics.histogram(
+    'nlp_seconds',
+    'Time taken to parse chat messages',
+    ('stage',)
+)
+
+
 # Load a list of 'global' phrases we have
 #   NLP matches these phrases and executes the corresponding function
 known_phrases = [
@@ -99,6 +110,41 @@ known_phrases = [
         "phrase": "thank",
         "function": "thank",
         "module": "global"
+    },
+    {
+        "phrase": "list jobs",
+        "function": "list_jobs",
+        "module": "core.jobs"
+    },
+    {
+        "phrase": "cancel job",
+        "function": "cancel_job",
+        "module": "core.jobs"
+    },
+    {
+        "phrase": "show routing",
+        "function": "show_routes",
+        "module": "core.routing"
+    },
+    {
+        "phrase": "list maintenance",
+        "function": "list_windows",
+        "module": "core.maintenance"
+    },
+    {
+        "phrase": "add maintenance",
+        "function": "add_maintenance",
+        "module": "core.maintenance"
+    },
+    {
+        "phrase": "end maintenance",
+        "function": "end_maintenance",
+        "module": "core.maintenance"
+    },
+    {
+        "phrase": "show latency",
+        "function": "show_latency",
+        "module": "core.latency"
     }
 ]
 
@@ -561,7 +607,8 @@ class ChatNlp():
         phrase = phrase.replace("<p>", "").replace("</p>", "").lower()
 
         # Find a match for this phrase
-        response = self.chatbot(phrase)
+        with NLP_LATENCY.time('match'):
+            response = self.chatbot(phrase)
 
         # If there is no matching response, write back to the user
         if not response:
@@ -578,5 +625,6 @@ class ChatNlp():
             function = getattr(module, response['function'])
 
         # Call the function, passing the list of entities and the phrase
-        entities = self.get_ents(phrase)
+        with NLP_LATENCY.time('entities'):
+            entities = self.get_ents(phrase)
         function(chat_id, ents=entities, message=phrase)
@@ -6,8 +6,8 @@ Confirms webhook authenticity
 Sends alerts on Teams when required
 
 Modules:
-    3rd Party: termcolor, dateutil, tzlocal, pytz, datetime
-    Custom: teamschat, plugin
+    3rd Party: termcolor, dataclasses
+    Custom: plugin, timestamp, event
 
 Classes:
 
@@ -37,13 +37,11 @@ Author:
 
 
 import termcolor
-from dateutil.parser import parse
-from tzlocal import get_localzone
-from pytz import timezone
-from datetime import datetime
+from dataclasses import replace
 
-from core import teamschat
 from core import plugin
+from core import timestamp
+from core.event import Event
 
 
 # Location of the config file
@@ -63,7 +61,7 @@ class CloudFlareHandler(plugin.PluginTemplate):
     -------
     timestamp()
         Extract the timestamp from the webhook
-        Return it in a simpler format
+        Return it as a local datetime
 
     handle_event()
         The main plugin handler
@@ -100,15 +98,26 @@ class CloudFlareHandler(plugin.PluginTemplate):
 
         super().__init__(LOCATION)
         self.table = self.config['config']['sql_table']
+        self.sql_columns = (
+            'type',
+            'pool',
+            'service',
+            'health',
+            'reason',
+            'logdate',
+            'logtime',
+            'source',
+            'message',
+        )
 
     def timestamp(self, json):
-        """Reformat the timestamp to make it nicer
+        """Get the time of the alert
 
         The timestamp field in the webhook can vary, depending on the alert
         Extracts the timestamp from the webhook
-        Converts to a datetime object
-        Converts to the local timezone (original is in UTC)
-        Simplifies the time format
+        Converts to a datetime object, in the local timezone
+            (original is in UTC)
+        If there's no timestamp, the current time is used
 
         Parameters
         ----------
@@ -121,31 +130,25 @@ class CloudFlareHandler(plugin.PluginTemplate):
 
         Returns
         -------
-        timestamp : str
-            The simplified timestamp
+        time : datetime
+            The time of the alert
         """
 
-        # Reformat the timestamp to make it nicer
         # This field varies depending on the webhook
-        if 'timestamp' in json['data']:
-            timestamp = parse(json['data']['timestamp'])
-            timestamp = timestamp.astimezone(timezone(str(get_localzone())))
-            timestamp = timestamp.strftime("%H:%M:%S")
+        data = json.get('data', {})
+        if 'timestamp' in data:
+            value = data['timestamp']
 
-        elif 'time' in json['data']:
-            timestamp = parse(json['data']['time'])
-            timestamp = timestamp.astimezone(timezone(str(get_localzone())))
-            timestamp = timestamp.strftime("%H:%M:%S")
+        elif 'time' in data:
+            value = data['time']
 
         elif 'time' in json:
-            timestamp = parse(json['time'])
-            timestamp = timestamp.astimezone(timezone(str(get_localzone())))
-            timestamp = timestamp.strftime("%H:%M:%S")
+            value = json['time']
 
         else:
-            timestamp = 'no timestamp'
+            value = None
 
-        return timestamp
+        return timestamp.event_time(value)
 
     def fields(self, json):
         """Extract fields from the webhook
@@ -167,10 +170,8 @@ class CloudFlareHandler(plugin.PluginTemplate):
 
         # Build a simple dictionary of fields
         #   Contains empty values by default to avoid KeyErrors
+        #   These are also the plugin's own SQL columns
         fields = {
-            'type': '',
-            'time': '',
-            'src_ip': '',
             'pool': '',
             'service': '',
             'health': '',
@@ -228,33 +229,36 @@ class CloudFlareHandler(plugin.PluginTemplate):
         alert = raw_response['data']
         print(termcolor.colored(f"CloudFlare Alert: {alert}", "yellow"))
 
-        # Reformat the timestamp to make it nicer
-        timestamp = self.timestamp(alert)
-
-        # Extract fields from the webhook
-        fields = self.fields(alert)
+        # Build an event, with the alert time and the fields we need
+        #   The alert time is used for the message and SQL
+        event = Event(
+            source='cloudflare',
+            when=self.timestamp(alert),
+            src_ip=src,
+            raw=raw_response,
+            details=self.fields(alert)
+        )
 
         try:
-            # Add a few fields of our own
-            fields['type'] = raw_response['alert_type'],
-            fields['time'] = timestamp,
-            fields['src_ip'] = src
+            # Add the alert type
+            event.type = raw_response['alert_type']
 
         # If there's a problem extracting fields
         except Exception:
-            fields['text'] = alert
-            message = f"Cloudflare event: {fields['text']}"
+            event.message = f"Cloudflare event: {alert}"
 
         # Build a message for Teams
         else:
-            message = f"<b><span style=\"color:Yellow\">{fields['type']} \
+            event.message = f"<b><span style=\"color:Yellow\">{event.type} \
                 </span></b> on <b><span style=\"color:Orange\"> \
-                {fields['pool']} </span></b> at {fields['time']}"
+                {event.details['pool']} </span></b> at \
+                {timestamp.clock(event.when)}"
 
         # Send the main message
-        self.log(message=message, event=fields)
+        self.log(event)
 
         # Create the health message, if there is anything to share
+        fields = event.details
         if fields['health'] != '':
             if fields['health'] == 'Healthy':
                 health = \
@@ -272,8 +276,8 @@ class CloudFlareHandler(plugin.PluginTemplate):
                     <b><span style=\"color:Red\"> \
                     {fields['health']}</span></b>"
 
-            # Send the health status
-            self.log(message=health, event=fields)
+            # Send the health status (logged as its own entry)
+            self.log(replace(event, message=health, chat_id=''))
 
     def authenticate(self, request, plugin):
         """Authenticate a webhook
@@ -314,7 +318,7 @@ class CloudFlareHandler(plugin.PluginTemplate):
         else:
             return False
 
-    def log(self, message, event):
+    def log(self, event):
         """Send alert and log to SQL
 
         Sends a message to teams
@@ -322,15 +326,12 @@ class CloudFlareHandler(plugin.PluginTemplate):
 
         Parameters
         ----------
-        message : str
-            The message to send to teams
-        event : dict
-            Interesting fields to log to SQL
+        event : core.event.Event
+            The event, with the message to send to teams
 
         Raises
         ------
-        Exception
-            If there were problems sending to Teams
+        None
 
         Returns
         -------
@@ -340,36 +341,5 @@ class CloudFlareHandler(plugin.PluginTemplate):
         # Log to the terminal
         print(termcolor.colored(f"CloudFlare event: {event}", "yellow"))
 
-        # Send to teams, and get the Teams ID
-        try:
-            chat_id = teamschat.send_chat(
-                message,
-                self.config['config']['chat_id']
-            )['id']
-
-        # If there was a problem, log to terminal
-        except Exception as err:
-            print(termcolor.colored("Error with Teams chat ID", "red"))
-            print(termcolor.colored(err, "red"))
-            return
-
-        # Collect the fields to write to SQL
-        date = datetime.now().date()
-        time = datetime.now().time().strftime("%H:%M:%S")
-        fields = {
-            'type': event['type'],
-            'pool': event['pool'],
-            'service': event['service'],
-            'health': event['health'],
-            'reason': event['reason'],
-            'logdate': date,
-            'logtime': time,
-            'source': event['src_ip'],
-            'message': chat_id
-        }
-
-        # Write to SQL
-        self.sql_write(
-            database=self.config['config']['sql_table'],
-            fields=fields
-        )
+        # Send to teams, and write to SQL
+        self.log_events([event])
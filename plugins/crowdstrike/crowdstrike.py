@@ -5,7 +5,7 @@ Sends alerts on Teams when required
 
 Modules:
     3rd Party: termcolor, hmac, hashlib, base64
-    Internal: core/teamschat, core/plugin
+    Internal: core/teamschat, core/plugin, core/event
 
 Classes:
 
@@ -24,6 +24,8 @@ Misc Variables:
 
     LOCATION : str
         The location of the config file
+    PAYLOAD_SCHEMA : dict
+        The webhook fields this plugin uses
 
 Author:
     Luke Robertson - April 2023
@@ -37,10 +39,27 @@ import base64
 
 from core import teamschat
 from core import plugin
+from core.event import Event
+from typing import Any
 
 # Location of the config file
 LOCATION = 'plugins\\crowdstrike\\config.yaml'
 
+# The webhook fields this plugin uses (see core/decode.py)
+PAYLOAD_SCHEMA = {
+    'data': {
+        'detections.command_line': Any,
+        'detections.action_taken': Any,
+        'detections.hostname': Any,
+        'detections.user_name': Any,
+        'detections.url': Any,
+    },
+    'meta': {
+        'trigger_category': Any,
+        'trigger_name': Any,
+    },
+}
+
 
 class CrowdStrikeHandler(plugin.PluginTemplate):
     """Manage webhook alerts from the CrowdStrike platform
@@ -81,6 +100,7 @@ class CrowdStrikeHandler(plugin.PluginTemplate):
 
         super().__init__(LOCATION)
         self.table = ""
+        self.schema = PAYLOAD_SCHEMA
         self.auth_header = self.config['config']['auth_header']
         self.auth_secret = self.config['config']['webhook_secret']
 
@@ -110,51 +130,45 @@ class CrowdStrikeHandler(plugin.PluginTemplate):
             "yellow"
         ))
 
-        # Set up the fields we want to extract
-        event = {
+        # Set up the event, and the fields we want to extract
+        event = Event(source='crowdstrike', src_ip=src, raw=raw_response)
+        details = event.details
+        details.update({
             'action': '',
-            'hostname': '',
             'username': '',
             'url': '',
-            'cli': '',
-            'category': '',
-            'name': '',
-            'src_ip': src
-        }
+        })
 
         # Populate the fields
         #   Raises an exception if the fields don't exist in the webhook
         try:
-            cli = raw_response['data']['detections.command_line']
-            cli = cli.replace("\\\\", "\\")
-            event['action'] = raw_response['data']['detections.action_taken']
-            event['hostname'] = raw_response['data']['detections.hostname']
-            event['username'] = raw_response['data']['detections.user_name']
-            event['url'] = raw_response['data']['detections.url']
-            event['cli'] = cli
-            event['category'] = raw_response['meta']['trigger_category']
-            event['name'] = raw_response['meta']['trigger_name']
+            data = raw_response['data']
+            cli = data['detections.command_line']
+            event.description = cli.replace("\\\\", "\\")
+            details['action'] = data['detections.action_taken']
+            event.device = data['detections.hostname']
+            details['username'] = data['detections.user_name']
+            details['url'] = data['detections.url']
+            event.kind = raw_response['meta']['trigger_category']
+            event.type = raw_response['meta']['trigger_name']
 
         # If the fields don't exist, just send the webhook as is
         except Exception as err:
-            event['text'] = raw_response
-            message = f"Event received: {event['text']}"
+            event.message = f"Event received: {raw_response}"
             print(termcolor.colored(f"Could not parse all fields: {err}"))
 
         # If all is according to plan, formulate an alert
         else:
-            message = f"{event['name']} for \
-                <span style=\"color:Yellow\"><b>{event['username']}</b></span>\
-                on \
-                <b><span style=\"color:Orange\">{event['hostname']}</span></b>\
-                <br>{event['cli']} \
-                <br><a href={event['url']}>See more detail here</a>"
+            event.message = f"{event.type} for \
+                <span style=\"color:Yellow\"><b>{details['username']}</b>\
+                </span> on \
+                <b><span style=\"color:Orange\">{event.device}</span></b>\
+                <br>{event.description} \
+                <br><a href={details['url']}>See more detail here</a>"
 
         # Send the message to Teams
-        teamschat.send_chat(
-            message,
-            self.config['config']['chat_id']
-        )
+        #   There's no SQL table for this plugin yet
+        self.log_events([event])
 
     # Check webhook authentication
     def authenticate(self, request, plugin):
@@ -12,6 +12,7 @@ policy Webhooks {
             arguments {
                 url <DESTINATION>;          <<< The URL to send webhooks to
                 secret <SECRET>;            <<< The webhooks secret
+                window <SECONDS>;           <<< Optional; Batch repeated events (default 10)
             }
         }
     }
@@ -28,99 +29,327 @@ https://www.juniper.net/documentation/us/en/software/junos/automation-scripting/
 
 Assumes junos 21.2R1 and later
 
+Repeated events are coalesced on the box
+    The first trigger of an event waits for the window, then sends one webhook
+    Triggers of the same event during the window are counted, and don't send
+    The webhook carries 'count', 'first', and 'last' for the batch
+    State is kept in /var/tmp, and locked, as each trigger is a new process
+
+Startup is kept lean, as low-end routing engines are slow to import modules
+    Only the standard library is used to send the webhook
+    JunosPyEZ is only imported for events that need to query the device
+    Use tools/agent-benchmark.py to measure the cold-start time
+
+If the server can't be reached, the webhook is spooled to /var/tmp
+    Spooled webhooks are sent after the next successful webhook
+
 '''
 
 
-import requests
 import json
-import argparse
 import hmac
 import hashlib
+import fcntl
+import os
+import sys
+import time
+import urllib.request
 
 from junos import Junos_Trigger_Event
-from jnpr.junos import Device
 
 
-# Collect top 4 CPU users
+# Where coalescing state is kept
+STATE_DIR = '/var/tmp'
+LOCK_FILE = '/var/tmp/webhook-agent.lock'
+
+# Where webhooks are spooled when the server can't be reached
+SPOOL_DIR = '/var/tmp/webhook-spool'
+SPOOL_MAX = 100
+
+# The time (seconds) to wait for the server
+SEND_TIMEOUT = 10
+
+# The number of processes to report, and processes to ignore
+#   flowd_octeon_hm always shows high CPU on SRX, as it polls
+TOP_COUNT = 4
+TOP_IGNORE = ('flowd_octeon_hm',)
+
+
+# Collect top CPU users, with the structured process RPC
+#   JunosPyEZ is slow to import, so it's only imported when needed
 def top():
+    from jnpr.junos import Device
+
     with Device() as jdev:
-        cmd1 = jdev.cli('show system processes extensive')
+        reply = jdev.rpc.get_system_process_information(extensive=True)
 
-    full_list = cmd1.split("\n")
     proc_list = []
-    top_counter = 0
-
-    # Use a range to skip the summary at the beginning
-    for item in full_list[9:-1]:
-        if ('0.00%' not in item) and ('flowd_octeon_hm' not in item):
-            # Only collect the top 4 processes (by CPU)
-            if top_counter >= 4:
-                break
-
-            # Cleanup the data before working with it
-            item = item.strip()
-            item = item.split()
-
-            # Sometimes the command has a space in it
-            # Convert this back into a string
-            if len(item) > 11:
-                item[10] = f"{item[10]} {item[11]}"
-
-            # Save the relevant details as a dictionary
-            # Save the cpu as a float, not a string
-            proc = {
-                'pid': item[0],
-                'user': item[1],
-                'cpu': float(item[9].replace("%", "")),
-                'command': item[10]
-            }
-            proc_list.append(proc)
-            top_counter += 1
+    for proc in reply.iter('process'):
+        proc_list.append({
+            'pid': proc.findtext('pid', '').strip(),
+            'user': proc.findtext('username', '').strip(),
+            'cpu': to_float(proc.findtext('cpu-load', '0')),
+            'command': proc.findtext('command', '').strip()
+        })
+
+    # Some platforms only return the 'top' text in an 'output' element
+    if not proc_list:
+        proc_list = parse_output(reply.findtext('.//output', ''))
+
+    # Only keep busy processes, busiest first
+    proc_list = [
+        proc for proc in proc_list
+        if proc['cpu'] > 0 and proc['command'] not in TOP_IGNORE
+    ]
+    proc_list.sort(key=lambda proc: proc['cpu'], reverse=True)
+
+    return proc_list[:TOP_COUNT]
+
+
+# Convert a CPU value (eg, '12.50%') to a float
+def to_float(value):
+    try:
+        return float(value.replace('%', '').strip())
+    except ValueError:
+        return 0.0
+
+
+# Parse 'top' style text, using the header row to find the columns
+def parse_output(text):
+    lines = text.splitlines()
+    for number, line in enumerate(lines):
+        header = line.split()
+        if 'PID' in header and 'COMMAND' in header:
+            break
+    else:
+        return []
+
+    cpu_col = header.index('WCPU') if 'WCPU' in header else \
+        header.index('CPU')
+    cmd_col = header.index('COMMAND')
+
+    proc_list = []
+    for line in lines[number + 1:]:
+        # The command is last, and may have spaces in it
+        item = line.split(None, cmd_col)
+        if len(item) <= cmd_col:
+            continue
+        proc_list.append({
+            'pid': item[header.index('PID')],
+            'user': item[header.index('USERNAME')]
+            if 'USERNAME' in header else '',
+            'cpu': to_float(item[cpu_col]),
+            'command': item[cmd_col].strip()
+        })
 
     return proc_list
 
 
-# Create a hash, using the body of the request, and a secret
-def create_hash(body, secret):
-    return hmac.new(secret.encode(), body.encode(), hashlib.sha256).hexdigest()
+# Get the state file for an event
+def state_file(event):
+    name = ''.join(
+        char if char.isalnum() or char in '_-' else '_' for char in event
+    )
+    return os.path.join(STATE_DIR, f'webhook-agent-{name}.json')
 
 
-# Setup arguments
-helpmsg = "Junos webhooks agent"
-parser = argparse.ArgumentParser(description=helpmsg)
+# Read and write the state of an event batch
+#   The caller must hold the lock
+def read_state(filename):
+    try:
+        with open(filename) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
 
-parser.add_argument("-url", help="URL to send webhooks to")
-parser.add_argument("-secret", help="URL to send webhooks to")
-args = parser.parse_args()
 
+def write_state(filename, state):
+    with open(filename, 'w') as file:
+        json.dump(state, file)
 
-# Data to send
-data = {
-    'event': Junos_Trigger_Event.xpath('//trigger-event/id')[0].text,
-    'process': Junos_Trigger_Event.xpath('//trigger-event/process/name')[0].text,
-    'message': Junos_Trigger_Event.xpath('//trigger-event/message')[0].text,
-    'hostname': Junos_Trigger_Event.xpath('//trigger-event/hostname')[0].text,
-    'detail': ''
-}
 
-# Add special handling, depending on the event
-if 'RTPERF_CPU' in data['event']:
-    data['detail'] = top()
+# Claim an event batch
+#   Returns True if this trigger should send the webhook (the leader)
+#   Returns False if another trigger is already batching this event
+def claim(event, window):
+    filename = state_file(event)
+    now = time.time()
+
+    with open(LOCK_FILE, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = read_state(filename)
+
+        # A batch is open; Count this trigger, and leave it to the leader
+        #   A batch that is much too old means the leader died; Take over
+        if state and now - state['first'] < window * 2:
+            state['count'] += 1
+            state['last'] = now
+            write_state(filename, state)
+            return False
+
+        write_state(filename, {'count': 1, 'first': now, 'last': now})
+        return True
+
+
+# Close an event batch, and return its count and times
+def close(event):
+    filename = state_file(event)
+
+    with open(LOCK_FILE, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = read_state(filename)
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    if state is None:
+        now = time.time()
+        state = {'count': 1, 'first': now, 'last': now}
 
-body = json.dumps(data)
-auth_header = create_hash(body, args.secret)
+    return {
+        'count': state['count'],
+        'first': time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(state['first'])
+        ),
+        'last': time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(state['last'])
+        )
+    }
+
+
+# Create a hash, using the body of the request, and a secret
+def create_hash(body, secret):
+    return hmac.new(secret.encode(), body.encode(), hashlib.sha256).hexdigest()
 
 
-# Send information as a webhook
-try:
-    req = requests.post(
-        args.url,
-        data=body,
+# Send a webhook with the standard library HTTP client
+#   Returns True if the server accepted it
+def send(url, body, auth_header):
+    request = urllib.request.Request(
+        url,
+        data=body.encode(),
         headers={
             'Content-type': 'application/json',
             'Junos-Auth': auth_header
-        }
+        },
+        method='POST'
     )
-except Exception as err:
-    print("Error occurred sending the webhook")
-    print(err)
+
+    try:
+        with urllib.request.urlopen(request, timeout=SEND_TIMEOUT) as reply:
+            return 200 <= reply.status < 300
+    except Exception as err:
+        print("Error occurred sending the webhook")
+        print(err)
+        return False
+
+
+# Save a webhook that couldn't be sent
+#   The oldest are removed if the spool is full
+def spool(body, auth_header):
+    try:
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        files = sorted(os.listdir(SPOOL_DIR))
+        for old in files[:max(0, len(files) - SPOOL_MAX + 1)]:
+            os.remove(os.path.join(SPOOL_DIR, old))
+
+        filename = os.path.join(
+            SPOOL_DIR,
+            f'{time.time():.6f}-{os.getpid()}.json'
+        )
+        with open(filename, 'w') as file:
+            json.dump({'body': body, 'auth': auth_header}, file)
+
+    except OSError as err:
+        print("Could not spool the webhook")
+        print(err)
+
+
+# Send spooled webhooks, oldest first
+#   Stops at the first failure, so the order is kept
+def flush(url):
+    try:
+        files = sorted(os.listdir(SPOOL_DIR))
+    except OSError:
+        return
+
+    for name in files:
+        filename = os.path.join(SPOOL_DIR, name)
+        try:
+            with open(filename) as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            continue
+
+        if not send(url, saved['body'], saved['auth']):
+            return
+
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+# Read the arguments (eg, '-url x -secret y -window 10')
+#   Done by hand, as argparse is slow to import
+def parse_args(argv):
+    args = {'url': None, 'secret': None, 'window': '10'}
+    for number, item in enumerate(argv[:-1]):
+        name = item.lstrip('-')
+        if item.startswith('-') and name in args:
+            args[name] = argv[number + 1]
+
+    if args['url'] is None or args['secret'] is None:
+        print("Usage: agent.py -url <URL> -secret <SECRET> [-window <SEC>]")
+        raise SystemExit(1)
+
+    args['window'] = int(args['window'])
+    return args
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    # Data to send
+    data = {
+        'event': Junos_Trigger_Event.xpath('//trigger-event/id')[0].text,
+        'process':
+            Junos_Trigger_Event.xpath('//trigger-event/process/name')[0].text,
+        'message':
+            Junos_Trigger_Event.xpath('//trigger-event/message')[0].text,
+        'hostname':
+            Junos_Trigger_Event.xpath('//trigger-event/hostname')[0].text,
+        'detail': ''
+    }
+
+    # Batch repeats of this event
+    #   Only the first trigger in the window continues
+    if args['window'] > 0 and not claim(data['event'], args['window']):
+        return
+
+    # Add special handling, depending on the event
+    if 'RTPERF_CPU' in data['event']:
+        data['detail'] = top()
+
+    # Wait for repeats, then add the count and times to the webhook
+    if args['window'] > 0:
+        time.sleep(args['window'])
+        data.update(close(data['event']))
+    else:
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        data.update({'count': 1, 'first': now, 'last': now})
+
+    body = json.dumps(data)
+    auth_header = create_hash(body, args['secret'])
+
+    # Send information as a webhook
+    #   Spool it if the server can't be reached, or send the backlog if it can
+    if send(args['url'], body, auth_header):
+        flush(args['url'])
+    else:
+        spool(body, auth_header)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+"""
+Caches Junos device facts (hostname, model, version, RE status)
+
+Connections are opened without gathering facts, as that takes several
+    RPCs for every connection
+Instead, facts are read from this cache, which is kept in memory and
+    saved to disk
+Stale entries are still returned, and refreshed in the background
+
+Modules:
+    3rd Party: termcolor, threading, json, os, time
+    Internal: core/crypto, plugins/junos/netconf
+
+Classes:
+
+    FactsCache
+        Keeps device facts in memory and on disk
+
+Functions
+
+    facts_settings()
+        Get the facts cache settings
+    get_facts()
+        Get the facts for a device
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    FACTS_DEFAULTS : dict
+        Default settings, overridden by the 'facts' section of the config
+    FACT_KEYS : list
+        The facts that are cached
+    cache : FactsCache
+        The shared facts cache
+
+Limitations:
+    Only the facts in FACT_KEYS are cached
+    Background refreshes need the device password in the secrets file
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import termcolor
+import threading
+import json
+import os
+import time
+
+from core import crypto
+from plugins.junos import netconf
+
+
+# Default facts cache settings
+#   These can be overridden in the 'facts' section of junos-config.yaml
+FACTS_DEFAULTS = {
+    # How long (seconds) facts are fresh for
+    'ttl': 86400,
+    # The file the cache is saved in
+    'cache_file': 'junos_facts.json',
+}
+
+
+# The facts that are cached
+#   PyEZ gathers facts lazily, so only these are collected
+FACT_KEYS = [
+    'hostname',
+    'model',
+    'version',
+    'serialnumber',
+    'master',
+    'RE0',
+    'RE1',
+]
+
+
+def facts_settings():
+    '''
+    Gets the facts cache settings
+    Defaults are overridden by the 'facts' section of the plugin config
+
+        Parameters:
+            None
+
+        Returns:
+            settings : dict
+                The facts cache settings
+    '''
+
+    return {**FACTS_DEFAULTS, **netconf.plugin_config('facts')}
+
+
+class FactsCache():
+    """Keeps device facts in memory and on disk
+
+    Entries older than the TTL are stale
+    Stale entries are returned straight away, and refreshed in the background
+
+    Attributes
+    ----------
+    entries : dict
+        Cached facts, and when they were collected, keyed by device
+    refreshing : set
+        Devices with a background refresh running
+
+    Methods
+    -------
+    get()
+        Get the facts for a device
+    gather()
+        Collect facts from an open connection, and cache them
+    refresh()
+        Collect facts in the background
+    expire()
+        Mark a device's facts as stale
+    load()
+        Load the cache from disk
+    save()
+        Write the cache to disk
+    """
+
+    def __init__(self):
+        """Class constructor
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.lock = threading.RLock()
+        self.entries = None
+        self.refreshing = set()
+
+    def get(self, host, dev=None):
+        """Get the facts for a device
+
+        If there is no entry, and a connection is given, facts are
+            collected from the connection
+        If the entry is stale, it's returned, and refreshed in the background
+
+        Parameters
+        ----------
+        host : str
+            The device name
+        dev : jnpr.junos.Device
+            Optional; An open connection to the device
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        facts : dict
+            The device facts (empty if they're not known yet)
+        """
+
+        settings = facts_settings()
+        key = host.lower()
+
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+
+        # Nothing cached; Use the connection if we have one
+        if entry is None:
+            if dev is not None:
+                return self.gather(host, dev)
+            self.refresh(host)
+            return {}
+
+        # Stale; Refresh in the background, and use what we have for now
+        if time.time() - entry['updated'] > settings['ttl']:
+            self.refresh(host)
+
+        return entry['facts']
+
+    def gather(self, host, dev):
+        """Collect facts from an open connection, and cache them
+
+        Parameters
+        ----------
+        host : str
+            The device name
+        dev : jnpr.junos.Device
+            An open connection to the device
+
+        Raises
+        ------
+        Exception
+            If a fact can't be collected (handled here)
+
+        Returns
+        -------
+        facts : dict
+            The device facts
+        """
+
+        facts = {}
+        for name in FACT_KEYS:
+            try:
+                facts[name] = dev.facts[name]
+            except Exception as err:
+                print(termcolor.colored(
+                    f"Could not get the '{name}' fact from {host}: {err}",
+                    "yellow"
+                ))
+                facts[name] = None
+
+        with self.lock:
+            self.load()
+            self.entries[host.lower()] = {
+                'facts': facts,
+                'updated': time.time(),
+            }
+
+        self.save()
+        return facts
+
+    def refresh(self, host):
+        """Collect facts in the background
+
+        Only one refresh runs for a device at a time
+
+        Parameters
+        ----------
+        host : str
+            The device name
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        key = host.lower()
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        thread = threading.Thread(
+            target=self.background,
+            args=(host,),
+            daemon=True
+        )
+        thread.start()
+
+    def background(self, host):
+        """Connect to a device, and collect its facts
+
+        Runs in a background thread
+
+        Parameters
+        ----------
+        host : str
+            The device name
+
+        Raises
+        ------
+        Exception
+            If the device can't be reached (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        try:
+            secret = crypto.pw_decrypt(dev_type='junos', device=host)
+            if secret:
+                with netconf.pool.session(
+                    host,
+                    secret['user'],
+                    secret['password']
+                ) as dev:
+                    self.gather(host, dev)
+
+        except Exception as err:
+            print(termcolor.colored(
+                f"Could not refresh facts for {host}: {repr(err)}",
+                "yellow"
+            ))
+
+        finally:
+            with self.lock:
+                self.refreshing.discard(host.lower())
+
+    def expire(self, host):
+        """Mark a device's facts as stale
+        Used when something changes the device (eg, a reboot)
+
+        Parameters
+        ----------
+        host : str
+            The device name
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            self.load()
+            entry = self.entries.get(host.lower())
+            if entry is not None:
+                entry['updated'] = 0
+
+        self.save()
+
+    def load(self):
+        """Load the cache from disk, if it hasn't been loaded yet
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        Exception
+            If the cache file can't be read (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            if self.entries is not None:
+                return
+
+            self.entries = {}
+            try:
+                with open(facts_settings()['cache_file']) as file:
+                    self.entries = json.load(file)
+            except FileNotFoundError:
+                pass
+            except Exception as err:
+                print(termcolor.colored(
+                    f"Could not load the facts cache: {err}",
+                    "red"
+                ))
+
+    def save(self):
+        """Write the cache to disk
+
+        The file is replaced in one step, so a crash can't leave it half
+            written
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        Exception
+            If the file can't be written (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        filename = facts_settings()['cache_file']
+        with self.lock:
+            try:
+                with open(filename + '.tmp', 'w') as file:
+                    json.dump(self.entries, file, indent=2, default=str)
+                os.replace(filename + '.tmp', filename)
+
+            except Exception as err:
+                print(termcolor.colored(
+                    f"Could not save the facts cache: {err}",
+                    "red"
+                ))
+
+
+# The shared facts cache
+cache = FactsCache()
+
+
+def get_facts(host, dev=None):
+    '''
+    Gets the facts for a device from the cache
+
+        Parameters:
+            host : str
+                The device name
+            dev : jnpr.junos.Device
+                Optional; An open connection, used if nothing is cached
+
+        Returns:
+            facts : dict
+                The device facts (empty if they're not known yet)
+    '''
+
+    return cache.get(host, dev)
@@ -0,0 +1,693 @@
+"""
+Runs an action against a fleet of Junos devices
+    Eg, rebooting many switches, or restarting a process on many devices
+Limits how many devices are worked on at once, globally and per site
+Supports rolling batches, so a large change happens a few devices at a time
+Collects results, and reports progress in a single Teams message
+
+Modules:
+    3rd Party: termcolor, yaml, threading, concurrent.futures, time
+    Internal: core/teamschat, core/crypto, config, plugins/junos/netconf
+
+Classes:
+
+    FleetProgress
+        Keeps a single Teams message up to date with progress
+    FleetExecutor
+        Runs an action against a list of devices
+
+Functions
+
+    fleet_settings()
+        Get the fleet settings
+    site_map()
+        Map device names to the site they're in
+    shared_pool()
+        Get the worker pool shared by all fleets
+    site_submit()
+        Run a function on the pool, when its site has a free slot
+    site_run()
+        Run a queued function, then start the site's next one
+
+Exceptions:
+
+    None
+
+Misc Variables:
+
+    FLEET_DEFAULTS : dict
+        Default settings, overridden by the 'fleet' section of the config
+    pool : ThreadPoolExecutor
+        The worker pool shared by all fleets (created when first needed)
+    site_running : dict
+        The number of functions running for each site, across all fleets
+    site_queues : dict
+        Functions waiting for a free slot in each site
+
+Limitations:
+    Actions must accept 'device', 'user', 'password', and 'chat_id'
+    Actions must return a dictionary with 'ok' (bool) and 'message' (str)
+    Sites come from the devices file; Unknown devices are their own site
+    The limits are shared by all fleets, so 'max_workers' and 'per_site'
+        come from the config, and can't be overridden for one fleet
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+
+import termcolor
+import threading
+import time
+import yaml
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from core import teamschat
+from core import crypto
+from config import LANGUAGE
+from plugins.junos import netconf
+
+
+# Default fleet settings
+#   These can be overridden in the 'fleet' section of junos-config.yaml
+FLEET_DEFAULTS = {
+    # The most devices worked on at once, across all sites
+    'max_workers': 10,
+    # The most devices worked on at once, within a single site
+    'per_site': 2,
+    # Devices per rolling batch (0 means a single batch)
+    'batch_size': 0,
+    # Stop starting new batches if a batch had a failure
+    'halt_on_failure': True,
+    # The minimum time (seconds) between Teams progress updates
+    'update_interval': 5,
+}
+
+# Shared by all fleets, so two fleets running at once (eg, two reboot
+#   commands) still keep within the global and per-site limits
+#   Work for a busy site waits in its queue, not in a worker thread, so
+#   one large site can't hold every worker
+pool = None
+site_running = {}
+site_queues = {}
+shared_lock = threading.Lock()
+
+
+def fleet_settings():
+    '''
+    Gets the fleet settings
+    Defaults are overridden by the 'fleet' section of the plugin config
+
+        Parameters:
+            None
+
+        Returns:
+            settings : dict
+                The fleet settings
+    '''
+
+    return {**FLEET_DEFAULTS, **netconf.plugin_config('fleet')}
+
+
+def site_map():
+    '''
+    Maps device names to the site they are in
+    Uses the same devices file as the NLP engine
+
+        Parameters:
+            None
+
+        Raises:
+            Exception
+                If the devices file can't be read (handled here)
+
+        Returns:
+            sites : dict
+                Lower case device names, and the site they're in
+    '''
+
+    sites = {}
+    try:
+        with open(LANGUAGE['device_file']) as file:
+            for entry in yaml.safe_load_all(file):
+                if entry['devices'] is None:
+                    continue
+                for device in entry['devices']:
+                    sites[device.lower()] = entry['site']
+
+    except Exception as err:
+        print(termcolor.colored(
+            f"Fleet: Could not load the devices file: {err}",
+            "red"
+        ))
+
+    return sites
+
+
+def shared_pool():
+    '''
+    Gets the worker pool shared by all fleets
+    The pool is created the first time it's needed
+
+        Parameters:
+            None
+
+        Raises:
+            None
+
+        Returns:
+            pool : ThreadPoolExecutor
+                The shared worker pool
+    '''
+
+    global pool
+    with shared_lock:
+        if pool is None:
+            pool = ThreadPoolExecutor(
+                max_workers=max(1, fleet_settings()['max_workers']),
+                thread_name_prefix='fleet'
+            )
+
+    return pool
+
+
+def site_submit(site, function, *args):
+    '''
+    Runs a function on the shared pool, when its site has a free slot
+    If the site is busy, the function waits in the site's queue
+        It's submitted when a function for the same site finishes
+
+        Parameters:
+            site : str
+                The site the work is in
+            function : function
+                The function to run
+            args : tuple
+                Arguments for the function
+
+        Raises:
+            None
+
+        Returns:
+            future : Future
+                Completes when the function has run
+    '''
+
+    future = Future()
+    job = (future, function, args)
+    limit = max(1, fleet_settings()['per_site'])
+
+    with shared_lock:
+        if site_running.get(site, 0) >= limit:
+            site_queues.setdefault(site, deque()).append(job)
+            return future
+        site_running[site] = site_running.get(site, 0) + 1
+
+    shared_pool().submit(site_run, site, job)
+    return future
+
+
+def site_run(site, job):
+    '''
+    Runs a function for a site, then starts the next one in its queue
+    The site's slot is handed straight to the next function, or freed
+
+        Parameters:
+            site : str
+                The site the work is in
+            job : tuple
+                The future, function, and arguments (from site_submit())
+
+        Raises:
+            Exception
+                If the function fails (handled here, and set on the future)
+
+        Returns:
+            None
+    '''
+
+    future, function, args = job
+    try:
+        future.set_result(function(*args))
+    except Exception as err:
+        future.set_exception(err)
+
+    finally:
+        with shared_lock:
+            waiting = site_queues.get(site)
+            following = waiting.popleft() if waiting else None
+            if following is None:
+                site_running[site] -= 1
+
+        if following is not None:
+            shared_pool().submit(site_run, site, following)
+
+
+class FleetProgress():
+    """Keeps a single Teams message up to date with fleet progress
+
+    The message is posted when the fleet starts, and then edited
+    Edits are rate limited, so many devices finishing at once only
+        cause one update
+
+    Attributes
+    ----------
+    chat_id : str
+        The chat to report to
+    title : str
+        A description of the action
+    devices : dict
+        The status and result message for each device
+    message_id : str
+        The ID of the Teams message, once it has been posted
+    interval : int
+        The minimum time (seconds) between updates
+
+    Methods
+    -------
+    render()
+        Build the HTML progress message
+    post()
+        Send the first progress message
+    update()
+        Record a device status, and update Teams if it's time to
+    flush()
+        Update the Teams message
+    finish()
+        Send the final update
+    """
+
+    def __init__(self, chat_id, title, devices, interval):
+        """Class constructor
+
+        Parameters
+        ----------
+        chat_id : str
+            The chat to report to
+        title : str
+            A description of the action
+        devices : list
+            The devices in the fleet
+        interval : int
+            The minimum time (seconds) between updates
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.chat_id = chat_id
+        self.title = title
+        self.devices = {
+            device: {'status': 'queued', 'message': ''}
+            for device in devices
+        }
+        self.message_id = None
+        self.interval = interval
+        self.last_update = 0
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def render(self, final=False):
+        """Build the HTML progress message
+
+        Parameters
+        ----------
+        final : bool
+            If this is the final message, list every device
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        message : str
+            The message to send to Teams
+        """
+
+        with self.lock:
+            states = dict(self.devices)
+
+        counts = {}
+        for state in states.values():
+            counts[state['status']] = counts.get(state['status'], 0) + 1
+
+        summary = ', '.join(
+            f"{status}: {count}" for status, count in sorted(counts.items())
+        )
+        elapsed = time.monotonic() - self.start
+        heading = 'Finished' if final else 'In progress'
+
+        message = f"<b>{self.title}</b> - {heading} \
+            ({len(states)} devices, {elapsed:.0f}s)<br>{summary}"
+
+        # Always list failures and running devices
+        # The full list is only shown when everything has finished
+        for device, state in states.items():
+            if state['status'] == 'failed':
+                message += f"<br><span style=\"color:Red\">{device}</span>: \
+                    {state['message']}"
+            elif state['status'] == 'running':
+                message += f"<br><span style=\"color:Yellow\">{device}\
+                    </span>: running"
+            elif final and state['status'] == 'done':
+                message += f"<br><span style=\"color:Lime\">{device}</span>: \
+                    {state['message']}"
+            elif final and state['status'] == 'skipped':
+                message += f"<br>{device}: skipped"
+
+        return message
+
+    def post(self):
+        """Send the first progress message
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        result = teamschat.send_chat(self.render(), self.chat_id)
+        if result:
+            self.message_id = result['id']
+        self.last_update = time.monotonic()
+
+    def update(self, device, status, message=''):
+        """Record a device status, and update Teams if it's time to
+
+        Parameters
+        ----------
+        device : str
+            The device name
+        status : str
+            queued, running, done, failed, or skipped
+        message : str
+            The result message from the action
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            self.devices[device] = {'status': status, 'message': message}
+            due = time.monotonic() - self.last_update >= self.interval
+            if due:
+                self.last_update = time.monotonic()
+
+        if due:
+            self.flush()
+
+    def flush(self, final=False):
+        """Update the Teams message
+
+        If the first message could not be posted, a new one is sent
+
+        Parameters
+        ----------
+        final : bool
+            If this is the final update
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        message = self.render(final=final)
+        if self.message_id is None or not teamschat.update_chat(
+            message,
+            self.chat_id,
+            self.message_id
+        ):
+            result = teamschat.send_chat(message, self.chat_id)
+            if result:
+                self.message_id = result['id']
+
+    def finish(self):
+        """Send the final update
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.flush(final=True)
+
+
+class FleetExecutor():
+    """Runs an action against a list of devices
+
+    Concurrency is limited globally by a pool of worker threads,
+        and per site by a semaphore for each site
+    The pool and site slots are shared with other fleets (see
+        shared_pool() and site_submit())
+    Devices are worked on in rolling batches; The next batch starts
+        when the current one has finished
+    Credentials are looked up by the workers, not all up front
+
+    Attributes
+    ----------
+    action : function
+        The function to run for each device
+    chat_id : str
+        The chat to report to
+    title : str
+        A description of the action, used in the progress message
+    settings : dict
+        The fleet settings
+    results : dict
+        The result for each device
+
+    Methods
+    -------
+    start()
+        Run the fleet in a background thread
+    run()
+        Run the action against each device, and wait for the results
+    work()
+        Run the action against a single device
+    """
+
+    def __init__(self, action, chat_id, title, **settings):
+        """Class constructor
+
+        Parameters
+        ----------
+        action : function
+            The function to run for each device
+        chat_id : str
+            The chat to report to
+        title : str
+            A description of the action
+        settings : dict
+            Optional; Overrides for the fleet settings
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.action = action
+        self.chat_id = chat_id
+        self.title = title
+        self.settings = {**fleet_settings(), **settings}
+        self.results = {}
+
+    def start(self, devices, **kwargs):
+        """Run the fleet in a background thread
+
+        Parameters
+        ----------
+        devices : list
+            The devices to run the action against
+        kwargs : dict
+            Extra arguments for the action
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        thread : threading.Thread
+            The thread running the fleet
+        """
+
+        thread = threading.Thread(
+            target=self.run,
+            args=(devices,),
+            kwargs=kwargs
+        )
+        thread.start()
+        return thread
+
+    def run(self, devices, **kwargs):
+        """Run the action against each device, and wait for the results
+
+        Parameters
+        ----------
+        devices : list
+            The devices to run the action against
+        kwargs : dict
+            Extra arguments for the action
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        results : dict
+            The result for each device
+        """
+
+        # Remove duplicates, but keep the order
+        devices = list(dict.fromkeys(devices))
+        if not devices:
+            return self.results
+
+        sites = site_map()
+        progress = FleetProgress(
+            self.chat_id,
+            self.title,
+            devices,
+            self.settings['update_interval']
+        )
+        progress.post()
+
+        # Split the devices into rolling batches
+        size = self.settings['batch_size'] or len(devices)
+        batches = [
+            devices[i:i + size] for i in range(0, len(devices), size)
+        ]
+
+        for number, batch in enumerate(batches):
+            print(termcolor.colored(
+                f"{self.title}: batch {number + 1} of {len(batches)}",
+                "green"
+            ))
+
+            futures = [
+                site_submit(
+                    sites.get(device.lower(), device),
+                    self.work,
+                    device,
+                    progress,
+                    kwargs
+                )
+                for device in batch
+            ]
+            wait(futures)
+
+            # Stop here if this batch had problems
+            failed = [
+                device for device in batch
+                if not self.results.get(device, {}).get('ok')
+            ]
+            if failed and self.settings['halt_on_failure']:
+                for later in batches[number + 1:]:
+                    for device in later:
+                        self.results[device] = {
+                            'ok': False,
+                            'message': 'skipped'
+                        }
+                        progress.update(device, 'skipped')
+                break
+
+        progress.finish()
+        return self.results
+
+    def work(self, device, progress, kwargs):
+        """Run the action against a single device
+
+        A result is always recorded, even if the action fails
+
+        Parameters
+        ----------
+        device : str
+            The device to run the action against
+        progress : FleetProgress
+            The progress tracker
+        kwargs : dict
+            Extra arguments for the action
+
+        Raises
+        ------
+        Exception
+            If the action fails unexpectedly (handled here)
+
+        Returns
+        -------
+        None
+        """
+
+        result = None
+        try:
+            progress.update(device, 'running')
+
+            secret = crypto.pw_decrypt(dev_type='junos', device=device)
+            if not secret:
+                result = {
+                    'ok': False,
+                    'message': 'Could not get credentials'
+                }
+
+            else:
+                result = self.action(
+                    device=device,
+                    user=secret['user'],
+                    password=secret['password'],
+                    chat_id=self.chat_id,
+                    **kwargs
+                )
+
+        except Exception as err:
+            result = {'ok': False, 'message': repr(err)}
+
+        # Actions that return nothing (or not a dictionary) have failed
+        finally:
+            if not isinstance(result, dict):
+                result = {
+                    'ok': False,
+                    'message': f"The action returned {result!r}"
+                }
+
+            self.results[device] = result
+            progress.update(
+                device,
+                'done' if result.get('ok') else 'failed',
+                result.get('message', '')
+            )
@@ -18,9 +18,10 @@ Author:
 
 
 # import yaml
-from core import teamschat
 from core import plugin
-from datetime import datetime
+from core import severity
+from core.event import Event
+from typing import Any
 import termcolor
 import yaml
 
@@ -29,12 +30,25 @@ import yaml
 LOCATION = 'plugins\\junos\\junos-config.yaml'
 ENTITIES = 'plugins\\junos\\entities.yaml'
 
+# The webhook fields the agent sends (see core/decode.py)
+PAYLOAD_SCHEMA = {
+    'event': str,
+    'process': Any,
+    'message': str,
+    'hostname': str,
+    'detail': Any,
+    'count': int,
+    'first': Any,
+    'last': Any,
+}
+
 
 # Junos handler class
 class JunosHandler(plugin.PluginTemplate):
     def __init__(self):
         super().__init__(LOCATION)
         self.table = self.config['config']['sql_table']
+        self.schema = PAYLOAD_SCHEMA
         self.ftp_server = self.config['config']['ftp_server']
         self.ftp_dir = self.config['config']['ftp_dir']
         self.phrase_list = [
@@ -69,84 +83,79 @@ class JunosHandler(plugin.PluginTemplate):
 
     # Handle the event as it comes in
     def handle_event(self, raw_response, src):
-        # Add the sending IP to the event
-        raw_response['source'] = src
+        # Build an event from the webhook
+        event = Event(
+            source='junos',
+            type=raw_response['event'],
+            device=raw_response['hostname'],
+            src_ip=src,
+            raw=raw_response
+        )
 
         # Assign a priority to the event
-        self.alert_priority(raw_response)
+        self.alert_priority(event)
 
         # Cleanup the message string
-        raw_response['message'] = \
-            raw_response['message'].replace(raw_response['event'], "")
-        raw_response['message'] = raw_response['message'].replace("'", "")
+        event.description = raw_response['message'].replace(event.type, "")
+
+        # The agent batches repeats of an event together
+        repeats = self.repeats(raw_response)
 
         # Depending on priority,
         # print event to terminal and prepare message for Teams
-        match raw_response['level']:
+        match event.level:
             # Priority 1
             case 1:
                 # Sometimes the agent gives us extra detail
-                if ('detail' in raw_response) and \
-                  (raw_response['detail'] != ''):
-                    message = f"{raw_response['message']} on \
+                if raw_response.get('detail', '') != '':
+                    event.message = f"{event.description} on \
                         <span style=\"color:Lime\"><b> \
-                        {raw_response['hostname']}</b></span><br> \
+                        {event.device}</b></span>{repeats}<br> \
                         {raw_response['detail']}"
                 else:
-                    message = f"{raw_response['message']} on \
+                    event.message = f"{event.description} on \
                         <span style=\"color:Lime\"><b> \
-                        {raw_response['hostname']}</b></span>"
-                self.log(message, raw_response)
+                        {event.device}</b></span>{repeats}"
+                self.log(event)
 
             # Priority 2
             case 2:
-                message = f"{raw_response['message']} on \
+                event.message = f"{event.description} on \
                     <span style=\"color:Lime\"><b> \
-                    {raw_response['hostname']}</b></span>"
-                self.log(message, raw_response)
+                    {event.device}</b></span>{repeats}"
+                self.log(event)
 
             # Priority 3
             case 3:
-                print('Junos event:', raw_response)
+                print('Junos event:', event)
 
             # Any other priority (4, or some error has occurred)
             case _:
                 pass
 
+    # Describe a batch of repeated events
+    # Older agents don't batch events, so there may be no count
+    def repeats(self, webhook):
+        count = webhook.get('count', 1)
+        if count <= 1:
+            return ''
+
+        return f"<br>Seen {count} times, from {webhook['first']} \
+            to {webhook['last']}"
+
+    # Compile the priority rules, when the config is loaded
+    def compile_config(self):
+        self.classifier = severity.Classifier(self.config.get('events'))
+
     # Assign a priority to an event
-    def alert_priority(self, webhook):
-        if webhook['event'] in self.config['events']:
-            webhook['level'] = self.config['events'][webhook['event']]
-        else:
-            webhook['level'] = 1
+    # Supports exact, prefix (NAME*), and keyword rules (see core.severity)
+    def alert_priority(self, event):
+        event.level = self.classifier.classify(
+            event.type,
+            event.raw.get('message', '')
+        )
 
     # Log to SQL and terminal, send to teams
-    def log(self, message, event):
-        date = datetime.now().date()
-        time = datetime.now().time().strftime("%H:%M:%S")
-
-        try:
-            chat_id = teamschat.send_chat(
-                message,
-                self.config['config']['chat_id']
-            )['id']
-            print(termcolor.colored(f"Junos event: {event}", "yellow"))
-        except Exception as err:
-            print(termcolor.colored("Error with Teams chat ID", "red"))
-            print(termcolor.colored(err, "red"))
-            return
-
-        fields = {
-            'device': f"'{event['hostname']}'",
-            'event': f"'{event['event']}'",
-            'description': f"'{event['message']}'",
-            'logdate': f"'{date}'",
-            'logtime': f"'{time}'",
-            'source': f"{self.ip2integer(event['source'])}",
-            'message': f"'{chat_id}'"
-        }
-
-        self.sql_write(
-            database=self.config['config']['sql_table'],
-            fields=fields
-        )
+    def log(self, event):
+        print(termcolor.colored(f"Junos event: {event}", "yellow"))
+        self.log_events([event])
@@ -2,8 +2,11 @@
 Supporting functions to connect to a junos device
 
 Usage:
-    Call junos_connect() to connnect to a device
+    Call junos_connect() to lease a connection to a device from the pool
+    Call junos_disconnect() to return the connection to the pool
+    Use 'with pool.session(host, user, password) as dev:' in new code
     Call send_shell() to send a shell command to a device
+    Use a ShellSession to send several commands over one shell
 
 Authentication:
     Supports username and password for login to NETCONF over SSH
@@ -22,61 +25,857 @@ Author:
 """
 
 import termcolor
+import threading
+import time
+import re
+import select
+from contextlib import contextmanager
 from jnpr.junos import Device
 from jnpr.junos.utils.start_shell import StartShell
 import jnpr.junos.exception
 from core import teamschat
+from config import plugin_list
+
+
+# Default connection pool settings
+#   These can be overridden in the 'netconf' section of junos-config.yaml
+POOL_DEFAULTS = {
+    # The most sessions that can be open to a single device at once
+    'max_per_host': 2,
+    # Close sessions that have not been used for this many seconds
+    'idle_timeout': 300,
+    # Check a session still works if it has been idle this long (seconds)
+    'health_interval': 60,
+    # How long to wait for a free session to a busy device (seconds)
+    'lease_timeout': 600,
+}
+
+
+# Get a section of the Junos plugin config
+def plugin_config(section):
+    '''
+    Finds the Junos plugin in the plugin list, and returns a config section
+
+        Parameters:
+            section : str
+                The name of the section in junos-config.yaml
+
+        Returns:
+            : dict
+                The config section (empty if it does not exist)
+    '''
+
+    for plugin in plugin_list:
+        if 'Junos' in plugin['name']:
+            return plugin['handler'].config.get(section) or {}
+
+    return {}
+
+
+class PooledSession():
+    """A NETCONF session held by the connection pool
+
+    Attributes
+    ----------
+    dev : jnpr.junos.Device
+        The open device connection
+    host : str
+        The host the session is connected to
+    user : str
+        The user the session authenticated as
+    last_used : float
+        When the session was last returned to the pool (monotonic)
+    discard : bool
+        Close the session instead of returning it to the pool
+    """
+
+    def __init__(self, dev, host, user):
+        self.dev = dev
+        self.host = host
+        self.user = user
+        self.last_used = time.monotonic()
+        self.discard = False
+
+
+class SessionPool():
+    """A pool of NETCONF sessions, keyed by host
+
+    Opening a session costs an SSH key exchange, authentication, and
+        fact gathering. The pool keeps sessions open between operations,
+        so repeated operations against a device reuse a warm session
+
+    Sessions are leased, and must be returned when finished with
+    A per-host limit stops too many sessions being opened to one device
+    Idle sessions are health checked before reuse, and closed when they
+        have not been used for a while
+
+    Attributes
+    ----------
+    idle : dict
+        Idle sessions for each host (a list of PooledSession objects)
+    leased : dict
+        Sessions currently in use, keyed by the id() of the device object
+    limits : dict
+        A semaphore for each host, limiting concurrent sessions
+
+    Methods
+    -------
+    settings()
+        Get the current pool settings
+    lease()
+        Lease a session to a host
+    release()
+        Return a session to the pool
+    invalidate()
+        Mark a leased session to be closed when it is returned
+    session()
+        Context manager to lease and return a session
+    reap()
+        Close sessions that have been idle too long
+    close_all()
+        Close all idle sessions
+    """
+
+    def __init__(self):
+        """Class constructor
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.leased = {}
+        self.limits = {}
+        self.reaper = None
+
+    def settings(self):
+        """Get the pool settings
+
+        Defaults are overridden by the 'netconf' section of the plugin config
+        This is read each time, so config refreshes take effect
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        settings : dict
+            The pool settings
+        """
+
+        return {**POOL_DEFAULTS, **plugin_config('netconf')}
+
+    def limit(self, host, settings):
+        """Get the semaphore that limits sessions to a host
+
+        Parameters
+        ----------
+        host : str
+            The host to get the semaphore for
+        settings : dict
+            The pool settings
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        limit : threading.BoundedSemaphore
+            The semaphore for this host
+        """
+
+        with self.lock:
+            if host not in self.limits:
+                self.limits[host] = threading.BoundedSemaphore(
+                    settings['max_per_host']
+                )
+            return self.limits[host]
+
+    def healthy(self, entry, settings):
+        """Check that an idle session still works
+
+        A session that has only been idle briefly is trusted
+        Otherwise, a cheap RPC confirms the session is still alive
+
+        Parameters
+        ----------
+        entry : PooledSession
+            The session to check
+        settings : dict
+            The pool settings
+
+        Raises
+        ------
+        Exception
+            If the RPC fails (handled here)
+
+        Returns
+        -------
+        True : bool
+            If the session can be used
+        False : bool
+            If the session should be closed
+        """
+
+        if not entry.dev.connected:
+            return False
+
+        if time.monotonic() - entry.last_used < settings['health_interval']:
+            return True
+
+        try:
+            entry.dev.rpc.get_system_uptime_information()
+        except Exception as err:
+            print(termcolor.colored(
+                f"Pooled session to {entry.host} failed a health check: \
+                    {repr(err)}",
+                "yellow"
+            ))
+            return False
+
+        return True
+
+    def lease(self, host, user, password, **kwargs):
+        """Lease a session to a host
+
+        Reuses a healthy idle session if there is one
+        Otherwise, opens a new session
+        If the host already has the maximum sessions open, this waits for
+            one to be returned
+
+        Parameters
+        ----------
+        host : str
+            The host to connect to
+        user : str
+            The username to authenticate with
+        password : str
+            The password to authenticate with
+        kwargs : dict
+            Extra arguments to pass to Device() when opening a new session
+
+        Raises
+        ------
+        TimeoutError
+            If no session became free in time
+        jnpr.junos.exception.ConnectError
+            If a new session could not be opened
+
+        Returns
+        -------
+        dev : jnpr.junos.Device
+            An open device connection
+        """
+
+        settings = self.settings()
+        limit = self.limit(host, settings)
+        if not limit.acquire(timeout=settings['lease_timeout']):
+            raise TimeoutError(
+                f"Timed out waiting for a free session to {host}"
+            )
+
+        # Look for an idle session that can be reused
+        while True:
+            with self.lock:
+                idle = self.idle.get(host, [])
+                entry = idle.pop() if idle else None
+
+            if entry is None:
+                break
+
+            if entry.user == user and self.healthy(entry, settings):
+                with self.lock:
+                    self.leased[id(entry.dev)] = entry
+                return entry.dev
+
+            self.close(entry)
+
+        # There are no idle sessions, so open a new one
+        #   Facts are not gathered here; They come from the facts cache
+        kwargs.setdefault('gather_facts', False)
+        try:
+            dev = Device(host, user=user, password=password, **kwargs).open()
+        except Exception:
+            limit.release()
+            raise
+
+        with self.lock:
+            self.leased[id(dev)] = PooledSession(dev, host, user)
+
+        return dev
+
+    def release(self, dev, discard=False):
+        """Return a leased session to the pool
+
+        Parameters
+        ----------
+        dev : jnpr.junos.Device
+            The device connection that was leased
+        discard : bool
+            Close the session rather than keeping it
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            entry = self.leased.pop(id(dev), None)
+
+        # This session did not come from the pool
+        if entry is None:
+            try:
+                dev.close()
+            except Exception:
+                pass
+            return
+
+        if discard or entry.discard or not dev.connected:
+            self.close(entry)
+
+        else:
+            entry.last_used = time.monotonic()
+            with self.lock:
+                self.idle.setdefault(entry.host, []).append(entry)
+            self.schedule_reap()
+
+        self.limits[entry.host].release()
+
+    def invalidate(self, dev):
+        """Mark a leased session to be closed when it is returned
+
+        Used when an operation will drop the session (eg, a reboot)
+
+        Parameters
+        ----------
+        dev : jnpr.junos.Device
+            The device connection that was leased
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            if id(dev) in self.leased:
+                self.leased[id(dev)].discard = True
+
+    @contextmanager
+    def session(self, host, user, password, **kwargs):
+        """Lease a session, and return it when finished
+
+        If the block raises an exception, the session is closed
+            rather than reused
+
+        Parameters
+        ----------
+        host : str
+            The host to connect to
+        user : str
+            The username to authenticate with
+        password : str
+            The password to authenticate with
+        kwargs : dict
+            Extra arguments to pass to Device() when opening a new session
+
+        Raises
+        ------
+        Exception
+            Any exception raised by lease() or by the block
+
+        Returns
+        -------
+        dev : jnpr.junos.Device
+            An open device connection
+        """
+
+        dev = self.lease(host, user, password, **kwargs)
+        discard = False
+        try:
+            yield dev
+        except Exception:
+            discard = True
+            raise
+        finally:
+            self.release(dev, discard=discard)
+
+    def close(self, entry):
+        """Close a pooled session, ignoring errors
+
+        Parameters
+        ----------
+        entry : PooledSession
+            The session to close
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        try:
+            entry.dev.close()
+        except Exception:
+            pass
+
+    def schedule_reap(self):
+        """Schedule a check for idle sessions, if one is not scheduled
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            if self.reaper is not None:
+                return
+            self.reaper = threading.Timer(
+                self.settings()['idle_timeout'],
+                self.reap
+            )
+            self.reaper.daemon = True
+            self.reaper.start()
+
+    def reap(self):
+        """Close sessions that have been idle for too long
+
+        Reschedules itself while there are still idle sessions
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        timeout = self.settings()['idle_timeout']
+        now = time.monotonic()
+        expired = []
+
+        with self.lock:
+            self.reaper = None
+            for host in list(self.idle):
+                keep = []
+                for entry in self.idle[host]:
+                    if now - entry.last_used >= timeout:
+                        expired.append(entry)
+                    else:
+                        keep.append(entry)
+
+                if keep:
+                    self.idle[host] = keep
+                else:
+                    del self.idle[host]
+
+            remaining = len(self.idle)
+
+        for entry in expired:
+            print(termcolor.colored(
+                f"Closing idle session to {entry.host}",
+                "yellow"
+            ))
+            self.close(entry)
+
+        if remaining:
+            self.schedule_reap()
+
+    def close_all(self):
+        """Close all idle sessions
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        with self.lock:
+            entries = [
+                entry for host in self.idle for entry in self.idle[host]
+            ]
+            self.idle = {}
+
+        for entry in entries:
+            self.close(entry)
+
+
+# The shared pool that all Junos actions use
+pool = SessionPool()
 
 
 # Connect to a Junos device
+# Returns a session from the pool, or the error if it failed
 def junos_connect(host, user, password):
     try:
-        dev = Device(host, user=user, password=password).open()
+        dev = pool.lease(host, user, password)
     except Exception as err:
         return err
     return (dev)
 
 
-# Send shell commands to the device
-# Take the command to run, as well as the shell object
-def send_shell(cmd, dev):
-    # Print the command we're going to run
-    print(termcolor.colored(cmd, "yellow"))
+# Return a device connection to the pool
+def junos_disconnect(dev, discard=False):
+    if isinstance(dev, Device):
+        pool.release(dev, discard=discard)
 
-    # Convert the raw junos command to something the API can work with
-    command = f'cli -c "{cmd}"'
 
-    # Connect to the device shell (for sending CLI commands)
-    try:
-        shell = StartShell(dev, timeout=60)
-        shell.open()
-    except jnpr.junos.exception.ConnectError as err:
-        print(termcolor.colored(
-            'There was an error connecting to the Junos shell: ' + repr(err),
-            "red"
-        ))
-        return err
+# Shell settings
+#   The default time (seconds) a shell command can take to complete
+SHELL_TIMEOUT = 60
+#   How often (seconds) to check the channel for output, and the read size
+SHELL_POLL = 0.5
+SHELL_RECV_SIZE = 4096
+#   The shell prompt, which tells us a command has finished
+#   It starts a new line, and has no spaces until the one that ends it
+#   (eg, 'user@host:RE:0% '), so output like '45% ' doesn't match
+SHELL_PROMPT = re.compile(r'\n\S*[%#$] \Z')
 
-    # Attempt the command
-    try:
-        output = shell.run(command)
-    except Exception as err:
-        print('An error has occurred')
-        print('Sometimes a device will get busy and reject the attempt')
-        return err
 
-    # Cleanup the output before returning
-    # Extract the actual message, and remove excessive blank lines
-    out_text = output[1].replace(command, "")
-    out_text = out_text.replace("\r\r\n", "")
+class ShellSession():
+    """A shell session to a Junos device, that stays open between commands
 
-    # Return the response from the device
+    Opening a shell is an extra SSH channel setup, so a job that runs
+        several commands should reuse one session
+    Output is streamed as it arrives, rather than buffered until the
+        command completes
+    The time taken by each command is recorded
+
+    Attributes
+    ----------
+    dev : jnpr.junos.Device
+        The device connection
+    timeout : int
+        The default time (seconds) a command can take
+    shell : StartShell
+        The underlying shell, or None if it's not open
+    timings : list
+        A list of dictionaries, with the command label and time taken
+
+    Methods
+    -------
+    open()
+        Open the shell
+    run()
+        Run a CLI command in the shell
+    stream()
+        Send a command, and read output until the prompt returns
+    report()
+        A summary of how long each command took
+    close()
+        Close the shell
+    """
+
+    def __init__(self, dev, timeout=SHELL_TIMEOUT):
+        """Class constructor
+
+        Parameters
+        ----------
+        dev : jnpr.junos.Device
+            An open device connection
+        timeout : int
+            The default time (seconds) a command can take
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        self.dev = dev
+        self.timeout = timeout
+        self.shell = None
+        self.timings = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """Open the shell
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        jnpr.junos.exception.ConnectError
+            If the shell could not be opened (handled here)
+
+        Returns
+        -------
+        True : bool
+            If the shell was opened
+        err : Exception
+            If there was an error
+        """
+
+        try:
+            self.shell = StartShell(self.dev, timeout=self.timeout)
+            self.shell.open()
+        except jnpr.junos.exception.ConnectError as err:
+            print(termcolor.colored(
+                'There was an error connecting to the Junos shell: ' +
+                repr(err),
+                "red"
+            ))
+            self.shell = None
+            return err
+
+        return True
+
+    def run(self, cmd, timeout=None, on_output=None, label=None):
+        """Run a CLI command in the shell
+
+        The shell is opened if it isn't already
+
+        Parameters
+        ----------
+        cmd : str
+            The junos command to run
+            Bytes are accepted, and decoded as ASCII
+        timeout : int
+            The time (seconds) the command can take
+            Uses the session default if not given
+        on_output : function
+            Optional; Called with each chunk of output as it arrives
+        label : str
+            Optional; A name for this command in the timing report
+            Use this when the command contains credentials
+
+        Raises
+        ------
+        Exception
+            If the command failed (handled here)
+
+        Returns
+        -------
+        out_text : str
+            The output of the command
+        err : Exception
+            If there was an error
+        """
+
+        # Sometimes the junos device mangles non-ASCII characters
+        if isinstance(cmd, bytes):
+            cmd = cmd.decode('ascii', 'ignore')
+
+        # Print the command we're going to run
+        print(termcolor.colored(cmd, "yellow"))
+
+        # Convert the raw junos command to something the API can work with
+        command = f'cli -c "{cmd}"'
+        if label is None:
+            label = ' '.join(cmd.split()[:3])
+
+        # Connect to the device shell (for sending CLI commands)
+        if self.shell is None:
+            result = self.open()
+            if result is not True:
+                return result
+
+        # Attempt the command
+        start = time.monotonic()
+        try:
+            output = self.stream(command, timeout or self.timeout, on_output)
+        except Exception as err:
+            print('An error has occurred')
+            print('Sometimes a device will get busy and reject the attempt')
+            self.timings.append({
+                'command': label,
+                'seconds': time.monotonic() - start,
+                'ok': False
+            })
+
+            # The shell is in an unknown state; Start fresh next time
+            self.close()
+            return err
+
+        self.timings.append({
+            'command': label,
+            'seconds': time.monotonic() - start,
+            'ok': True
+        })
+
+        # Cleanup the output before returning
+        # Extract the actual message, and remove excessive blank lines
+        out_text = output.replace(command, "")
+        out_text = out_text.replace("\r\r\n", "")
+
+        return (out_text)
+
+    def stream(self, command, timeout, on_output=None):
+        """Send a command, and read output until the prompt returns
+
+        Parameters
+        ----------
+        command : str
+            The shell command to send
+        timeout : int
+            The time (seconds) the command can take
+        on_output : function
+            Optional; Called with each chunk of output as it arrives
+
+        Raises
+        ------
+        EOFError
+            If the channel closed before the command finished
+        TimeoutError
+            If the command did not finish in time
+
+        Returns
+        -------
+        output : str
+            All output from the command
+        """
+
+        channel = self.shell._chan
+        self.shell.send(command)
+
+        deadline = time.monotonic() + timeout
+        chunks = []
+        tail = ''
+        while time.monotonic() < deadline:
+            ready, _, _ = select.select([channel], [], [], SHELL_POLL)
+            if not ready:
+                continue
+
+            data = channel.recv(SHELL_RECV_SIZE)
+            if not data:
+                raise EOFError("The shell channel closed unexpectedly")
+
+            text = data.decode('utf-8', 'replace')
+            chunks.append(text)
+            if on_output:
+                on_output(text)
+
+            # The prompt may be split across reads, so keep a short tail
+            tail = (tail + text)[-256:]
+            if SHELL_PROMPT.search(tail):
+                return ''.join(chunks)
+
+        raise TimeoutError(
+            f"The command did not finish within {timeout} seconds"
+        )
+
+    def report(self):
+        """A summary of how long each command took
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        summary : str
+            An HTML formatted summary, one line per command
+        """
+
+        lines = []
+        for timing in self.timings:
+            status = '' if timing['ok'] else ' (failed)'
+            lines.append(
+                f"{timing['command']}: {timing['seconds']:.1f}s{status}"
+            )
+
+        return '<br>'.join(lines)
+
+    def close(self):
+        """Close the shell, ignoring errors
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        None
+
+        Returns
+        -------
+        None
+        """
+
+        if self.shell is not None:
+            try:
+                self.shell.close()
+            except Exception:
+                pass
+            self.shell = None
+
+
+# Send a single shell command to the device
+# Take the command to run, as well as the device object
+# Jobs running several commands should use ShellSession directly
+def send_shell(cmd, dev):
+    shell = ShellSession(dev)
+    result = shell.run(cmd)
     shell.close()
-    return (out_text)
+
+    # Return the response from the device
+    return result
 
 
 # Handle errors when they occur
-def error_handler(err, dev, chat_id):
+#   Set disconnect to False if the connection is still in use elsewhere
+#   (eg, one step of a job failed, while others are still running)
+def error_handler(err, dev, chat_id, disconnect=True):
     if isinstance(err, str):
         if 'could not fetch local copy of file' in err:
             teamschat.send_chat(
@@ -122,8 +921,6 @@ def error_handler(err, dev, chat_id):
                 'red'
             ))
 
-        dev.close()
-
     elif isinstance(err, jnpr.junos.exception.ConnectRefusedError):
         teamschat.send_chat(
             "Sorry. It refused my connection. <br> \
@@ -169,3 +966,7 @@ def error_handler(err, dev, chat_id):
                 <span style=\"color:Red\">{repr(err)}</span>",
             chat_id
         )
+
+    # Return the session to the pool (if we got as far as connecting)
+    if disconnect:
+        junos_disconnect(dev)
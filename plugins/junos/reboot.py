@@ -24,16 +24,16 @@ Author:
 
 # 'SW' is the 'Software Utility' class
 # This is used for upgrades, file copies, reboots, etc
-from jnpr.junos import Device
 from jnpr.junos.utils.sw import SW
 from jnpr.junos.exception import ConnectError
 from jnpr.junos.exception import RpcError
 
 from datetime import datetime, timedelta
 from dateutil.parser import parse
-from core import crypto
-from core import teamschat
-import threading
+from core import teamschat, maintenance
+from plugins.junos import netconf
+from plugins.junos import fleet
+from plugins.junos import facts
 
 
 # Reboot a device under various conditions
@@ -46,31 +46,38 @@ def reboot(device, user, password, chat_id, **kwargs):
     'time' parameter (datetime object) - Reboot at a time
     'duration' parameter (positive integer) - Reboot in a given time (minutes)
     No parameter - Reboot immediately
+    Returns a dictionary with 'ok' (bool) and 'message' (str)
+    Progress is reported to 'chat_id' by the fleet executor
     '''
 
     print(f"Connecting to {device}...")
 
-    # Connect to the device
+    # Lease a connection to the device from the pool
     try:
-        with Device(host=device, user=user, passwd=password) as dev:
+        with netconf.pool.session(device, user, password) as dev:
             # Instantiate the 'Software Utility' class
             try:
                 sw = SW(dev)
             except Exception as err:
                 print("Could not create the software class")
                 print(err)
-                return
+                return {'ok': False, 'message': 'Could not start a reboot'}
 
             # If there are no parameters, reboot now
             if kwargs == {}:
                 print("Rebooting now")
                 result = sw.reboot()
 
+                # The device is going down, so don't reuse this session
+                #   Its facts (eg, version) may change when it comes back
+                netconf.pool.invalidate(dev)
+                facts.cache.expire(device)
+
             # If the 'time' parameter is present, reboot then
             elif 'time' in kwargs:
                 if kwargs['time'] < datetime.now():
                     print("This time is in the past")
-                    return
+                    return {'ok': False, 'message': 'This time is in the past'}
 
                 print(f"Rebooting at {kwargs['time']}")
                 # Convert the time to a format junos uses
@@ -82,7 +89,10 @@ def reboot(device, user, password, chat_id, **kwargs):
             elif 'duration' in kwargs:
                 if kwargs['duration'] < 1 or type(kwargs['duration']) != int:
                     print("This needs to be a positive whole integer")
-                    return
+                    return {
+                        'ok': False,
+                        'message': 'The delay needs to be a positive number'
+                    }
 
                 print(f"Rebooting in: {kwargs['duration']} minutes")
                 result = sw.reboot(in_min=kwargs['duration'])
@@ -94,37 +104,53 @@ def reboot(device, user, password, chat_id, **kwargs):
                 print("  Pass no parameters to reboot now")
                 print("  Pass 'time' parameter to reboot at a particular time")
                 print("  Pass 'duration' to reboot in a number of minutes")
+                return {'ok': False, 'message': 'Invalid reboot parameters'}
 
             print(result)
-            teamschat.send_chat(
-                f"{device}: {result}",
-                chat_id
+
+            # Don't flood the chat with events while the device reboots
+            if kwargs == {}:
+                delay = 0
+            elif 'time' in kwargs:
+                delay = (kwargs['time'] - datetime.now()).total_seconds()
+            else:
+                delay = kwargs['duration'] * 60
+            maintenance.add_window(
+                device,
+                maintenance.MAINTENANCE['reboot_minutes'],
+                'Rebooted by the bot',
+                'reboot',
+                delay=delay
             )
 
+            return {'ok': True, 'message': str(result)}
+
     # Handle Connection error
     except ConnectError as err:
         print(f"There has been a connection error: {err}")
-        teamschat.send_chat(
-            f"There was a problem connecting to {device}",
-            chat_id
-        )
+        return {
+            'ok': False,
+            'message': f"There was a problem connecting to {device}"
+        }
 
     # Handle an RPC error
     except RpcError as err:
         if 'another shutdown is running' in str(err):
             print("Unable to reboot")
             print("Another reboot/shutdown has been scheduled")
-            teamschat.send_chat(
-                "Unable to reboot, as another reboot is scheduled",
-                chat_id
-            )
+            return {
+                'ok': False,
+                'message': 'Unable to reboot, as another reboot is scheduled'
+            }
 
         else:
             print(f"RPC Error has occurred: {err}")
+            return {'ok': False, 'message': f"RPC error: {err}"}
 
     # Handle a generic error
     except Exception as err:
         print(f"Error was: {err}")
+        return {'ok': False, 'message': f"Error: {err}"}
 
 
 # Use NLP to parse the message, and handle the reboot
@@ -157,35 +183,15 @@ def nlp_reboot(chat_id, **kwargs):
 
     # If not, reboot now
     if time == '' and date == '':
-        for device in device_list:
-            print(f"Reboot requested for {device}")
-            secret = crypto.pw_decrypt(dev_type='junos', device=device)
-            if not secret:
-                print("Could not get credentials")
-                return False
-            thread = threading.Thread(
-                target=reboot,
-                kwargs={
-                    'device': device,
-                    'user': secret['user'],
-                    'password': secret['password'],
-                    'chat_id': chat_id
-                }
-            )
-            thread.start()
-
-            teamschat.send_chat(
-                f"Reboot requested for {device}",
-                chat_id
-            )
-
-        return
+        print(f"Reboot requested for {device_list}")
+        schedule = {}
+        title = 'Rebooting now'
 
     # If the reboot should happen in a relative time from now
-    if 'seconds' in time or \
-       'minutes' in time or \
-       'hours' in time or \
-       'days' in time:
+    elif 'seconds' in time or \
+         'minutes' in time or \
+         'hours' in time or \
+         'days' in time:
         time_value = int(time.split()[0])
         time_units = time.split()[1]
 
@@ -202,28 +208,9 @@ def nlp_reboot(chat_id, **kwargs):
                 print(f"{time_units} is not a valid unit of time")
                 return
 
-        for device in device_list:
-            secret = crypto.pw_decrypt(dev_type='junos', device=device)
-            if not secret:
-                print("Could not get credentials")
-                return False
-            thread = threading.Thread(
-                target=reboot,
-                kwargs={
-                    'device': device,
-                    'user': secret['user'],
-                    'password': secret['password'],
-                    'chat_id': chat_id,
-                    'duration': time_value
-                }
-            )
-            thread.start()
-
-            teamschat.send_chat(
-                f"Rebooting {device} in {time_value} minutes",
-                chat_id
-            )
-            print(f"Rebooting {device} in {time_value} minutes")
+        print(f"Rebooting {device_list} in {time_value} minutes")
+        schedule = {'duration': time_value}
+        title = f"Rebooting in {time_value} minutes"
 
     # If the reboot should happen at an absolute time
     else:
@@ -233,34 +220,26 @@ def nlp_reboot(chat_id, **kwargs):
         except Exception as err:
             print(f"I'm not sure what {time} means")
             print(err)
+            teamschat.send_chat(f"I'm not sure what {time} means", chat_id)
+            return
 
         # If this turns out to be a time in the past, add 1 day
         # If 'tomorrow' used, add 1 day
         if dt < datetime.now() or date == 'tomorrow':
             dt = dt + timedelta(days=1)
 
-        # Execute the reboot
-        for device in device_list:
-            print(f"Rebooting {device} at {dt}")
-            secret = crypto.pw_decrypt(dev_type='junos', device=device)
-            if not secret:
-                print("Could not get credentials")
-                return False
-            thread = threading.Thread(
-                target=reboot,
-                kwargs={
-                    'device': device,
-                    'user': secret['user'],
-                    'password': secret['password'],
-                    'chat_id': chat_id,
-                    'time': dt
-                }
-            )
-            thread.start()
-
-            teamschat.send_chat(
-                f"Rebooting {device} at {dt}",
-                chat_id
-            )
+        print(f"Rebooting {device_list} at {dt}")
+        schedule = {'time': dt}
+        title = f"Rebooting at {dt}"
+
+    # Execute the reboot across all the devices
+    #   The fleet executor limits concurrency, and reports progress
+    #   in a single Teams message
+    executor = fleet.FleetExecutor(
+        action=reboot,
+        chat_id=chat_id,
+        title=title
+    )
+    executor.start(device_list, **schedule)
 
     return
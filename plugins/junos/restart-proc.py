@@ -21,14 +21,13 @@ Author:
     Luke Robertson - March 2023
 """
 
-from jnpr.junos import Device
 from jnpr.junos.exception import ConnectError
 from jnpr.junos.exception import RpcError
 from lxml import etree
 
-from core import crypto
-from core import teamschat
-import threading
+from core import teamschat, maintenance
+from plugins.junos import netconf
+from plugins.junos import fleet
 
 
 # Restart a process on a device
@@ -37,6 +36,8 @@ def restart(device, user, password, process, chat_id, **kwargs):
     Restart a process on a device
     Requires device name, username and password, and a process to restart
     Optionally can pass 'immediately=True' to use SIGKILL
+    Returns a dictionary with 'ok' (bool) and 'message' (str)
+    Progress is reported to 'chat_id' by the fleet executor
     '''
 
     print(f"Connecting to {device}...")
@@ -44,15 +45,14 @@ def restart(device, user, password, process, chat_id, **kwargs):
         print("This will restart the forwarding process")
         print("You will lose access to the device temporarily")
         print("(5+ minutes for small devices)")
-        teamschat.send_chat(
-            "Restarting the forwarding process, \
-                expect disruption for 5+ minutes",
-            chat_id
-        )
 
-    # Connect to the device
+    # Lease a connection to the device from the pool
     try:
-        with Device(host=device, user=user, passwd=password) as dev:
+        with netconf.pool.session(device, user, password) as dev:
+            # Restarting forwarding drops the session, so don't reuse it
+            if process == 'forwarding':
+                netconf.pool.invalidate(dev)
+
             # Restart the process immediately (SIGKILL)
             if 'immediately' in kwargs and kwargs['immediately'] is True:
                 result = dev.rpc.restart_daemon(
@@ -64,9 +64,15 @@ def restart(device, user, password, process, chat_id, **kwargs):
                 # When using 'immediately', only a True or False is returned
                 if result:
                     print("Restart Complete")
+                    response = 'Restart complete'
                 else:
                     print("There were problems restarting this service")
                     print("Maybe check the system logs")
+                    return {
+                        'ok': False,
+                        'message': 'There were problems restarting the \
+                            process. Maybe check the system logs'
+                    }
 
             # No args means restart gracefully (SIGTERM)
             # If args are invalid, just a regular restart will do
@@ -79,18 +85,21 @@ def restart(device, user, password, process, chat_id, **kwargs):
                 response = response.replace("<output>", "")
                 response = response.replace("</output>", "")
                 print(response)
-            teamschat.send_chat(
-                f"{device}: {response}",
-                chat_id
+
+            # Don't flood the chat with events while the process restarts
+            maintenance.add_window(
+                device,
+                maintenance.MAINTENANCE['restart_minutes'],
+                f"The {process} process was restarted by the bot",
+                'restart'
             )
 
+            return {'ok': True, 'message': response}
+
     # Handle Connection error
     except ConnectError as err:
         print(f"There has been a connection error: {err}")
-        teamschat.send_chat(
-            f"Could not connect to {device}",
-            chat_id
-        )
+        return {'ok': False, 'message': f"Could not connect to {device}"}
 
     # Handle an RPC error
     except RpcError as err:
@@ -98,43 +107,46 @@ def restart(device, user, password, process, chat_id, **kwargs):
         if process == 'forwarding':
             print(f"I have been disconnected from {device}")
             print("This is normal when restarting the forwarding process")
+            maintenance.add_window(
+                device,
+                maintenance.MAINTENANCE['restart_minutes'],
+                'The forwarding process was restarted by the bot',
+                'restart'
+            )
+            return {
+                'ok': True,
+                'message': 'Disconnected while restarting forwarding \
+                    (this is normal)'
+            }
 
         # Handle errors where a process is not running
         elif 'subsystem not running' in str(err):
             print(f"The {process} process cannot be started")
             print("It is not in use on this system")
-            teamschat.send_chat(
-                f"The {process} process cannot be started",
-                chat_id
-            )
+            return {
+                'ok': False,
+                'message': f"The {process} process cannot be started"
+            }
 
         # Handle a bad process name
         elif 'invalid daemon' in str(err):
             print(f"The {process} does not exist on this system")
             print("Maybe it's typed incorrectly?")
-            teamschat.send_chat(
-                f"The {process} does not exist on this system \
-                    Is this a typo",
-                chat_id
-            )
+            return {
+                'ok': False,
+                'message': f"The {process} does not exist on this system. \
+                    Is this a typo?"
+            }
 
         # Handle other RPC errors
         else:
             print(f"RPC Error has occurred: {err}")
-            teamschat.send_chat(
-                f"RPC Error has occurred while connecting to {device} \
-                    <br>{err}",
-                chat_id
-            )
+            return {'ok': False, 'message': f"RPC Error: {err}"}
 
     # Handle a generic error
     except Exception as err:
         print(f"Error was: {err}")
-        teamschat.send_chat(
-            f"An error has occurred while connecting to {device} \
-                <br>{err}",
-            chat_id
-        )
+        return {'ok': False, 'message': f"An error has occurred: {err}"}
 
 
 # Process the users phrase in order to restart a process
@@ -164,44 +176,34 @@ def nlp_restart(chat_id, **kwargs):
             "I need at least one process to restart",
             chat_id
         )
+        return
 
-    # Restart the processes
-    for device in device_list:
-        secret = crypto.pw_decrypt(dev_type='junos', device=device)
-        if not secret:
-            print("Could not get credentials")
-            return False
-
-        args = {
-            'device': device,
-            'user': secret['user'],
-            'password': secret['password'],
-            'process': process,
-            'chat_id': chat_id,
-        }
-
-        # Force restart
-        if 'immediate' in kwargs['message']:
-            print(f"restarting the {process} process on {device} immediately")
-
-            teamschat.send_chat(
-                f"restarting the {process} process on {device} immediately",
-                chat_id
-            )
-            args['immediately'] = True
-
-        # Graceful restart
-        else:
-            print(f"restarting the {process} process on {device}")
-
-            teamschat.send_chat(
-                f"restarting the {process} process on {device}",
-                chat_id
-            )
-
-        # Run the thread
-        thread = threading.Thread(
-            target=restart,
-            kwargs=args
+    if process == 'forwarding':
+        teamschat.send_chat(
+            "Restarting the forwarding process, \
+                expect disruption for 5+ minutes",
+            chat_id
         )
-        thread.start()
+
+    # Force restart
+    args = {'process': process}
+    if 'immediate' in kwargs['message']:
+        print(f"restarting the {process} process on {device_list} \
+            immediately")
+        title = f"Restarting the {process} process immediately"
+        args['immediately'] = True
+
+    # Graceful restart
+    else:
+        print(f"restarting the {process} process on {device_list}")
+        title = f"Restarting the {process} process"
+
+    # Restart the processes across all the devices
+    #   The fleet executor limits concurrency, and reports progress
+    #   in a single Teams message
+    executor = fleet.FleetExecutor(
+        action=restart,
+        chat_id=chat_id,
+        title=title
+    )
+    executor.start(device_list, **args)
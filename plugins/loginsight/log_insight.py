@@ -17,103 +17,96 @@ Author:
 
 
 # import yaml
-from core import teamschat
 from core import plugin
-from datetime import datetime
+from core import timestamp
+from core.event import Event
+from typing import Any
 import termcolor
 
 
 # Location of the config file
 LOCATION = 'plugins\\loginsight\\config.yaml'
 
+# Fields that name the device that logged the message, in order
+HOST_FIELDS = ('hostname', 'host', 'source')
+
+# The webhook fields this plugin uses (see core/decode.py)
+PAYLOAD_SCHEMA = {
+    'alert_name': str,
+    'timestamp': Any,
+    'messages': [{
+        'text': Any,
+        'fields': [{'name': Any, 'content': Any}],
+    }],
+    'recommendation': Any,
+    'url': Any,
+}
+
 
 class LogInsight(plugin.PluginTemplate):
     # Initialise the class from the inherited class
     def __init__(self):
         super().__init__(LOCATION)
         self.table = self.config['config']['sql_table']
+        self.schema = PAYLOAD_SCHEMA
 
     # Handle the webhook
     def handle_event(self, raw_response, src):
         '''Handle webhooks when the are sent'''
-        # Add the sending IP to the event
-        raw_response['source'] = src
-
         # Cleanup the message
-        event = self.parse_message(raw_response)
-        message = event
-        message = f"<span style=\"color:yellow\"><b>{event['hostname']} \
+        event = self.parse_message(raw_response, src)
+        event.message = f"<span style=\"color:yellow\"><b>{event.device} \
             </span></b> had a <span style=\"color:orange\"><b> \
-            {message['alert']} </span></b>event.<br> {event['description']} \
-            <br><span style=\"color:lime\">{event['recommendation']}</span> \
-            <br><a href={message['url']}>See more logs here</a>"
+            {event.type} </span></b>event.<br> {event.description} \
+            <br><span style=\"color:lime\"> \
+            {event.details['recommendation']}</span> \
+            <br><a href={event.details['url']}>See more logs here</a>"
 
         # Log the message, and send to teams
-        self.log(message, raw_response)
-
-    # Parse the message
-    def parse_message(self, event):
-        message = {}
-        message['source'] = event['source']
-        message['alert'] = event['alert_name']
-        message['time'] = event['timestamp']
+        self.log(event)
+
+    # Parse the message into the common event format (core.event)
+    def parse_message(self, raw_response, src):
+        event = Event(
+            source='loginsight',
+            type=raw_response['alert_name'],
+            when=timestamp.event_time(raw_response.get('timestamp')),
+            src_ip=src,
+            raw=raw_response
+        )
+
+        # Use the hostname field, so events can be correlated with other
+        #   plugins (see core/correlate.py); Otherwise, the first field
         try:
-            message['hostname'] = event['messages'][0]['fields'][0]['content']
-        except IndexError:
-            message['hostname'] = 'Log Insight'
+            fields = raw_response['messages'][0]['fields']
+            names = {field.get('name'): field for field in fields}
+            field = next(
+                (names[name] for name in HOST_FIELDS if name in names),
+                fields[0]
+            )
+            event.device = field['content']
+        except (IndexError, KeyError):
+            event.device = 'Log Insight'
 
         try:
-            message['description'] = event['messages'][0]['text']
+            event.description = raw_response['messages'][0]['text']
         except IndexError:
-            message['description'] = ''
+            event.description = ''
         except KeyError:
-            message['description'] = ''
+            event.description = ''
 
-        if event['recommendation'] == 'null':
-            message['recommendation'] = 'No recommended actions'
+        if raw_response['recommendation'] == 'null':
+            event.details['recommendation'] = 'No recommended actions'
         else:
-            message['recommendation'] = event['recommendation']
+            event.details['recommendation'] = raw_response['recommendation']
 
-        message['url'] = event['url']
-        return message
+        event.details['url'] = raw_response['url']
+        return event
 
     # Log to Teams and SQL
-    def log(self, message, event):
-        date = datetime.now().date()
-        time = datetime.now().time().strftime("%H:%M:%S")
-
-        chat_id = teamschat.send_chat(
-            message,
-            self.config['config']['chat_id']
-        )['id']
+    def log(self, event):
         print(termcolor.colored(f"Log Insight event: {event}", "yellow"))
-
-        try:
-            description = event['messages'][0]['text'].replace("'", "")
-        except KeyError:
-            description = ''
-        except IndexError:
-            description = ''
-
-        try:
-            hostname = event['messages'][0]['fields'][0]['content']
-        except IndexError:
-            hostname = 'No hostname'
-
-        fields = {
-            'device': f"'{hostname}'",
-            'event': f"'{event['source']}'",
-            'description': f"'{description}'",
-            'logdate': f"'{date}'",
-            'logtime': f"'{time}'",
-            'source': f"{self.ip2integer(event['source'])}",
-            'message': f"'{chat_id}'"
-        }
-
-        self.sql_write(
-            database=self.config['config']['sql_table'],
-            fields=fields
-        )
+        self.log_events([event])
 
     # Check webhook authentication
     # This overrides the default implementation from the template
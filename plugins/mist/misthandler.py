@@ -10,6 +10,12 @@ Usage:
 Restrictions:
     Needs access to the 'teamschat' module
 
+Functions:
+    filter_stats()
+        Chat command to show how often each filter has matched
+    batch_stats()
+        Chat command to show webhook batch sizes and handling times
+
 To Do:
     None
 
@@ -19,204 +25,311 @@ Author:
 
 from core import teamschat
 from core import plugin
-from datetime import datetime
+from core import severity
+from core import prefilter
+from core import diff
+from core import timestamp
+from core.event import Event
+from core import decode
+from typing import Any
+from config import plugin_list
 import termcolor
+import threading
+import time
 
 
 LOCATION = 'plugins\\mist\\mist-config.yaml'
 
+# The webhook fields this plugin uses (see core/decode.py)
+#   Fields used by field filters are added when the config is loaded
+PAYLOAD_SCHEMA = {
+    'topic': str,
+    'events': [{
+        'type': str,
+        'timestamp': Any,
+        'device_name': Any,
+        'device_type': Any,
+        'mac': Any,
+        'site_name': Any,
+        'text': Any,
+        'count': Any,
+        'hostnames': Any,
+        'message': Any,
+        'before': Any,
+        'after': Any,
+        'admin_name': Any,
+    }],
+}
+
 
 # Create a class to handle Mist webhooks
 class MistHandler(plugin.PluginTemplate):
     def __init__(self):
         super().__init__(LOCATION)
         self.table = self.config['config']['sql_table']
+        self.sql_columns = (
+            'device',
+            'site',
+            'event',
+            'description',
+            'logdate',
+            'logtime',
+            'source',
+            'message',
+        )
+        self.phrase_list = [
+            {
+                "phrase": "mist filter stats",
+                "function": "filter_stats",
+                "module": "plugins.mist.misthandler"
+            },
+            {
+                "phrase": "mist batch stats",
+                "function": "batch_stats",
+                "module": "plugins.mist.misthandler"
+            }
+        ]
+
+        # Statistics on webhook batches
+        self.stats_lock = threading.Lock()
+        self.batch_stats = {
+            'batches': 0,
+            'events': 0,
+            'largest': 0,
+            'last_size': 0,
+            'last_ms': 0,
+            'total_ms': 0,
+            'slowest_ms': 0,
+        }
+
+    # Compile the priority rules, when the config is loaded
+    def compile_config(self):
+        '''Builds a classifier for each section of priority rules'''
+        self.classifiers = {
+            section: severity.Classifier(self.config.get(section))
+            for section in ('device_event', 'audit', 'alarm', 'updown')
+        }
+
+        # Filters are checked against the raw webhook, before decoding
+        self.payload_filter = prefilter.PayloadFilter(
+            self.config.get('filter')
+        )
+
+        # Decode the fields we use, and any that field filters look at
+        #   Filters without a field need whole events
+        #   Large webhooks have their events decoded incrementally
+        fields = dict(PAYLOAD_SCHEMA['events'][0])
+        for field in self.payload_filter.fields:
+            fields.setdefault(field, Any)
+        if len(self.payload_filter.anywhere):
+            fields = Any
+        self.decoder = decode.Decoder(
+            {**PAYLOAD_SCHEMA, 'events': [fields]},
+            stream_key='events'
+        )
+
+    # Drop filtered webhooks before they're decoded
+    def prefilter(self, body):
+        '''Takes the raw webhook body, and returns True to drop it'''
+        if self.payload_filter.check(body):
+            print('filtering out an event')
+            return True
+
+        return False
+
+    # Decode the webhook, unless the prefilter already did
+    def decode(self, body):
+        '''Takes the raw webhook body, and returns the decoded payload'''
+        payload = self.payload_filter.decoded(body)
+        if payload is not None:
+            return payload
+
+        return super().decode(body)
 
     # Each alert has a different priority, which admins assign
     # These priorities are defined in mist-config.yaml
     def alert_priority(self, event):
         '''Takes given events, and adds a priority level'''
-        match event['event']:
+        match event.kind:
             case 'device_event':
-                if event['type'] in self.config['device_event']:
-                    # Check if this alert has a subpriority
-                    # (the 'default' keyword must be there)
-                    if 'default' in str(self.config['device_event']
-                                        [event['type']]):
-                        # Set the default priority
-                        event['level'] = (self.config['device_event']
-                                          [event['type']]['default'])
-
-                        # Check if there is a more specific priority
-                        for entry in (self.config['device_event']
-                                                 [event['type']]):
-                            if entry == 'default':
-                                break
-                            if entry in event['text']:
-                                event['level'] = (self.config
-                                                  ['device_event']
-                                                  [event['type']][entry])
-
-                    # An alert with no sub priority
-                    else:
-                        event['level'] = (self.config['device_event']
-                                          [event['type']])
-                else:
-                    event['level'] = 1
+                # Sub priorities are based on keywords in the event text
+                event.level = self.classifiers['device_event'].classify(
+                    event.type,
+                    event.description
+                )
 
             case 'audit':
-                # Some audit events don't have an 'admin' (user) field,
-                # so we will inject one
-                if 'admin' not in event:
-                    event['admin'] = 'system'
-
-                # Some audit events don't have an 'site' field,
-                # so we will inject one
-                if 'site' not in event:
-                    event['site'] = 'global'
-
                 # Split the 'task' field, to just read the part before the
                 # description; This matches the entry in the YAML file
-                if event['task'].split(' "')[0] in self.config['audit']:
-                    event['level'] = (self.config['audit']
-                                      [event['task'].split(' "')[0]])
-                else:
-                    event['level'] = 1
+                event.level = self.classifiers['audit'].classify(
+                    event.details['task'].split(' "')[0],
+                    event.details['task']
+                )
 
             case 'alarm':
-                if event['type'] in self.config['alarm']:
-                    event['level'] = (self.config['alarm']
-                                      [event['type']])
-                else:
-                    event['level'] = 1
+                event.level = self.classifiers['alarm'].classify(event.type)
 
             case 'updown':
-                if event['err_type'] in self.config['updown']:
-                    event['level'] = (self.config['updown']
-                                      [event['err_type']])
-                else:
-                    event['level'] = 1
+                event.level = self.classifiers['updown'].classify(event.type)
 
-            case 'default':
-                event['level'] = 1
+            case _:
+                event.level = 1
 
-    # Parse the alerts into a standard dictionary format that we can use
+    # Parse a single event into the common event format (core.event)
     # If fields are missing, add them in
-    def alert_parse(self, raw_response):
+    def event_parse(self, topic, event, src):
         '''
-        Takes a raw event from Mist,
+        Takes a single raw event from Mist,
         and parses it into something we can use
         '''
-        details = {}
-        match raw_response['topic']:
+        # The event time; Mist sends epoch seconds, in most events
+        record = Event(
+            source='mist',
+            when=timestamp.event_time(event.get('timestamp')),
+            src_ip=src,
+            raw=event
+        )
+        details = record.details
+
+        match topic:
             case 'device-events':
-                for event in raw_response['events']:
-                    details['event'] = 'device_event'
-                    details['name'] = event['device_name']
-                    details['type'] = event['device_type']
-                    details['mac'] = event['mac']
-                    if 'site_name' in event:
-                        details['site'] = event['site_name']
-                    else:
-                        details['site'] = 'No site listed'
-                    details['type'] = event['type']
-                    if 'text' in event:
-                        details['text'] = event['text']
-                    else:
-                        details['text'] = 'no additional details available'
+                record.kind = 'device_event'
+                record.device = event['device_name']
+                record.type = event['type']
+                record.site = event.get('site_name', 'No site listed')
+                record.description = event.get(
+                    'text',
+                    'no additional details available'
+                )
+                details['device_type'] = event['device_type']
+                details['mac'] = event['mac']
 
             case 'alarms':
-                for event in raw_response['events']:
-                    details['event'] = 'alarm'
-                    details['count'] = event['count']
-                    details['site'] = event['site_name']
-                    details['type'] = event['type']
-                    if 'hostnames' in event:
-                        details['devices'] = event['hostnames']
-                    else:
-                        details['devices'] = 'No device listed'
+                record.kind = 'alarm'
+                record.type = event['type']
+                record.site = event['site_name']
+                details['count'] = event['count']
+                details['devices'] = event.get('hostnames', 'No device listed')
+                if isinstance(details['devices'], list):
+                    record.device = ', '.join(details['devices'])
+                else:
+                    record.device = details['devices']
 
             case 'audits':
-                for event in raw_response['events']:
-                    details['event'] = 'audit'
-                    details['task'] = event['message']
-
-                    if 'before' in event:
-                        details['before'] = event['before']
-
-                    if 'after' in event:
-                        details['after'] = event['after']
-                    else:
-                        details['after'] = "No details available"
+                record.kind = 'audit'
+                details['task'] = event['message']
+                record.type = event['message'].split(" ", 1)[0]
+                record.description = event['message'] \
+                    .replace("[", "").replace("]", "").replace("'", "")
 
-                    if 'admin_name' in event:
-                        details['admin'] = event['admin_name']
+                if 'before' in event:
+                    details['before'] = event['before']
+                details['after'] = event.get('after', "No details available")
 
-                    if 'site_name' in event:
-                        details['site'] = event['site_name']
+                # Some audit events don't have an 'admin' (user) or
+                #   'site' field, so we will inject them
+                details['admin'] = event.get('admin_name', 'system')
+                record.site = event.get('site_name', 'global')
 
             case 'device-updowns':
-                for event in raw_response['events']:
-                    details['event'] = 'updown'
-                    details['name'] = event['device_name']
-                    details['device'] = event['device_type']
-                    details['mac'] = event['mac']
-                    details['site'] = event['site_name']
-                    details['err_type'] = event['type']
+                record.kind = 'updown'
+                record.device = event['device_name']
+                record.type = event['type']
+                record.site = event['site_name']
+                details['device_type'] = event['device_type']
+                details['mac'] = event['mac']
 
             case _:
-                topic = raw_response['topic']
-                for event in raw_response['events']:
-                    details['event'] = topic
-                    details['data'] = event
-                    print(raw_response)
+                record.kind = topic
+                record.type = topic
+                record.site = event.get('site_name', 'No site listed')
 
-        return details
+        return record
 
-    # Handle an event, whatever it may be
-    # Takes the event, which needs parsing
+    # Parse every event in a webhook
+    # Mist sends events as a list, and there may be many in one webhook
+    def alert_parse(self, raw_response, src):
+        '''
+        Takes a raw webhook from Mist, and parses each event in it
+        Events matching a filter are left out
+        '''
+        events = []
+        for event in raw_response['events']:
+            if self.payload_filter.event_match(event) is not None:
+                continue
+            events.append(
+                self.event_parse(raw_response['topic'], event, src)
+            )
+
+        return events
+
+    # Handle a webhook, whatever it may be
+    # Takes the webhook, which needs parsing
     def handle_event(self, raw_response, src):
         '''
-        takes a raw event from Mist, and handles it as appropriate
-        This includes parsing the event, assigning a priority,
-        and possibly sending it to teams
+        takes a raw webhook from Mist, and handles it as appropriate
+        This includes parsing each event, assigning a priority,
+        and possibly sending them to teams
+        All events in the webhook are sent as one teams message,
+        and written to SQL together
         '''
 
+        start = time.monotonic()
+
         # Parse the message
-        event = self.alert_parse(raw_response)
+        # Webhooks where every event is filtered are dropped before this
+        #   (see prefilter()); Other filtered events are left out here
+        events = self.alert_parse(raw_response, src)
+        if not events:
+            print('filtering out an event')
+            return
 
-        # Filter events
-        # These are just keywords that we want to avoid
-        for item in self.config['filter']:
-            if item in str(event):
-                print('filtering out an event')
-                return
+        # Prioritise each event, and prepare messages for teams
+        batch = []
+        for event in events:
+            # Add the event level (1-4) to the event
+            self.alert_priority(event)
 
-        # Add the event level (1-4) to the 'event'
-        self.alert_priority(event)
+            # Level 4 events are ignored completely
+            if event.level == 4:
+                continue
 
-        # Add the source IP to the event
-        event['src_ip'] = src
+            event.message = self.render(event)
+            batch.append(event)
+
+        # Send to teams, and write to the database
+        self.log_events(batch, title=f"Mist events ({raw_response['topic']})")
+
+        self.record_batch(len(events), time.monotonic() - start)
+
+    # Build a teams message for an event
+    def render(self, event):
+        '''
+        Takes a prioritised event, and returns a message for teams
+        Returns an empty string if the event should not go to teams
+        '''
 
-        # Handle device events
         message = ''
-        if event['event'] == 'device_event':
-            match event['level']:
+        details = event.details
+
+        # Handle device events
+        if event.kind == 'device_event':
+            match event.level:
                 case 1:
                     message = f"<b><span style=\"color:Yellow\"> \
-                        {event['name']} \
+                        {event.device} \
                         </span></b> in the <span style=\"color:Lime\"><b> \
-                        {event['site']}</b></span> site had a <b> \
-                        <span style=\"color:Orange\">{event['type']} \
-                        </span></b> event. <br> {event['text']}"
+                        {event.site}</b></span> site had a <b> \
+                        <span style=\"color:Orange\">{event.type} \
+                        </span></b> event. <br> {event.description}"
                     print('Level 1 event:', event)
 
                 case 2:
                     message = f"<b><span style=\"color:Yellow\"> \
-                        {event['name']} \
+                        {event.device} \
                         </span></b> in the <span style=\"color:Lime\"><b> \
-                        {event['site']}</b></span> site had a <b> \
-                        <span style=\"color:Orange\">{event['type']} \
+                        {event.site}</b></span> site had a <b> \
+                        <span style=\"color:Orange\">{event.type} \
                         </span></b> event"
                     print('Level 2 event:', event)
 
@@ -224,41 +337,34 @@ class MistHandler(plugin.PluginTemplate):
                     print('Level 3 event:', event)
 
         # Handle audit events
-        elif event['event'] == 'audit':
-            match event['level']:
+        elif event.kind == 'audit':
+            match event.level:
                 case 1:
-                    if 'before' in event:
+                    if 'before' in details:
                         # Find the difference
-                        old_config = []
-                        for line in str(event['before']).split(", "):
-                            if line not in str(event['after']).split(", "):
-                                old_config.append(line)
-
-                        new_config = []
-                        for line in str(event['after']).split(", "):
-                            if line not in str(event['before']).split(", "):
-                                new_config.append(line)
+                        changes = diff.render(
+                            diff.diff(details['before'], details['after'])
+                        )
 
                         message = f"<b><span style=\"color:Yellow\"> \
-                            {event['admin']}</span></b> just worked on the \
-                            <span style=\"color:Lime\"><b>{event['site']}</b> \
+                            {details['admin']}</span></b> just worked on the \
+                            <span style=\"color:Lime\"><b>{event.site}</b> \
                             </span> site<br> The completed task was: <b> \
-                            <span style=\"color:Orange\">{event['task']} \
-                            </span></b>.<br> New config: <br>{new_config} \
-                            <br> <br>Old config: <br>{old_config}"
+                            <span style=\"color:Orange\">{details['task']} \
+                            </span></b>.<br> Config changes: <br>{changes}"
                     else:
                         message = f"<b><span style=\"color:Yellow\"> \
-                        {event['admin']}</span></b> worked on to the  \
-                        <span style=\"color:Lime\"><b>{event['site']}</b> \
+                        {details['admin']}</span></b> worked on to the  \
+                        <span style=\"color:Lime\"><b>{event.site}</b> \
                         </span> site.<br> The completed task was: <b> \
-                        <span style=\"color:Orange\">{event['task']} \
+                        <span style=\"color:Orange\">{details['task']} \
                         </span></b>"
                     print('Level 1 event:', event)
 
                 case 2:
                     message = f"<b><span style=\"color:Yellow\"> \
-                        {event['admin']}</span></b> worked on to the \
-                        <span style=\"color:Lime\"><b>{event['site']}</b> \
+                        {details['admin']}</span></b> worked on to the \
+                        <span style=\"color:Lime\"><b>{event.site}</b> \
                         </span> site."
                     print('Level 2 event:', event)
 
@@ -266,22 +372,22 @@ class MistHandler(plugin.PluginTemplate):
                     print('Level 3 event:', event)
 
         # Handle alarms
-        elif event['event'] == 'alarm':
-            match event['level']:
+        elif event.kind == 'alarm':
+            match event.level:
                 case 1:
-                    message = f"{str(event['count'])} devices in the \
-                        <span style=\"color:Lime\"><b>{event['site']}</b> \
+                    message = f"{str(details['count'])} devices in the \
+                        <span style=\"color:Lime\"><b>{event.site}</b> \
                         </span> site have raised an alarm<br> devices \
-                        {str(event['devices'])} have the status <b> \
-                        <span style=\"color:Orange\">{event['type']} \
+                        {str(details['devices'])} have the status <b> \
+                        <span style=\"color:Orange\">{event.type} \
                         </span></b>"
                     print('Level 1 event:', event)
 
                 case 2:
                     message = f"One or more devices in the \
-                        <span style=\"color:Lime\"><b>{event['site']}</b> \
+                        <span style=\"color:Lime\"><b>{event.site}</b> \
                         </span> site have raised non-critical alarms (<b> \
-                        <span style=\"color:Orange\">{event['type']} \
+                        <span style=\"color:Orange\">{event.type} \
                         </span></b>)"
                     print('Level 2 event:', event)
 
@@ -289,21 +395,21 @@ class MistHandler(plugin.PluginTemplate):
                     print('Level 3 event:', event)
 
         # Handle device up/down events
-        elif event['event'] == 'updown':
-            match event['level']:
+        elif event.kind == 'updown':
+            match event.level:
                 case 1:
                     message = f"A/An <b><span style=\"color:Yellow\"> \
-                        {event['device']}</span></b> in the \
-                        <span style=\"color:Lime\"><b>{event['site']}</b> \
-                        </span> site ({event['name']}) has changed status<br> \
+                        {details['device_type']}</span></b> in the \
+                        <span style=\"color:Lime\"><b>{event.site}</b> \
+                        </span> site ({event.device}) has changed status<br> \
                         New status: <b><span style=\"color:Orange\"> \
-                        {event['err_type']}</span></b>"
+                        {event.type}</span></b>"
                     print('Level 1 event:', event)
 
                 case 2:
                     message = f"A/An <b><span style=\"color:Yellow\"> \
-                        {event['device']}</span></b> in the \
-                        <span style=\"color:Lime\"><b>{event['site']}</b> \
+                        {details['device_type']}</span></b> in the \
+                        <span style=\"color:Lime\"><b>{event.site}</b> \
                         </span> site has changed status"
                     print('Level 2 event:', event)
 
@@ -312,71 +418,91 @@ class MistHandler(plugin.PluginTemplate):
 
         # Handle anything unexpected
         else:
-            message = event
-            print(termcolor.colored(event), "red")
-
-        # Write the entry to the database
-        if event['level'] != 4:
-            self.log(message, event)
-
-    # Send a message to teams, and write to SQL
-    def log(self, message, event):
-        """
-        Send a message to Teams, and log to the SQL server
-        """
-        date = datetime.now().date()
-        time = datetime.now().time().strftime("%H:%M:%S")
-        ip_decimal = self.ip2integer(event['src_ip'])
-
-        # Different event types have different fields
-        # Some need to be handled a little differently
-        if event['event'] == 'device_event':
-            device = event['name']
-            description = event['text']
-            type = event['type']
-
-        elif event['event'] == 'alarm':
-            device = ''
-            for mist_device in event['devices']:
-                device += ', ' + mist_device
-            description = ''
-            type = event['type']
-
-        elif event['event'] == 'audit':
-            device = ''
-            description = event['task'].replace("[", "").replace("]", "") \
-                .replace("'", "")
-            type = event['task'].split(" ", 1)[0]
-
-        elif event['event'] == 'updown':
-            device = event['name']
-            type = event['err_type']
-            description = ''
-
-        # Print to the terminal
-        print(event)
-
-        # Send the message to teams
-        chat_id = ''
-        if message:
-            chat_id = teamschat.send_chat(
-                message,
-                self.config['config']['chat_id']
-            )['id']
-
-        # Log to SQL
-        fields = {
-            'device': f"'{device}'",
-            'site': f"'{event['site']}'",
-            'event': f"'{type}'",
-            'description': f"'{description}'",
-            'logdate': f"'{date}'",
-            'logtime': f"'{time}'",
-            'source': f"{ip_decimal}",  # IP address needs to be decimal
-            'message': f"'{chat_id}'"
-        }
+            message = str(event.raw)
+            print(termcolor.colored(event, "red"))
 
-        self.sql_write(
-            database=self.config['config']['sql_table'],
-            fields=fields
-        )
+        return message
+
+    # Keep batch statistics
+    def record_batch(self, size, seconds):
+        '''
+        Records the size of a batch, and how long it took to handle
+        '''
+        with self.stats_lock:
+            stats = self.batch_stats
+            stats['batches'] += 1
+            stats['events'] += size
+            stats['largest'] = max(stats['largest'], size)
+            stats['last_size'] = size
+            stats['last_ms'] = seconds * 1000
+            stats['total_ms'] += seconds * 1000
+            stats['slowest_ms'] = max(stats['slowest_ms'], seconds * 1000)
+
+
+def filter_stats(chat_id, **kwargs):
+    '''
+    Chat command to show how often each Mist filter has matched
+
+        Parameters:
+            chat_id : str
+                The teams chat ID to respond to
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    for entry in plugin_list:
+        if isinstance(entry['handler'], MistHandler):
+            lines = []
+            for stat in entry['handler'].payload_filter.stats():
+                scope = f" (in '{stat['field']}')" if stat['field'] else ''
+                lines.append(f"{stat['text']}{scope}: {stat['hits']}")
+
+            teamschat.send_chat(
+                "Mist filter hits:<br>" + ("<br>".join(lines) or "None"),
+                chat_id
+            )
+            return
+
+    teamschat.send_chat("The Mist plugin isn't loaded", chat_id)
+
+
+def batch_stats(chat_id, **kwargs):
+    '''
+    Chat command to show Mist webhook batch sizes and handling times
+
+        Parameters:
+            chat_id : str
+                The teams chat ID to respond to
+
+        Raises:
+            None
+
+        Returns:
+            None
+    '''
+
+    for entry in plugin_list:
+        if isinstance(entry['handler'], MistHandler):
+            handler = entry['handler']
+            with handler.stats_lock:
+                stats = dict(handler.batch_stats)
+
+            average_size = stats['events'] / max(stats['batches'], 1)
+            average_ms = stats['total_ms'] / max(stats['batches'], 1)
+            teamschat.send_chat(
+                f"Mist webhook batches: {stats['batches']}<br> \
+                    Events: {stats['events']} \
+                    (average {average_size:.1f}, largest {stats['largest']}, \
+                    last {stats['last_size']})<br> \
+                    Handling time: average {average_ms:.0f}ms, \
+                    slowest {stats['slowest_ms']:.0f}ms, \
+                    last {stats['last_ms']:.0f}ms",
+                chat_id
+            )
+            return
+
+    teamschat.send_chat("The Mist plugin isn't loaded", chat_id)
@@ -0,0 +1,153 @@
+"""
+Junos agent: Cold-start benchmark
+
+Measures how long plugins/junos/agent.py takes to start, build a webhook,
+    and send it, when run as a fresh process (as an event script is)
+Also measures the import cost of the modules the agent avoids, for
+    comparison
+
+Usage:
+    python tools/agent-benchmark.py [runs]
+
+    The agent sends its webhooks to a local HTTP server, started here
+    The 'junos' module only exists on Junos devices, so a small one is
+        written to a temp folder, holding a sample trigger event
+    The agent is copied to the same folder, as it would be on a device
+        (this also stops plugins/junos/junos.py being imported instead)
+
+Authentication:
+    None
+
+Restrictions:
+    Run from the root of the project
+    Modules that aren't installed are skipped in the comparison
+
+To Do:
+    None
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+import os
+import sys
+import shutil
+import time
+import statistics
+import subprocess
+import tempfile
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+AGENT = os.path.join('plugins', 'junos', 'agent.py')
+RUNS = 20
+
+
+# A sample trigger event, as a Junos device would give the script
+SAMPLE_EVENT = '''
+from xml.etree import ElementTree
+
+Junos_Trigger_Event = ElementTree.fromstring("""
+<event-script-input>
+    <trigger-event>
+        <id>UI_COMMIT</id>
+        <process><name>mgd</name></process>
+        <hostname>bench-switch</hostname>
+        <message>UI_COMMIT: User 'admin' requested 'commit'</message>
+    </trigger-event>
+</event-script-input>
+""")
+'''
+
+
+# Import sets to compare
+#   The agent used to import requests, argparse, and JunosPyEZ every time
+IMPORTS = {
+    'Interpreter only': 'pass',
+    'Lean agent imports': 'import json, hmac, hashlib, fcntl, urllib.request',
+    'requests + argparse': 'import requests, argparse',
+    'JunosPyEZ': 'from jnpr.junos import Device',
+}
+
+
+class Receiver(BaseHTTPRequestHandler):
+    '''Accepts webhooks from the agent, and counts them'''
+    count = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        Receiver.count += 1
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Run a command several times, and return the times taken
+def time_runs(command, runs, env=None):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(command, env=env, capture_output=True)
+        times.append(time.perf_counter() - start)
+
+        if result.returncode != 0:
+            return None
+
+    return times
+
+
+# Print a line of results
+def show(name, times):
+    if times is None:
+        print(f"{name:<24} not available")
+        return
+
+    print(
+        f"{name:<24} min {min(times) * 1000:7.1f}ms  "
+        f"median {statistics.median(times) * 1000:7.1f}ms  "
+        f"max {max(times) * 1000:7.1f}ms"
+    )
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+
+    # Start the local webhook server
+    server = HTTPServer(('127.0.0.1', 0), Receiver)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_port}/'
+
+    print(f"Cold-start times over {runs} runs")
+    print()
+
+    # The import cost of each set of modules
+    for name, statement in IMPORTS.items():
+        show(name, time_runs([sys.executable, '-c', statement], runs))
+
+    # The agent, end to end
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, 'junos.py'), 'w') as file:
+            file.write(SAMPLE_EVENT)
+        agent = shutil.copy(AGENT, os.path.join(folder, 'junos-agent.py'))
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = folder
+        command = [
+            sys.executable, agent,
+            '-url', url,
+            '-secret', 'benchmark',
+            '-window', '0'
+        ]
+        show('Agent (send webhook)', time_runs(command, runs, env))
+
+    server.shutdown()
+    print()
+    print(f"Webhooks received: {Receiver.count}")
+
+
+if __name__ == '__main__':
+    main()
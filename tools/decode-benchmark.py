@@ -0,0 +1,153 @@
+"""
+Webhook decoding: Benchmark
+
+Decodes recorded webhooks with each method in core/decode.py, and compares
+    them with the standard json module (what Flask's request.json uses)
+    - json: The standard library
+    - loads: The fastest decoder installed (msgspec, orjson, or json)
+    - schema: Decoding into the plugin's payload schema (needs msgspec)
+    - incremental: Decoding a large list one item at a time
+
+Usage:
+    python tools/decode-benchmark.py [folder] [runs] [scale]
+
+    folder: Recorded webhooks (default tools/payloads)
+        Files are named <plugin>-<description>.json
+    runs: How many times each webhook is decoded (default 200)
+    scale: Repeat the items in each plugin's list this many times, to
+        test large webhooks (default 1)
+
+Authentication:
+    None
+
+Restrictions:
+    Run from the root of the project
+    Plugin schemas are read from the plugin modules; If a plugin can't be
+        imported, its webhooks are decoded without a schema
+
+To Do:
+    None
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+import os
+import sys
+import json
+import time
+import importlib
+
+sys.path.insert(0, os.getcwd())
+from core import decode   # noqa: E402
+
+
+FOLDER = os.path.join('tools', 'payloads')
+RUNS = 200
+SCALE = 1
+
+# Plugin modules, and the list each can decode incrementally
+PLUGINS = {
+    'mist': ('plugins.mist.misthandler', 'events'),
+    'junos': ('plugins.junos.junos', None),
+    'loginsight': ('plugins.loginsight.log_insight', None),
+    'crowdstrike': ('plugins.crowdstrike.crowdstrike', None),
+    'cloudflare': ('plugins.cloudflare.cloudflare', None),
+}
+
+
+# Get a plugin's payload schema, if it has one
+def plugin_schema(name):
+    if name not in PLUGINS:
+        return None
+
+    try:
+        module = importlib.import_module(PLUGINS[name][0])
+    except Exception as err:
+        print(f"  ({name} schema not available: {err})")
+        return None
+
+    return getattr(module, 'PAYLOAD_SCHEMA', None)
+
+
+# Read a webhook, repeating its list items to make it larger
+def load(filename, key, scale):
+    with open(filename, 'rb') as file:
+        body = file.read()
+
+    if scale > 1 and key:
+        payload = json.loads(body)
+        payload[key] = payload[key] * scale
+        body = json.dumps(payload).encode('utf-8')
+
+    return body
+
+
+# Time a decoding method
+#   Incrementally decoded lists are read, as a plugin would read them
+def run(method, body, runs, key=None):
+    start = time.perf_counter()
+    for _ in range(runs):
+        payload = method(body)
+        if key and not isinstance(payload[key], list):
+            for _ in payload[key]:
+                pass
+    return (time.perf_counter() - start) / runs
+
+
+# Print a line of results
+def show(name, seconds, baseline):
+    if seconds is None:
+        print(f"    {name:<14} not available")
+        return
+
+    print(
+        f"    {name:<14} {seconds * 1e6:10.1f}us  "
+        f"({baseline / seconds:5.2f}x json)"
+    )
+
+
+def main():
+    folder = sys.argv[1] if len(sys.argv) > 1 else FOLDER
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else RUNS
+    scale = int(sys.argv[3]) if len(sys.argv) > 3 else SCALE
+
+    print(f"Decoder: {decode.BACKEND}, {runs} runs, scale {scale}")
+    schemas = {}
+
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith('.json'):
+            continue
+
+        name = filename.split('-')[0]
+        if name not in schemas:
+            schemas[name] = plugin_schema(name)
+        schema = schemas[name]
+        key = PLUGINS.get(name, (None, None))[1]
+
+        body = load(os.path.join(folder, filename), key, scale)
+        print()
+        print(f"{filename} ({len(body)} bytes)")
+
+        baseline = run(json.loads, body, runs)
+        show('json', baseline, baseline)
+        show('loads', run(decode.loads, body, runs), baseline)
+
+        typed = decode.Decoder(schema)
+        if typed.typed is None:
+            show('schema', None, baseline)
+        else:
+            show('schema', run(typed.decode, body, runs), baseline)
+
+        # Force incremental decoding, whatever the size
+        if key:
+            stream = decode.Decoder(schema, key)
+            show(
+                'incremental',
+                run(stream.stream, body, runs, key),
+                baseline
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,810 @@
+"""
+Microsoft Graph: Local stand-in
+
+A local Graph API server, so the Teams and subscription code can be tested
+    and benchmarked without Microsoft's servers
+    - Chats: Send, update, and list messages; List a user's chats
+    - Subscriptions: Create, list, renew, and delete
+    - $batch: Up to 20 requests in one call
+    - Token endpoint: Issues test tokens (any code or refresh token works)
+
+Faults can be added to every call
+    --latency and --jitter: Delay each response
+    --limit: Requests per second allowed; Extra requests get 429, with a
+        Retry-After header, as Graph does when throttling
+    --error-rate: The share of requests that fail with --error-status
+
+Messages sent to a chat with a subscription cause a change notification,
+    sent to the subscription's notificationUrl, encrypted with its
+    certificate (as Graph does)
+    Messages sent through the API are from the chatbot, so the app ignores
+    them, as it does with Graph
+
+--notify sends change notifications from a user instead, to benchmark /chat
+    end to end (decrypt, parse, and reply through this server)
+    These are encrypted with --cert; Make a test certificate and key with
+    --make-cert, and set 'public_key' and 'private_key' in config.yaml
+
+Usage:
+    python tools/mock-graph.py [--port n] [--latency ms] [--jitter ms]
+        [--limit n] [--retry-after n] [--error-rate n] [--error-status n]
+        [--token-file file] [--skip-validation]
+    python tools/mock-graph.py --make-cert folder
+    python tools/mock-graph.py --notify n [--rate n] [--workers n]
+        [--chat-url url] [--chat id] [--sender name] [--text phrase]
+        [--cert file]
+
+    Set 'base_url' in the 'graph' section of config.yaml to
+        http://localhost:<port>/v1.0/
+    --token-file writes a test token, so the app doesn't need to log in
+    --skip-validation creates subscriptions without calling the app first
+    GET /mock/stats returns the calls made so far, by call and status
+
+Authentication:
+    Any Authorization header is accepted (401 if there isn't one)
+
+Restrictions:
+    Run from the root of the project
+    Needs pycryptodome (notifications) and cryptography (--make-cert),
+        which the app already uses
+    MSAL only accepts HTTPS authorities, and core/azureauth.py uses the
+        Microsoft login URL, so the token endpoint is for direct testing
+    Messages and subscriptions are kept in memory, and lost on restart
+
+To Do:
+    None
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+import os
+import sys
+import re
+import json
+import time
+import math
+import queue
+import uuid
+import hmac
+import base64
+import random
+import hashlib
+import argparse
+import functools
+import itertools
+import threading
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone, timedelta
+from urllib.parse import urlparse, parse_qs, unquote, quote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from Crypto.Cipher import PKCS1_OAEP, AES
+from Crypto.PublicKey import RSA
+from Crypto.Util.Padding import pad
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, os.getcwd())
+from config import GLOBAL, GRAPH, TEAMS   # noqa: E402
+
+
+PORT = 8081
+
+# Messages kept for each chat
+KEEP = 1000
+
+# The most requests in a $batch
+BATCH_LIMIT = 20
+
+# Path parts that are followed by an ID
+ID_PARTS = ('chats', 'messages', 'users', 'subscriptions')
+
+
+# A Graph error response
+def error(status, code, message, headers=None):
+    body = {
+        'error': {
+            'code': code,
+            'message': message,
+            'innerError': {
+                'date': now(),
+                'request-id': str(uuid.uuid4()),
+            }
+        }
+    }
+    return status, body, headers or {}
+
+
+# The time, in Graph's format
+def now(offset=0):
+    when = datetime.now(timezone.utc) + timedelta(seconds=offset)
+    return when.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+# Read a Graph time (which may have 7 decimal places)
+def parse_time(value):
+    value = re.sub(r'(\.\d{6})\d+', r'\1', value.replace('Z', '+00:00'))
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when
+
+
+# The name of a call, for stats (eg, POST chats/{id}/messages)
+def call_name(method, parts):
+    if 'oauth2' in parts:
+        return 'POST token'
+
+    return method + ' ' + '/'.join(
+        '{id}' if number and parts[number - 1] in ID_PARTS else part
+        for number, part in enumerate(parts)
+    )
+
+
+# Import a public key, from a PEM certificate or a base64 DER certificate
+@functools.lru_cache(maxsize=16)
+def public_key(certificate):
+    if '-----BEGIN' in certificate:
+        return RSA.import_key(certificate)
+    return RSA.import_key(base64.b64decode(certificate))
+
+
+# Encrypt a message for a change notification, as Graph does
+#   The AES key is encrypted with the certificate (RSA OAEP), and the
+#   encrypted data is signed with the AES key (HMAC-SHA256)
+def encrypt(message, subscription):
+    key = os.urandom(32)
+    cipher = AES.new(key, AES.MODE_CBC, iv=key[:16])
+    data = cipher.encrypt(pad(json.dumps(message).encode('utf-8'), 16))
+
+    rsa_key = public_key(subscription['encryptionCertificate'])
+    data_key = PKCS1_OAEP.new(rsa_key).encrypt(key)
+    signature = hmac.new(key, msg=data, digestmod=hashlib.sha256).digest()
+
+    return {
+        'data': base64.b64encode(data).decode(),
+        'dataSignature': base64.b64encode(signature).decode(),
+        'dataKey': base64.b64encode(data_key).decode(),
+        'encryptionCertificateId': subscription['encryptionCertificateId'],
+        'encryptionCertificateThumbprint': '',
+    }
+
+
+# A change notification for a new message
+def notification(message, subscription):
+    chat = message['chatId']
+    return {
+        'value': [{
+            'subscriptionId': subscription['id'],
+            'changeType': 'created',
+            'clientState': None,
+            'subscriptionExpirationDateTime':
+                subscription['expirationDateTime'],
+            'resource': f"chats('{chat}')/messages('{message['id']}')",
+            'resourceData': {
+                'id': message['id'],
+                '@odata.type': '#Microsoft.Graph.chatMessage',
+                '@odata.id':
+                    f"chats('{chat}')/messages('{message['id']}')",
+            },
+            'encryptedContent': encrypt(message, subscription),
+            'tenantId': TEAMS['tenant'],
+        }]
+    }
+
+
+# A chat message, as Graph stores it
+def chat_message(message_id, chat, sender, content):
+    return {
+        'id': message_id,
+        'chatId': chat,
+        'messageType': 'message',
+        'createdDateTime': now(),
+        'lastModifiedDateTime': now(),
+        'from': {
+            'user': {
+                'id': str(uuid.uuid5(uuid.NAMESPACE_OID, sender)),
+                'displayName': sender,
+                'userIdentityType': 'aadUser',
+            }
+        },
+        'body': content,
+    }
+
+
+# POST JSON (or nothing) to a URL; Returns the status, or the error
+def post(url, body=None, timeout=10):
+    data = b'' if body is None else json.dumps(body).encode('utf-8')
+    request = urllib.request.Request(
+        url,
+        data=data,
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as err:
+        return err.code, b''
+    except Exception as err:
+        return str(err), b''
+
+
+class Graph():
+    # Chats, subscriptions, and faults, shared by all request threads
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.chats = {}
+        self.subscriptions = {}
+        self.stats = {}
+        self.ids = itertools.count()
+        self.tokens = args.limit
+        self.refilled = time.monotonic()
+
+    # Count a call, by name and status
+    def count(self, name, status):
+        with self.lock:
+            key = f"{name} {status}"
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    # Throttle or fail a call, if it's due
+    #   Throttling is a token bucket, refilled at --limit per second
+    def fault(self):
+        if self.args.limit:
+            with self.lock:
+                clock = time.monotonic()
+                self.tokens = min(
+                    self.args.limit,
+                    self.tokens + (clock - self.refilled) * self.args.limit
+                )
+                self.refilled = clock
+
+                if self.tokens < 1:
+                    return error(
+                        429,
+                        'TooManyRequests',
+                        'Too many requests, retry later',
+                        {'Retry-After': str(self.args.retry_after)}
+                    )
+                self.tokens -= 1
+
+        if random.random() < self.args.error_rate:
+            return error(
+                self.args.error_status,
+                'ServiceNotAvailable',
+                'Injected error'
+            )
+
+        return None
+
+    # Handle a call, after faults and authentication
+    #   Returns the status, body, and extra headers
+    def call(self, method, path, raw, headers, batch=False):
+        parts = [unquote(part) for part in path.split('/') if part]
+        if parts[:1] == ['v1.0']:
+            parts = parts[1:]
+        name = call_name(method, parts)
+
+        if parts == ['mock', 'stats']:
+            with self.lock:
+                return 200, dict(sorted(self.stats.items())), {}
+
+        # A $batch is delayed once, not for each request in it
+        if not batch:
+            time.sleep(
+                self.args.latency / 1000 +
+                random.uniform(0, self.args.jitter) / 1000
+            )
+
+        result = self.fault()
+        if result is None:
+            if 'oauth2' in parts or '.well-known' in parts:
+                result = self.login(parts, raw, headers)
+            elif not headers.get('Authorization'):
+                result = error(
+                    401,
+                    'InvalidAuthenticationToken',
+                    'Access token is empty.'
+                )
+            else:
+                try:
+                    body = json.loads(raw) if raw else {}
+                    result = self.route(method, parts, body, headers)
+                except ValueError:
+                    result = error(400, 'BadRequest', 'Invalid JSON')
+
+        self.count(name, result[0])
+        return result
+
+    # Graph calls
+    def route(self, method, parts, body, headers):
+        match (method, parts):
+            case ('POST', ['$batch']):
+                return self.batch(body, headers)
+
+            case ('POST', ['chats', chat, 'messages']):
+                return self.send(chat, body)
+
+            case ('GET', ['chats', chat, 'messages']):
+                with self.lock:
+                    messages = list(self.chats.get(chat, {}).values())
+                return 200, {'value': messages[::-1]}, {}
+
+            case ('PATCH', ['chats', chat, 'messages', message_id]):
+                with self.lock:
+                    message = self.chats.get(chat, {}).get(message_id)
+                    if message is None:
+                        return error(404, 'NotFound', 'Message not found')
+                    message['body'] = body.get('body', message['body'])
+                    message['lastModifiedDateTime'] = now()
+                return 204, None, {}
+
+            case ('GET', ['users', _, 'chats']):
+                with self.lock:
+                    chats = list(self.chats)
+                return 200, {'value': [
+                    {
+                        'id': chat,
+                        'topic': chat,
+                        'chatType': 'group',
+                        'members': [],
+                    }
+                    for chat in chats
+                ]}, {}
+
+            case ('GET', ['subscriptions']):
+                with self.lock:
+                    self.expire()
+                    subscriptions = list(self.subscriptions.values())
+                return 200, {'value': subscriptions}, {}
+
+            case ('POST', ['subscriptions']):
+                return self.subscribe(body)
+
+            case ('PATCH', ['subscriptions', sub_id]):
+                with self.lock:
+                    subscription = self.subscriptions.get(sub_id)
+                    if subscription is None:
+                        return error(
+                            404,
+                            'ResourceNotFound',
+                            'The object was not found.'
+                        )
+                    if 'expirationDateTime' in body:
+                        subscription['expirationDateTime'] = \
+                            body['expirationDateTime']
+                return 200, dict(subscription), {}
+
+            case ('DELETE', ['subscriptions', sub_id]):
+                with self.lock:
+                    if self.subscriptions.pop(sub_id, None) is None:
+                        return error(
+                            404,
+                            'ResourceNotFound',
+                            'The object was not found.'
+                        )
+                return 204, None, {}
+
+        return error(404, 'UnknownError', 'Resource not found')
+
+    # Token and discovery endpoints
+    def login(self, parts, raw, headers):
+        tenant = parts[0] if parts else 'common'
+
+        if parts[-2:] == ['.well-known', 'openid-configuration']:
+            base = f"http://{headers.get('Host', 'localhost')}/{tenant}"
+            return 200, {
+                'issuer': f"{base}/v2.0",
+                'authorization_endpoint': f"{base}/oauth2/v2.0/authorize",
+                'token_endpoint': f"{base}/oauth2/v2.0/token",
+            }, {}
+
+        form = {
+            key: values[0]
+            for key, values in parse_qs(raw.decode('utf-8')).items()
+        }
+        grant = form.get('grant_type')
+        if grant not in (
+            'authorization_code',
+            'refresh_token',
+            'client_credentials'
+        ):
+            return 400, {
+                'error': 'unsupported_grant_type',
+                'error_description': f"Grant type '{grant}' is not valid",
+            }, {}
+
+        return 200, token(form.get('scope', '')), {}
+
+    # Run each request in a $batch
+    def batch(self, body, headers):
+        requests = body.get('requests', [])
+        if len(requests) > BATCH_LIMIT:
+            return error(
+                400,
+                'BadRequest',
+                f"A batch can't have more than {BATCH_LIMIT} requests"
+            )
+
+        responses = []
+        for item in requests:
+            url = urlparse(item.get('url', ''))
+            status, result, extra = self.call(
+                item.get('method', 'GET').upper(),
+                url.path,
+                json.dumps(item['body']).encode() if 'body' in item else b'',
+                {**headers, **item.get('headers', {})},
+                batch=True
+            )
+            response = {'id': item.get('id'), 'status': status}
+            if extra:
+                response['headers'] = extra
+            if result is not None:
+                response['body'] = result
+            responses.append(response)
+
+        return 200, {'responses': responses}, {}
+
+    # Send a message from the chatbot, and notify subscribers
+    def send(self, chat, body):
+        content = body.get('body')
+        if not isinstance(content, dict) or 'content' not in content:
+            return error(400, 'BadRequest', 'Message body is missing')
+
+        message_id = f"{int(time.time() * 1000)}{next(self.ids) % 1000:03d}"
+        message = chat_message(
+            message_id,
+            chat,
+            GLOBAL['chatbot_name'],
+            content
+        )
+        self.store(message)
+
+        return 201, message, {}
+
+    # Keep a message, and send change notifications for it
+    def store(self, message):
+        chat = message['chatId']
+        with self.lock:
+            messages = self.chats.setdefault(chat, {})
+            messages[message['id']] = message
+            if len(messages) > KEEP:
+                messages.pop(next(iter(messages)))
+
+            self.expire()
+            subscriptions = [
+                subscription
+                for subscription in self.subscriptions.values()
+                if subscription['resource'].strip('/') in (
+                    f"chats/{chat}/messages",
+                    f"users/{TEAMS['user_id']}/chats/getAllMessages",
+                )
+            ]
+
+        for subscription in subscriptions:
+            threading.Thread(
+                target=self.notify,
+                args=(message, subscription),
+                daemon=True
+            ).start()
+
+    # Send a change notification to a subscriber
+    def notify(self, message, subscription):
+        try:
+            body = notification(message, subscription)
+        except Exception as err:
+            print(f"Could not encrypt a notification: {err}")
+            self.count('notify', 'error')
+            return
+
+        status, _ = post(subscription['notificationUrl'], body)
+        self.count('notify', status)
+
+    # Create a subscription, after checking the app responds to it
+    def subscribe(self, body):
+        for field in (
+            'resource',
+            'notificationUrl',
+            'changeType',
+            'expirationDateTime'
+        ):
+            if field not in body:
+                return error(
+                    400,
+                    'ValidationError',
+                    f"Subscription is missing '{field}'"
+                )
+
+        resource_data = str(body.get('includeResourceData')).lower()
+        if resource_data == 'true' and not body.get('encryptionCertificate'):
+            return error(
+                400,
+                'ValidationError',
+                'An encryption certificate is needed for resource data'
+            )
+
+        try:
+            parse_time(body['expirationDateTime'])
+        except ValueError:
+            return error(400, 'ValidationError', 'Invalid expiry time')
+
+        # Graph checks the notification URL echoes a validation token
+        if not self.args.skip_validation:
+            check = str(uuid.uuid4())
+            joiner = '&' if '?' in body['notificationUrl'] else '?'
+            status, text = post(
+                f"{body['notificationUrl']}{joiner}validationToken="
+                f"{quote(check)}"
+            )
+            if status != 200 or text.decode('utf-8', 'replace') != check:
+                return error(
+                    400,
+                    'ValidationError',
+                    'Subscription validation request failed. '
+                    f"Response: {status}"
+                )
+
+        subscription = {
+            'id': str(uuid.uuid4()),
+            'resource': body['resource'],
+            'changeType': body['changeType'],
+            'notificationUrl': body['notificationUrl'],
+            'expirationDateTime': body['expirationDateTime'],
+            'includeResourceData': resource_data == 'true',
+            'encryptionCertificate': body.get('encryptionCertificate'),
+            'encryptionCertificateId': body.get('encryptionCertificateId'),
+        }
+        with self.lock:
+            self.subscriptions[subscription['id']] = subscription
+
+        return 201, dict(subscription), {}
+
+    # Remove expired subscriptions (call with the lock held)
+    def expire(self):
+        current = datetime.now(timezone.utc)
+        for sub_id, subscription in list(self.subscriptions.items()):
+            try:
+                expiry = parse_time(subscription['expirationDateTime'])
+            except ValueError:
+                continue
+            if expiry < current:
+                del self.subscriptions[sub_id]
+
+
+# A test token, in the format the token endpoint returns
+def token(scope=''):
+    return {
+        'token_type': 'Bearer',
+        'scope': scope,
+        'expires_in': 3600,
+        'ext_expires_in': 3600,
+        'access_token': f"mock-{uuid.uuid4()}",
+        'refresh_token': f"mock-refresh-{uuid.uuid4()}",
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Passes HTTP requests to the shared Graph object
+    protocol_version = 'HTTP/1.1'
+    graph = None
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def do_PATCH(self):
+        self.respond('PATCH')
+
+    def do_DELETE(self):
+        self.respond('DELETE')
+
+    def respond(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+
+        status, body, headers = self.graph.call(
+            method,
+            urlparse(self.path).path,
+            raw,
+            self.headers
+        )
+
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Make a self-signed test certificate and private key
+def make_cert(folder):
+    os.makedirs(folder, exist_ok=True)
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, 'network-assistant-test')
+    ])
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(start)
+        .not_valid_after(start + timedelta(days=366))
+        .sign(key, hashes.SHA256())
+    )
+
+    cert_file = os.path.join(folder, 'test-cert.pem')
+    key_file = os.path.join(folder, 'test-key.pem')
+    with open(cert_file, 'wb') as file:
+        file.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, 'wb') as file:
+        file.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ))
+
+    print("Test certificate written; Set these in the 'teams' section:")
+    print(f"  public_key: '{cert_file}'")
+    print(f"  private_key: '{key_file}'")
+
+
+# Nearest rank percentile, from sorted values
+def percentile(values, number):
+    rank = math.ceil(number / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+# Send change notifications from a user to /chat, and time them
+def benchmark(args):
+    with open(args.cert) as file:
+        subscription = {
+            'id': 'benchmark',
+            'expirationDateTime': now(3600),
+            'encryptionCertificate': file.read(),
+            'encryptionCertificateId': GRAPH['key_id'],
+        }
+
+    jobs = queue.Queue()
+    results = []
+
+    # Send notifications when they're due, and record the results
+    def worker():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+
+            number, due = job
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+            message = chat_message(
+                f"{int(time.time() * 1000)}{number % 1000:03d}",
+                args.chat,
+                args.sender,
+                {'contentType': 'html', 'content': args.text}
+            )
+            status, text = post(
+                args.chat_url,
+                notification(message, subscription)
+            )
+            results.append((
+                status == 200 and text != b'Error',
+                time.perf_counter() - due
+            ))
+
+    print(f"Sending {args.notify} notifications to {args.chat_url}")
+    threads = [
+        threading.Thread(target=worker) for _ in range(args.workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Schedule every notification up front, one every 1/rate seconds
+    start = time.perf_counter() + 0.5
+    for number in range(args.notify):
+        jobs.put((number, start + number / args.rate))
+    for _ in threads:
+        jobs.put(None)
+    for thread in threads:
+        thread.join()
+
+    seconds = time.perf_counter() - start
+    latencies = sorted(latency * 1000 for _, latency in results)
+    errors = sum(1 for ok, _ in results if not ok)
+    print(
+        f"{len(results)} sent, {errors} errors, "
+        f"{len(results) / seconds:.1f}/s; "
+        f"p50 {percentile(latencies, 50):.1f}ms, "
+        f"p95 {percentile(latencies, 95):.1f}ms, "
+        f"p99 {percentile(latencies, 99):.1f}ms"
+    )
+
+
+# Print the calls made, by call and status
+def report(graph):
+    print()
+    with graph.lock:
+        for key, value in sorted(graph.stats.items()):
+            print(f"{key:<48}{value:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local Graph API')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--limit', type=float, default=0)
+    parser.add_argument('--retry-after', type=int, default=5)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--token-file', default='')
+    parser.add_argument('--skip-validation', action='store_true')
+    parser.add_argument('--make-cert', default='')
+    parser.add_argument('--notify', type=int, default=0)
+    parser.add_argument('--rate', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument(
+        '--chat-url',
+        default=f"http://localhost:{GLOBAL['web_port']}/chat"
+    )
+    parser.add_argument('--chat', default=(TEAMS['approved_ids'] or [''])[0])
+    parser.add_argument('--sender', default='Mock User')
+    parser.add_argument('--text', default='hello')
+    parser.add_argument('--cert', default=TEAMS['public_key'])
+    args = parser.parse_args()
+
+    if args.make_cert:
+        make_cert(args.make_cert)
+        return
+
+    if args.token_file:
+        with open(args.token_file, 'w') as file:
+            json.dump(token(), file)
+        print(f"Test token written to {args.token_file}")
+
+    Handler.graph = graph = Graph(args)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    server.daemon_threads = True
+    print(
+        f"Graph API at http://127.0.0.1:{args.port}/v1.0/ "
+        f"(latency {args.latency}ms, limit {args.limit or 'none'}/s, "
+        f"errors {args.error_rate:.1%})"
+    )
+
+    if args.notify:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        benchmark(args)
+
+        # Give the app time to finish its replies
+        time.sleep(1)
+        report(graph)
+        return
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        report(graph)
+
+
+if __name__ == '__main__':
+    main()
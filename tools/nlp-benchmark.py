@@ -0,0 +1,422 @@
+"""
+Natural Language Processor: Benchmark
+
+Measures nlp.ChatNlp as the device inventory and phrase catalog grow
+    - Construction: Total time, and the time to load the spaCy model, read
+        the device file, add entity patterns, and build the phrase docs
+    - Memory: Resident memory before and after construction, and the peak
+    - Parsing: Latency of each stage, for a mix of chat messages
+        cleanup: cleanup_text()
+        similarity: The rest of chatbot() (building docs, and comparing
+            them with every known phrase)
+        entities: get_ents()
+
+Each inventory and catalog size runs in a new process, so construction
+    time and memory aren't affected by earlier runs
+Inventories are synthetic devices.yaml files (20 devices per site)
+Catalogs are the built-in phrases, plus generated phrases (eg, 'show
+    failed tunnels') up to the size needed
+
+Results are saved as JSON, named with the git commit, so runs can be
+    compared between commits with --compare
+
+Usage:
+    python tools/nlp-benchmark.py [--devices n ...] [--phrases n ...]
+        [--messages n] [--output folder] [--compare file]
+
+    --devices: Inventory sizes (default 100 10000 100000)
+    --phrases: Catalog sizes (default 20 200 2000)
+    --messages: Chat messages parsed for each size (default 200)
+    --output: Where results are saved (default benchmarks)
+    --compare: Earlier results, to show the change for each size
+
+Authentication:
+    None
+
+Restrictions:
+    Run from the root of the project
+    Needs spaCy, and the en_core_web_md model
+    Memory is read with psutil if it's installed, or from /proc on Linux;
+        Peak memory needs the resource module (not on Windows)
+    Plugin phrases and entities aren't loaded (plugins aren't started)
+
+To Do:
+    None
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+import os
+import sys
+import io
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+import contextlib
+from datetime import datetime
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.getcwd())
+
+
+DEVICES = [100, 10000, 100000]
+PHRASES = [20, 200, 2000]
+MESSAGES = 200
+OUTPUT = 'benchmarks'
+
+# Devices in each site of a synthetic inventory
+SITE_SIZE = 20
+
+# Words for generated phrases
+VERBS = (
+    'show', 'list', 'check', 'get', 'restart',
+    'clear', 'count', 'find', 'reset', 'test',
+)
+OBJECTS = (
+    'interfaces', 'alarms', 'routes', 'neighbours', 'logs',
+    'users', 'vlans', 'ports', 'sessions', 'config',
+    'power', 'firmware', 'licences', 'uptime', 'clients',
+    'tunnels', 'policies', 'errors', 'temperature', 'memory',
+)
+QUALIFIERS = (
+    '', 'all', 'active', 'recent', 'failed',
+    'new', 'old', 'down', 'up', 'blocked',
+)
+
+# Chat messages; {device} is replaced with a device from the inventory
+MESSAGE_TEMPLATES = (
+    'hello',
+    'tell me a joke',
+    'what day is it?',
+    'list jobs',
+    'show maintenance',
+    'show interfaces on {device}',
+    'check alarms for {device}',
+    'restart {device} at 5pm',
+    'get recent logs from {device} please',
+    'are you a real person?',
+    'shwo intrefaces',
+)
+
+# Parse stages, in the order they run
+STAGES = ('cleanup', 'similarity', 'entities', 'match')
+
+
+# Write a synthetic device file
+def write_inventory(folder, count):
+    filename = os.path.join(folder, f"devices-{count}.yaml")
+    devices = [
+        f"site{number // SITE_SIZE:05d}-sw{number % SITE_SIZE:02d}"
+        for number in range(count)
+    ]
+
+    with open(filename, 'w') as file:
+        for start in range(0, count, SITE_SIZE):
+            file.write(f"---\nsite: site{start // SITE_SIZE:05d}\n")
+            file.write("devices:\n")
+            for device in devices[start:start + SITE_SIZE]:
+                file.write(f"  - {device}\n")
+
+    return filename, devices
+
+
+# The built-in phrases, plus generated phrases up to the count
+def phrase_catalog(known, count):
+    catalog = list(known[:count])
+    generated = (
+        ' '.join(word for word in (verb, qualifier, item) if word)
+        for qualifier, item, verb in itertools.product(
+            QUALIFIERS, OBJECTS, VERBS
+        )
+    )
+
+    for phrase in generated:
+        if len(catalog) >= count:
+            break
+        catalog.append({
+            'phrase': phrase,
+            'function': 'greeting',
+            'module': 'global',
+        })
+
+    return catalog
+
+
+# Resident memory in bytes (None if it can't be read)
+def rss():
+    if psutil:
+        return psutil.Process().memory_info().rss
+
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Peak resident memory in bytes (None if it can't be read)
+def peak():
+    if resource is None:
+        return None
+
+    # Linux reports kilobytes, macOS reports bytes
+    value = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return value if sys.platform == 'darwin' else value * 1024
+
+
+# Nearest rank percentile, from sorted values
+def percentile(values, number):
+    rank = math.ceil(number / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+# Mean and percentiles, in milliseconds
+def summary(values):
+    values = sorted(value * 1000 for value in values)
+    return {
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+    }
+
+
+# Wrap a function, adding the time it takes to a stage
+def timed(times, stage, function):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            times[stage] = times.get(stage, 0) + time.perf_counter() - start
+    return wrapper
+
+
+# Build ChatNlp and parse messages, for one inventory and catalog size
+#   This runs in its own process, and prints its results as JSON
+def child(devices, phrases, messages):
+    import spacy
+    from spacy.language import Language
+    from config import LANGUAGE
+    import nlp.nlp as chat_nlp
+
+    folder = tempfile.mkdtemp()
+    LANGUAGE['device_file'], names = write_inventory(folder, devices)
+    LANGUAGE['log_unknown'] = False
+    chat_nlp.known_phrases[:] = phrase_catalog(
+        list(chat_nlp.known_phrases),
+        phrases
+    )
+
+    # Time each part of construction
+    build = {}
+    spacy.load = timed(build, 'model', spacy.load)
+    chat_nlp.load_devices = timed(build, 'device_file', chat_nlp.load_devices)
+    add_pipe = Language.add_pipe
+
+    def timed_add_pipe(self, *args, **kwargs):
+        pipe = add_pipe(self, *args, **kwargs)
+        pipe.add_patterns = timed(build, 'patterns', pipe.add_patterns)
+        return pipe
+
+    Language.add_pipe = timed_add_pipe
+
+    before = rss()
+    start = time.perf_counter()
+    bot = chat_nlp.ChatNlp()
+    build['total'] = time.perf_counter() - start
+    build['phrase_docs'] = build['total'] - sum(
+        build.get(stage, 0) for stage in ('model', 'device_file', 'patterns')
+    )
+    after = rss()
+
+    # Parse messages, timing each stage
+    random.seed(devices + phrases)
+    parse = {stage: [] for stage in STAGES}
+    times = {}
+    bot.cleanup_text = timed(times, 'cleanup', bot.cleanup_text)
+
+    for _ in range(messages):
+        message = random.choice(MESSAGE_TEMPLATES).format(
+            device=random.choice(names)
+        )
+
+        # chatbot() prints debug information for every message
+        times.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            bot.chatbot(message)
+            match = time.perf_counter() - start
+
+            start = time.perf_counter()
+            bot.get_ents(message)
+            entities = time.perf_counter() - start
+
+        parse['cleanup'].append(times.get('cleanup', 0))
+        parse['similarity'].append(match - times.get('cleanup', 0))
+        parse['entities'].append(entities)
+        parse['match'].append(match)
+
+    print(json.dumps({
+        'devices': devices,
+        'phrases': phrases,
+        'construct': {stage: value * 1000 for stage, value in build.items()},
+        'memory': {'before': before, 'after': after, 'peak': peak()},
+        'parse': {stage: summary(values) for stage, values in parse.items()},
+        'spacy': spacy.__version__,
+    }))
+
+
+# The current git commit, to name the results
+def commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+# Megabytes, or '-' if memory couldn't be read
+def megabytes(value):
+    return '-' if value is None else f"{value / 1048576:.0f}"
+
+
+# Print results, with the change from earlier results if given
+def report(results, previous=None):
+    earlier = {
+        (item['devices'], item['phrases']): item
+        for item in (previous or {}).get('results', [])
+    }
+
+    print()
+    print(
+        f"{'Devices':>8}{'Phrases':>8}{'Build s':>9}{'Model s':>9}"
+        f"{'RSS MB':>8}{'Peak MB':>9}{'Clean ms':>10}{'Sim ms':>9}"
+        f"{'Ents ms':>9}{'Match p99':>11}"
+    )
+    for item in results:
+        build = item['construct']
+        parse = item['parse']
+        print(
+            f"{item['devices']:>8}{item['phrases']:>8}"
+            f"{build['total'] / 1000:>9.2f}{build['model'] / 1000:>9.2f}"
+            f"{megabytes(item['memory']['after']):>8}"
+            f"{megabytes(item['memory']['peak']):>9}"
+            f"{parse['cleanup']['p50']:>10.2f}"
+            f"{parse['similarity']['p50']:>9.2f}"
+            f"{parse['entities']['p50']:>9.2f}"
+            f"{parse['match']['p99']:>11.2f}"
+        )
+
+        old = earlier.get((item['devices'], item['phrases']))
+        if old:
+            changes = []
+            for name, new_value, old_value in (
+                ('build', build['total'], old['construct']['total']),
+                ('match p50', parse['match']['p50'],
+                 old['parse']['match']['p50']),
+                ('match p99', parse['match']['p99'],
+                 old['parse']['match']['p99']),
+                ('entities p50', parse['entities']['p50'],
+                 old['parse']['entities']['p50']),
+            ):
+                if old_value:
+                    changes.append(
+                        f"{name} {(new_value - old_value) / old_value:+.0%}"
+                    )
+            print(f"{'':>16}vs {previous['commit']}: {', '.join(changes)}")
+
+    print("(Parse stages are p50; Match is cleanup and similarity together)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NLP benchmark')
+    parser.add_argument('--devices', type=int, nargs='+', default=DEVICES)
+    parser.add_argument('--phrases', type=int, nargs='+', default=PHRASES)
+    parser.add_argument('--messages', type=int, default=MESSAGES)
+    parser.add_argument('--output', default=OUTPUT)
+    parser.add_argument('--compare', default='')
+    parser.add_argument(
+        '--child',
+        type=int,
+        nargs=2,
+        help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child, args.messages)
+        return
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+
+    results = []
+    for devices, phrases in itertools.product(args.devices, args.phrases):
+        print(f"Running {devices} devices, {phrases} phrases...")
+        process = subprocess.run(
+            [
+                sys.executable, __file__,
+                '--child', str(devices), str(phrases),
+                '--messages', str(args.messages),
+            ],
+            capture_output=True,
+            text=True
+        )
+
+        # Results are the last line; Anything before is from spaCy/config
+        lines = process.stdout.strip().splitlines()
+        if process.returncode or not lines:
+            errors = process.stderr.strip().splitlines() or ['No results']
+            print(f"  Failed: {errors[-1]}")
+            continue
+        results.append(json.loads(lines[-1]))
+
+    if not results:
+        return
+
+    label = commit()
+    report(results, previous)
+
+    os.makedirs(args.output, exist_ok=True)
+    filename = os.path.join(
+        args.output,
+        f"nlp-{label}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    with open(filename, 'w') as file:
+        json.dump({
+            'commit': label,
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'messages': args.messages,
+            'results': results,
+        }, file, indent=2)
+    print(f"Results saved to {filename}")
+
+
+if __name__ == '__main__':
+    main()
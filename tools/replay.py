@@ -0,0 +1,342 @@
+"""
+Webhook replay: Load test
+
+Sends recorded, captured, or synthetic webhooks to the web service at a
+    steady rate, and reports throughput, errors, and latency for each route
+
+Webhooks are sent on a fixed schedule (open loop), and latency is timed
+    from when each webhook was due, not when it was sent
+    If the service falls behind, the queueing delay is included, as it
+    would be for real webhooks
+
+By default, the app (web-service.py) is started here, with stand-in sinks
+    Teams, SQL, and email calls are replaced with a delay, and counted
+    Microsoft authentication and chat subscriptions are skipped
+    Webhook authentication is skipped, as captured webhooks are redacted
+Use --url to test a running service instead (sinks are real there)
+
+Usage:
+    python tools/replay.py [--source folder] [--synthetic] [--rate n]
+        [--duration n] [--workers n] [--url url] [--sink-delay ms]
+        [--plugins name ...]
+
+    --source: A folder of webhooks (default tools/payloads)
+        Recorded webhooks are named <plugin>-<description>.json
+        Captured webhooks (core/capture.py) are <plugin>-*.jsonl.gz
+    --synthetic: Give each webhook new device names and times
+    --rate: Webhooks per second, across all routes (default 20)
+    --duration: Seconds to send for (default 30)
+    --workers: Webhooks sent at once (default 16)
+    --url: The base URL of a running service (eg, http://localhost:8080)
+    --sink-delay: Milliseconds each stand-in sink call takes (default 50)
+    --plugins: Only send webhooks for these plugins
+
+Authentication:
+    None
+
+Restrictions:
+    Run from the root of the project
+    Running the app here needs its dependencies (Flask, spaCy, etc)
+
+To Do:
+    None
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+import os
+import sys
+import json
+import gzip
+import glob
+import time
+import math
+import queue
+import random
+import argparse
+import threading
+import itertools
+import http.client
+import importlib.util
+from urllib.parse import urlparse
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.getcwd())
+
+
+FOLDER = os.path.join('tools', 'payloads')
+
+# Fields that name a device, changed in synthetic webhooks
+DEVICE_KEYS = ('hostname', 'device_name', 'detections.hostname', 'name')
+
+# Fields that hold a time, set to now in synthetic webhooks
+TIME_KEYS = ('timestamp', 'time', 'ts')
+
+# Headers that shouldn't be replayed
+SKIP_HEADERS = ('host', 'content-length', 'connection')
+
+# Calls to the stand-in sinks
+sinks = {'teams': 0, 'edits': 0, 'sql rows': 0, 'email': 0}
+sinks_lock = threading.Lock()
+
+
+# Read recorded (.json) and captured (.jsonl.gz) webhooks
+#   Returns a list of (plugin, route, headers, body)
+def load(folder, routes, plugins):
+    webhooks = []
+
+    for filename in sorted(glob.glob(os.path.join(folder, '*.json'))):
+        plugin = os.path.basename(filename).split('-')[0]
+        with open(filename, 'rb') as file:
+            body = file.read()
+        webhooks.append((
+            plugin,
+            routes.get(plugin, plugin),
+            {'Content-Type': 'application/json'},
+            body
+        ))
+
+    for filename in sorted(glob.glob(os.path.join(folder, '*.jsonl.gz'))):
+        plugin = os.path.basename(filename).split('-')[0]
+        try:
+            with gzip.open(filename, 'rt') as file:
+                for line in file:
+                    record = json.loads(line)
+                    headers = {
+                        name: value
+                        for name, value in record['headers'].items()
+                        if name.lower() not in SKIP_HEADERS
+                    }
+                    if 'body' in record:
+                        body = json.dumps(record['body']).encode('utf-8')
+                    else:
+                        body = record['text'].encode('utf-8')
+                    webhooks.append(
+                        (plugin, record['route'], headers, body)
+                    )
+
+        # Files still being written may end part way through a line
+        except (EOFError, ValueError) as err:
+            print(f"  ({filename} ends early: {err})")
+
+    if plugins:
+        webhooks = [hook for hook in webhooks if hook[0] in plugins]
+
+    return webhooks
+
+
+# Change device names and times, so each webhook looks like a new event
+def synthesise(value, number, key=''):
+    if isinstance(value, dict):
+        return {
+            name: synthesise(item, number, name)
+            for name, item in value.items()
+        }
+
+    if isinstance(value, list):
+        return [synthesise(item, number, key) for item in value]
+
+    if key in DEVICE_KEYS and isinstance(value, str):
+        return f"{value}-{number}"
+
+    if key in TIME_KEYS:
+        now = time.time()
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, (int, float)):
+            return int(now * 1000) if value > 1e11 else int(now)
+        if isinstance(value, str):
+            return datetime.now(timezone.utc).isoformat()
+
+    return value
+
+
+# Replace Teams, SQL, and email with a delay, and count the calls
+def stand_in_sinks(delay):
+    from core import azureauth, teamschat, sql, smtp
+
+    ids = itertools.count(1)
+
+    def count(sink, amount=1):
+        time.sleep(delay)
+        with sinks_lock:
+            sinks[sink] += amount
+
+    def send_chat(message, chat_msg_id):
+        count('teams')
+        return {'id': f"replay-{next(ids)}"}
+
+    def update_chat(message, chat_msg_id, message_id):
+        count('edits')
+        return True
+
+    def add(self, table, fields):
+        count('sql rows')
+        return True
+
+    def add_many(self, table, rows):
+        count('sql rows', len(rows))
+        return True
+
+    def send_mail(message, receivers=None, subject=None, html=False):
+        count('email')
+        return True
+
+    azureauth.AzureAuth.client_auth = lambda self: None
+    teamschat.notification_refresh = lambda: None
+    teamschat.send_chat = send_chat
+    teamschat.update_chat = update_chat
+    sql.Sql.__init__ = lambda self: None
+    sql.Sql.add = add
+    sql.Sql.add_many = add_many
+    smtp.send_mail = send_mail
+
+
+# Start the app here, with stand-in sinks
+#   Returns the base URL
+def start_app(delay):
+    stand_in_sinks(delay)
+
+    spec = importlib.util.spec_from_file_location(
+        'web_service',
+        'web-service.py'
+    )
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+
+    # Captured webhooks are redacted, so they can't be authenticated
+    for plugin in app.plugin_list:
+        plugin['handler'].authenticate = lambda **kwargs: True
+
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+# Send webhooks when they're due, and record the results
+def worker(url, jobs, results):
+    target = urlparse(url)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+
+        due, route, headers, body = job
+        wait = due - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+        ok = False
+        try:
+            connection = http.client.HTTPConnection(
+                target.hostname,
+                target.port or 80,
+                timeout=30
+            )
+            connection.request('POST', f"/{route}", body, headers)
+            response = connection.getresponse()
+            text = response.read()
+            connection.close()
+            ok = response.status == 200 and not text.startswith(b'Invalid')
+        except Exception:
+            pass
+
+        results.append((route, ok, time.perf_counter() - due))
+
+
+# Nearest rank percentile, from sorted values
+def percentile(values, number):
+    rank = math.ceil(number / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+# Print results for each route
+def report(results, seconds):
+    routes = {}
+    for route, ok, latency in results:
+        routes.setdefault(route, []).append((ok, latency))
+
+    print()
+    print(
+        f"{'Route':<14}{'Sent':>7}{'Errors':>8}{'Error%':>8}{'Req/s':>8}"
+        f"{'p50ms':>9}{'p95ms':>9}{'p99ms':>9}"
+    )
+    for route, items in sorted(routes.items()):
+        errors = sum(1 for ok, _ in items if not ok)
+        latencies = sorted(latency * 1000 for _, latency in items)
+        print(
+            f"{route:<14}{len(items):>7}{errors:>8}"
+            f"{errors / len(items):>8.1%}{len(items) / seconds:>8.1f}"
+            f"{percentile(latencies, 50):>9.1f}"
+            f"{percentile(latencies, 95):>9.1f}"
+            f"{percentile(latencies, 99):>9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Webhook load test')
+    parser.add_argument('--source', default=FOLDER)
+    parser.add_argument('--synthetic', action='store_true')
+    parser.add_argument('--rate', type=float, default=20)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--url', default='')
+    parser.add_argument('--sink-delay', type=float, default=50)
+    parser.add_argument('--plugins', nargs='*', default=[])
+    args = parser.parse_args()
+
+    # Routes for each plugin, from the global config
+    from config import PLUGINS
+    routes = {name: entry['route'] for name, entry in PLUGINS.items()}
+
+    webhooks = load(args.source, routes, args.plugins)
+    if not webhooks:
+        print(f"No webhooks found in {args.source}")
+        return
+    print(f"{len(webhooks)} webhooks loaded from {args.source}")
+
+    url = args.url or start_app(args.sink_delay / 1000)
+    count = int(args.rate * args.duration)
+    print(f"Sending {count} webhooks to {url}, at {args.rate}/s")
+
+    jobs = queue.Queue()
+    results = []
+    threads = [
+        threading.Thread(target=worker, args=(url, jobs, results))
+        for _ in range(args.workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Schedule every webhook up front, one every 1/rate seconds
+    start = time.perf_counter() + 0.5
+    for number in range(count):
+        plugin, route, headers, body = random.choice(webhooks)
+        if args.synthetic:
+            try:
+                body = json.dumps(
+                    synthesise(json.loads(body), number)
+                ).encode('utf-8')
+            except ValueError:
+                pass
+        jobs.put((start + number / args.rate, route, headers, body))
+
+    for _ in threads:
+        jobs.put(None)
+    for thread in threads:
+        thread.join()
+
+    report(results, time.perf_counter() - start)
+    if not args.url:
+        print()
+        print("Stand-in sinks: " + ', '.join(
+            f"{value} {name}" for name, value in sinks.items()
+        ))
+
+
+if __name__ == '__main__':
+    main()
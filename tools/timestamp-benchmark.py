@@ -0,0 +1,126 @@
+"""
+Timestamp handling: Microbenchmark
+
+Compares the shared timestamp service (core/timestamp.py) with the way
+    plugins used to handle timestamps:
+    dateutil.parser.parse, then get_localzone() and pytz.timezone() for
+    every alert, and datetime.now() twice for the SQL date and time
+
+Usage:
+    python tools/timestamp-benchmark.py [count]
+
+    'count' is the number of timestamps converted in each test
+
+Authentication:
+    None
+
+Restrictions:
+    Run from the root of the project
+    The old method is skipped if dateutil, tzlocal, or pytz aren't installed
+
+To Do:
+    None
+
+Author:
+    Luke Robertson - May 2023
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.getcwd())
+from core import timestamp   # noqa: E402
+
+
+COUNT = 20000
+
+
+# Sample timestamps, as different webhooks send them
+def samples(count):
+    start = datetime(2023, 5, 1, tzinfo=timezone.utc)
+    times = [start + timedelta(seconds=n * 7) for n in range(count)]
+
+    return {
+        'ISO-8601 (Z)': [
+            t.strftime('%Y-%m-%dT%H:%M:%S.%fZ') for t in times
+        ],
+        'ISO-8601 (offset)': [t.isoformat() for t in times],
+        'Epoch seconds': [int(t.timestamp()) for t in times],
+        'Epoch ms (text)': [str(int(t.timestamp() * 1000)) for t in times],
+    }
+
+
+# The old method, as used by the CloudFlare plugin
+def old_method():
+    try:
+        from dateutil.parser import parse
+        from tzlocal import get_localzone
+        from pytz import timezone as pytz_timezone
+    except ImportError:
+        return None
+
+    def convert(value):
+        stamp = parse(value)
+        stamp = stamp.astimezone(pytz_timezone(str(get_localzone())))
+        date = datetime.now().date()
+        clock = datetime.now().time().strftime("%H:%M:%S")
+        return stamp.strftime("%H:%M:%S"), date, clock
+
+    return convert
+
+
+# The shared timestamp service
+def new_method(value):
+    when = timestamp.event_time(value)
+    date, clock = timestamp.log_fields(when)
+    return timestamp.clock(when), date, clock
+
+
+# Time a method over a list of values
+def run(method, values):
+    start = time.perf_counter()
+    for value in values:
+        method(value)
+    return time.perf_counter() - start
+
+
+# Print a line of results
+def show(name, seconds, count):
+    if seconds is None:
+        print(f"  {name:<28} not available")
+        return
+
+    print(
+        f"  {name:<28} {seconds * 1000:8.1f}ms  "
+        f"{seconds / count * 1e6:6.2f}us each"
+    )
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else COUNT
+    old = old_method()
+
+    print(f"Converting {count} timestamps")
+    for name, values in samples(count).items():
+        print()
+        print(name)
+
+        # Each timestamp is unique, so the cache doesn't help here
+        timestamp.from_text.cache_clear()
+        show('core.timestamp', run(new_method, values), count)
+
+        # Batches often share timestamps; Repeat a few, so the cache is hit
+        repeated = values[:100] * (count // 100)
+        show('core.timestamp (repeated)', run(new_method, repeated), count)
+
+        # The old method only handled ISO-8601 text
+        if old is None or name.startswith('Epoch'):
+            show('dateutil + pytz', None, count)
+        else:
+            show('dateutil + pytz', run(old, values), count)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,8 +8,14 @@ Usage:
     Test the web server - Browse to /test
     Test the mist webhook - GET /mist
     Send a Mist webhook - POST /mist
+    Get metrics for Prometheus - GET /metrics
+    Find traces - GET /admin/traces?message={teams message ID}
+    Profile the service - POST /admin/profile?seconds=30
+    Get the last profile - GET /admin/profile
 
 Authentication:
+    Admin endpoints - Send the admin secret (see config.yaml) in the
+        X-Admin-Secret header; The endpoints are disabled without a secret
     Mist - Not required, as this service passively receives webhooks
 
 Restrictions:
@@ -36,14 +42,23 @@ Author:
 from core import azureauth
 from core import crypto
 from core import teamschat
+from core import jobs
+from core import decode
+from core import metrics
+from core import trace
+from core import profiler
+from core import capture
+from core import suppress, correlate, routing, maintenance
 from nlp import nlp
 
-from config import GLOBAL, GRAPH, TEAMS
+from config import GLOBAL, GRAPH, TEAMS, TRACING
 from config import PLUGINS, plugin_list
 
 from flask import Flask, request, Response
 import importlib
 import termcolor
+import hmac
+import json
 from urllib.parse import urlparse, parse_qs
 import threading
 
@@ -107,6 +122,84 @@ print(termcolor.colored(f"Plugins: {plugin_list}", "cyan"))
 chat_nlp = nlp.ChatNlp()
 
 
+# Start the job engine, resuming any jobs from the last run
+jobs.engine.start()
+
+
+# Metrics, for Prometheus (see core/metrics.py)
+WEBHOOKS = metrics.counter(
+    'webhooks_total',
+    'Webhooks received, by plugin and result',
+    ('plugin', 'result')
+)
+HANDLE_LATENCY = metrics.histogram(
+    'handle_event_seconds',
+    'Time taken by plugins to handle a webhook',
+    ('plugin',)
+)
+
+
+def jobs_waiting():
+    with jobs.engine.lock:
+        return sum(len(waiting) for waiting in jobs.engine.waiting.values())
+
+
+def routing_hits():
+    with routing.engine.lock:
+        return {
+            rule['name']: hits
+            for rule, hits in zip(routing.engine.rules, routing.engine.hits)
+        }
+
+
+metrics.gauge(
+    'jobs_ready',
+    'Jobs waiting for a worker',
+    jobs.engine.ready.qsize
+)
+metrics.gauge(
+    'jobs_waiting',
+    'Jobs waiting for another job on the same device',
+    jobs_waiting
+)
+metrics.gauge(
+    'suppress_entries',
+    'Fingerprints in the suppression table',
+    lambda: len(suppress.engine.entries)
+)
+metrics.gauge(
+    'suppress_events_total',
+    'Events checked for suppression, by result',
+    lambda: dict(suppress.engine.stats),
+    ('result',),
+    'counter'
+)
+metrics.gauge(
+    'correlate_open_incidents',
+    'Incidents that are open',
+    lambda: len(correlate.engine.expiry)
+)
+metrics.gauge(
+    'correlate_incidents_total',
+    'Incidents opened and closed, and events correlated',
+    lambda: dict(correlate.engine.stats),
+    ('result',),
+    'counter'
+)
+metrics.gauge(
+    'routing_hits_total',
+    'Events routed by each routing rule',
+    routing_hits,
+    ('rule',),
+    'counter'
+)
+metrics.gauge(
+    'maintenance_windows',
+    'Maintenance windows (including ones that are due to start)',
+    lambda: len(maintenance.store.windows)
+)
+
+
 # Authenticate with Microsoft (for teams)
 print('Calling client_auth')
 azure = azureauth.AzureAuth()
@@ -127,6 +220,78 @@ def test():
     return message
 
 
+# Metrics URL - Scraped by Prometheus
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    return Response(
+        metrics.render(),
+        status=200,
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
+# Check the admin secret, for the /admin endpoints
+# The endpoints are disabled if there's no secret in the config
+def admin_allowed():
+    secret = str(TRACING['admin_secret'] or '')
+    given = request.headers.get('X-Admin-Secret', '')
+    return bool(secret) and hmac.compare_digest(
+        given.encode(),
+        secret.encode()
+    )
+
+
+# Admin URL - Find traces by trace ID or Teams message ID
+# With no IDs, the most recent traces are returned
+@app.route("/admin/traces", methods=['GET'])
+def admin_traces():
+    if not admin_allowed():
+        return Response('Not found', status=404)
+
+    found = trace.log.find(
+        trace_id=request.args.get('trace'),
+        message_id=request.args.get('message')
+    )
+    return Response(
+        json.dumps(found, indent=2),
+        status=200,
+        mimetype='application/json'
+    )
+
+
+# Admin URL - Start profiling (POST), or get the last report (GET)
+# Profiles run in the background, for the given number of seconds
+@app.route("/admin/profile", methods=['GET', 'POST'])
+def admin_profile():
+    if not admin_allowed():
+        return Response('Not found', status=404)
+
+    if request.method == 'GET':
+        if profiler.profiler.running:
+            return Response('A profile is running', status=202)
+        return Response(
+            profiler.profiler.report or 'No profile has been run',
+            status=200,
+            mimetype='text/plain'
+        )
+
+    try:
+        seconds = float(request.args.get('seconds', 30))
+    except ValueError:
+        seconds = 0
+    if seconds <= 0:
+        return Response('Invalid number of seconds', status=400)
+
+    if not profiler.profiler.start(seconds):
+        return Response('A profile is already running', status=409)
+
+    return Response(
+        f"Profiling for {min(seconds, TRACING['max_profile_seconds'])} "
+        "seconds",
+        status=202
+    )
+
+
 # Callback URL; Used for MS Identity authentication
 # When a user authenticates, a code is returned here
 @app.route("/callback", methods=['GET'])
@@ -155,18 +320,61 @@ def webhook_handler(handler):
     for plugin in plugin_list:
         # Confirm that a route exists for this plugin
         if handler == plugin['route']:
-            # Authenticate the webhook
-            if plugin['handler'].authenticate(request=request, plugin=plugin):
-                # If authenticated, send this to the handler
-                plugin['handler'].handle_event(raw_response=request.json,
-                                               src=source_ip)
-
-            # Return a positive response
-            return ('Webhook received')
+            with trace.request('webhook', plugin['name']):
+                return handle_webhook(plugin, source_ip)
 
     return ('Invalid path')
 
 
+# Authenticate, decode, and handle a webhook for a plugin
+# Each stage is timed as a span of the webhook's trace (see core/trace.py)
+def handle_webhook(plugin, source_ip):
+    # Authenticate the webhook
+    with trace.span('authenticate'):
+        authenticated = plugin['handler'].authenticate(
+            request=request,
+            plugin=plugin
+        )
+    if not authenticated:
+        WEBHOOKS.inc(plugin['name'], 'unauthenticated')
+        return ('Webhook received')
+
+    # Keep a sample of webhooks, for load testing (see tools/replay.py)
+    capture.writer.capture(
+        plugin['name'],
+        plugin['route'],
+        request.headers,
+        request.get_data()
+    )
+
+    # Drop filtered webhooks before decoding them
+    with trace.span('prefilter'):
+        filtered = plugin['handler'].prefilter(request.get_data())
+    if filtered:
+        WEBHOOKS.inc(plugin['name'], 'filtered')
+        return ('Webhook received')
+
+    # Decode the webhook (see core/decode.py)
+    try:
+        with trace.span('decode'):
+            payload = plugin['handler'].decode(request.get_data())
+    except ValueError as err:
+        print(termcolor.colored(
+            f"Could not decode the webhook: {err}",
+            "red"
+        ))
+        WEBHOOKS.inc(plugin['name'], 'invalid')
+        return ('Invalid webhook')
+
+    # If authenticated, send this to the handler
+    with trace.span('handle_event'), HANDLE_LATENCY.time(plugin['name']):
+        plugin['handler'].handle_event(raw_response=payload, src=source_ip)
+    WEBHOOKS.inc(plugin['name'], 'handled')
+
+    # Return a positive response
+    return ('Webhook received')
+
+
 # GraphAPI - Listens for change notifications
 # This is when new messages are sent to the chatbot
 @app.route("/chat", methods=['POST'])
@@ -180,67 +388,76 @@ def chat():
 
     # Or, is this a webhook
     else:
-        # Extract the values we need from the webhook
-        body_value = request.json['value']
-        encrypted_session_key = body_value[0]['encryptedContent']['dataKey']
-        signature = body_value[0]['encryptedContent']['dataSignature']
-        data = body_value[0]['encryptedContent']['data']
+        with trace.request('chat'):
+            return handle_chat()
+
+
+# Decrypt a message from Teams, and respond to it
+def handle_chat():
+    # Extract the values we need from the webhook
+    body_value = decode.loads(request.get_data())['value']
+    encrypted_session_key = body_value[0]['encryptedContent']['dataKey']
+    signature = body_value[0]['encryptedContent']['dataSignature']
+    data = body_value[0]['encryptedContent']['data']
 
-        # Decrypt the symmetric key
+    # Decrypt the symmetric key
+    with trace.span('decrypt'):
         decrypted_symmetric_key = crypto.rsa_decrypt(encrypted_session_key)
-        if not decrypted_symmetric_key:
-            print(termcolor.colored("Could not decrypt message", "red"))
-            return ('received')
+    if not decrypted_symmetric_key:
+        print(termcolor.colored("Could not decrypt message", "red"))
+        return ('received')
 
-        # Validate the signature - Tamper prevention
-        if crypto.validate(decrypted_symmetric_key, data, signature):
-            # Decrypt the message
+    # Validate the signature - Tamper prevention
+    if crypto.validate(decrypted_symmetric_key, data, signature):
+        # Decrypt the message
+        with trace.span('decrypt'):
             decrypted_payload = crypto.aes_decrypt(
                 decrypted_symmetric_key,
                 data
             )
 
-            # Get key fields from the message
-            # Sometimes the API sends a message with no name - we can ignore
-            try:
-                name = decrypted_payload['from']['user']['displayName']
-            except Exception:
-                return ('received')
+        # Get key fields from the message
+        # Sometimes the API sends a message with no name - we can ignore
+        try:
+            name = decrypted_payload['from']['user']['displayName']
+        except Exception:
+            return ('received')
 
-            message = decrypted_payload['body']['content']
-            chat_msg_id = decrypted_payload['chatId']
+        message = decrypted_payload['body']['content']
+        chat_msg_id = decrypted_payload['chatId']
 
-            # If it's the chatbot talking, ignore (no need to talk to itself)
-            if name == GLOBAL['chatbot_name']:
-                return ('received')
+        # If it's the chatbot talking, ignore (no need to talk to itself)
+        if name == GLOBAL['chatbot_name']:
+            return ('received')
 
-            # Check that this sender is authorized, and parse the message
-            if chat_msg_id in APPROVED_LIST:
+        # Check that this sender is authorized, and parse the message
+        if chat_msg_id in APPROVED_LIST:
+            with trace.span('parse'):
                 chat_nlp.parse(phrase=message, chat_id=chat_msg_id)
 
-            else:
-                print(termcolor.colored(
-                    f"User {name} is not authorized",
-                    "red"
-                ))
-                teamschat.send_chat(
-                    f"User {name} tried to chat, but is unauthorized.<br> \
-                    ID: {chat_msg_id}",
-                    GRAPH['chat_id']
-                )
-                teamschat.send_chat(
-                    "Sorry, I can't chat to you right now. \
-                    You need to be authorized. \
-                    An admin has been notified",
-                    chat_msg_id
-                )
-
         else:
-            print("Validation failed")
-            print("Data may have been tampered with")
-            return "Error"
+            print(termcolor.colored(
+                f"User {name} is not authorized",
+                "red"
+            ))
+            teamschat.send_chat(
+                f"User {name} tried to chat, but is unauthorized.<br> \
+                ID: {chat_msg_id}",
+                GRAPH['chat_id']
+            )
+            teamschat.send_chat(
+                "Sorry, I can't chat to you right now. \
+                You need to be authorized. \
+                An admin has been notified",
+                chat_msg_id
+            )
 
-        return ('received')
+    else:
+        print("Validation failed")
+        print("Data may have been tampered with")
+        return "Error"
+
+    return ('received')
 
 
 # Start the Flask app